@@ -0,0 +1,168 @@
+"""
+Username rename and account purge cascades.
+
+Community tables reference users by username rather than id, so renaming or
+purging an account has to touch rows in many tables. These cascades run as
+background jobs (see background_jobs) in keyset-paginated batches. A purge
+records the highest row id of every table at enqueue time and never touches
+rows above it, so a newcomer who claims the freed username is not swept up.
+
+A renamed row can collide with a UNIQUE constraint when the account already
+has the same row under its new name (e.g. a reaction to the same post). The
+old-name duplicate is then deleted in the same batch, so nothing is left
+behind under the old name. The old name stays reserved in
+`username_reservations` until the rename job has finished, so nobody can sign
+up with it or rename to it while rows still point at it. Every row under the
+reserved name therefore belongs to the renamed account, including rows written
+after the job was queued (a DM or friend request addressed to the old name),
+so a rename is not bounded by id. Once all steps are done, the job re-checks
+every column under the write lock and releases the reservation only if nothing
+is left; otherwise it runs the steps again.
+"""
+from background_jobs import register_job, enqueue_job
+
+CASCADE_BATCH_SIZE = 500
+
+# (table, column) pairs that store a username
+USERNAME_COLUMNS = [
+    ('forum_posts', 'author_name'),
+    ('direct_messages', 'sender_name'),
+    ('direct_messages', 'receiver_name'),
+    ('friendships', 'user1_name'),
+    ('friendships', 'user2_name'),
+    ('post_reactions', 'username'),
+    ('message_reactions', 'username'),
+    ('channel_members', 'username'),
+    ('channel_members', 'invited_by'),
+    ('channel_opt_out', 'username'),
+    ('channel_invites', 'invited_by'),
+    ('channel_invites', 'invitee_username'),
+    ('channel_invites', 'owner_approved_by'),
+    ('channel_post_notifications', 'recipient_username'),
+    ('forum_channels', 'owner_name'),
+]
+
+# Purge steps: (table, match condition, action). Forum posts are anonymized
+# rather than deleted so replies from other parents keep their thread.
+PURGE_STEPS = [
+    ('post_reactions', 'username = :username', 'DELETE'),
+    ('message_reactions', 'username = :username', 'DELETE'),
+    ('direct_messages', 'sender_name = :username OR receiver_name = :username', 'DELETE'),
+    ('friendships', 'user1_name = :username OR user2_name = :username', 'DELETE'),
+    ('channel_members', 'username = :username', 'DELETE'),
+    ('channel_opt_out', 'username = :username', 'DELETE'),
+    ('channel_invites', 'invited_by = :username OR invitee_username = :username', 'DELETE'),
+    ('channel_post_notifications', 'recipient_username = :username', 'DELETE'),
+    ('forum_channels', 'owner_name = :username', 'SET owner_name = NULL'),
+    ('forum_posts', 'author_name = :username',
+     "SET author_name = 'deleted-user', content = '[deleted]', file_path = NULL, file_type = NULL, file_name = NULL"),
+    ('messages', 'conversation_id IN (SELECT id FROM conversations WHERE user_id = :user_id)', 'DELETE'),
+    ('conversations', 'user_id = :user_id', 'DELETE'),
+    ('baby_profiles', 'user_id = :user_id', 'DELETE'),
+    ('sleep_goals', 'user_id = :user_id', 'DELETE'),
+    ('sleep_factors', 'user_id = :user_id', 'DELETE'),
+    ('forum_users', 'username = :username', 'DELETE'),
+]
+
+RENAME_STEPS = [
+    (table, f'{column} = :old', f'SET {column} = :new') for table, column in USERNAME_COLUMNS
+]
+
+
+def _table_high_water_marks(cursor, tables):
+    marks = {}
+    for table in sorted(set(tables)):
+        cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+        marks[table] = cursor.fetchone()[0]
+    return marks
+
+
+def _run_steps(cursor, steps, params, state):
+    """Process one batch of the current step; advance to the next step when exhausted"""
+    step_index = state.get('step', 0)
+    last_id = state.get('last_id', 0)
+    if step_index >= len(steps):
+        return state, 0, True
+
+    table, condition, action = steps[step_index]
+    # Jobs without high water marks (renames) process every matching row
+    bound = 'AND id <= :max_id' if 'max_ids' in params else ''
+    cursor.execute(f'''
+        SELECT id FROM {table}
+        WHERE ({condition}) AND id > :last_id {bound}
+        ORDER BY id
+        LIMIT :limit
+    ''', {**params, 'last_id': last_id, 'max_id': params.get('max_ids', {}).get(table, 0), 'limit': CASCADE_BATCH_SIZE})
+    ids = [row[0] for row in cursor.fetchall()]
+
+    if ids:
+        id_params = {f'id{i}': row_id for i, row_id in enumerate(ids)}
+        placeholders = ', '.join(f':{name}' for name in id_params)
+        if action == 'DELETE':
+            cursor.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', {**params, **id_params})
+        else:
+            # OR IGNORE skips rows that would collide with a UNIQUE constraint.
+            # Those still match the condition; they duplicate an existing row, so drop them.
+            cursor.execute(f'UPDATE OR IGNORE {table} {action} WHERE id IN ({placeholders})', {**params, **id_params})
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id IN ({placeholders}) AND ({condition})',
+                {**params, **id_params}
+            )
+
+    if len(ids) < CASCADE_BATCH_SIZE:
+        state = {'step': step_index + 1, 'last_id': 0, 'total_steps': len(steps)}
+    else:
+        state = {'step': step_index, 'last_id': ids[-1], 'total_steps': len(steps)}
+    return state, len(ids), state['step'] >= len(steps)
+
+
+def _rows_left(cursor, steps, params):
+    for table, condition, _ in steps:
+        cursor.execute(f'SELECT 1 FROM {table} WHERE {condition} LIMIT 1', params)
+        if cursor.fetchone() is not None:
+            return True
+    return False
+
+
+@register_job('rename_user')
+def run_rename_user(cursor, payload, state):
+    # Payloads queued before renames were unbounded still carry high water marks
+    params = {key: value for key, value in payload.items() if key != 'max_ids'}
+    state, rows, done = _run_steps(cursor, RENAME_STEPS, params, state)
+    if done:
+        # Hold the write lock so no row can be written under the old name between
+        # the check and the release; both commit with this batch
+        if not cursor.connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        if _rows_left(cursor, RENAME_STEPS, params):
+            return {'step': 0, 'last_id': 0, 'total_steps': len(RENAME_STEPS)}, rows, False
+        cursor.execute(
+            'DELETE FROM username_reservations WHERE username = ? AND user_id = ?',
+            (payload['old'], payload['user_id'])
+        )
+    return state, rows, done
+
+
+@register_job('purge_user')
+def run_purge_user(cursor, payload, state):
+    return _run_steps(cursor, PURGE_STEPS, payload, state)
+
+
+def enqueue_rename(cursor, user_id, old_username, new_username):
+    """Queue a cascade moving all username-keyed rows from old_username to new_username"""
+    job_id = enqueue_job(cursor, 'rename_user', {
+        'user_id': user_id, 'old': old_username, 'new': new_username
+    }, user_id=user_id)
+    cursor.execute('''
+        INSERT OR REPLACE INTO username_reservations (username, user_id, job_id)
+        VALUES (?, ?, ?)
+    ''', (old_username, user_id, job_id))
+    return job_id
+
+
+def enqueue_purge(cursor, user_id, username):
+    """Queue a cascade deleting (or anonymizing) all of a user's rows"""
+    max_ids = _table_high_water_marks(cursor, [table for table, _, _ in PURGE_STEPS])
+    return enqueue_job(cursor, 'purge_user', {
+        'user_id': user_id, 'username': username, 'max_ids': max_ids
+    }, user_id=user_id)
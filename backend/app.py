@@ -1,20 +1,49 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import google.generativeai as genai
 import os
+import base64
 import secrets
 import uuid
-import json
 import re
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 from database import init_db, get_db_connection
 from models import Conversation, Message
+from llm_provider import LLM_PROVIDER, chat_model_name, get_chat_model, llm_configured, with_system_prompt
+from metrics import average, gauge_add, increment, observe, observe_value, snapshot as metrics_snapshot
+from conversation_context import estimate_tokens, load_prompt_history, schedule_summary_refresh
+from user_context import calculate_age_months, get_user_context_block
+from response_cache import get_cached_response, is_cacheable_turn, replay_chunks, store_cached_response
+from chat_stream import StreamedReply, close_upstream, coalesce_chunks
+from history_retrieval import retrieve_related_turns
+from history_cache import format_transcript
+from chat_prefetch import prefetch, prefetched, stage
+from stream_registry import StreamGone, create_stream, get_stream, parse_last_event_id
+from llm_admission import AdmissionRejected, admit_llm_call
+from llm_resilience import (
+    PROVIDER_ERRORS, PROVIDER_UNAVAILABLE_MESSAGE, generate_stream, generate_text
+)
+from rate_limit_storage import DEFAULT_RATE_LIMIT_STORAGE_URI
+from email_outbox import enqueue_email, notify_outbox, start_outbox_worker
+from profile_cache import bump_profile_version, cached_json_response
+from background_jobs import get_job, notify_jobs, start_job_runner
+from account_cascade import enqueue_rename, enqueue_purge
+import conversation_gc  # registers the periodic conversation_gc job
+from usage_ledger import (
+    LLM_DAILY_TOKEN_QUOTA, LLM_DAILY_TURN_QUOTA, QuotaExceeded, UsageRecord,
+    check_quota, get_daily_usage, get_today_usage, record_usage, start_usage_writer
+)
+from username_availability import (
+    username_exists, email_exists, is_username_available, pick_available_username, mark_username_taken
+)
 from security_utils import (
     validate_password_strength, validate_email, validate_username, validate_name,
     validate_input_length, handle_error, safe_log, MAX_MESSAGE_LENGTH, MAX_POST_LENGTH, MAX_BIO_LENGTH
@@ -23,14 +52,6 @@ from security_utils import (
 # Load environment variables
 load_dotenv()
 
-# Email configuration
-try:
-    import resend
-    RESEND_AVAILABLE = True
-except ImportError:
-    RESEND_AVAILABLE = False
-    print("Warning: Resend not installed. Email functionality will be disabled.")
-
 
 def get_user_from_session_token(session_token):
     """Return the authenticated user (sqlite Row) for a session token, or None."""
@@ -53,10 +74,8 @@ def get_user_from_session_token(session_token):
         return None
 
 
-def generate_conversation_title(message, existing_titles=None):
+def generate_conversation_title(message):
     """Generate a concise, descriptive title for a conversation based on the message."""
-    if existing_titles is None:
-        existing_titles = []
     text = (message or '').strip()
     if not text:
         base_title = "Sleep Chat"
@@ -95,322 +114,30 @@ def generate_conversation_title(message, existing_titles=None):
                 base_title = candidate.title()
     if not base_title:
         base_title = "Sleep Chat"
-    existing_lower = {t.lower() for t in existing_titles if t}
-    final_title = base_title
-    suffix = 2
-    while final_title.lower() in existing_lower:
-        final_title = f"{base_title} #{suffix}"
-        suffix += 1
-    return final_title
-
-def send_welcome_email(email, first_name, username):
-    """Send a welcome email to new users"""
-    if not RESEND_AVAILABLE:
-        safe_log('info', 'Email sending disabled. Would send welcome email')
-        return False
-    
-    resend_api_key = os.getenv('RESEND_API_KEY')
-    resend_from_email = os.getenv('RESEND_FROM_EMAIL', 'noreply@remi.app')
-    
-    if not resend_api_key:
-        print("Warning: RESEND_API_KEY not set. Email sending disabled.")
-        return False
-    
-    try:
-        html_content = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: 'Nunito', Arial, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                }}
-                .header {{
-                    background: #3a1f35;
-                    color: white;
-                    padding: 30px;
-                    text-align: center;
-                    border-radius: 10px 10px 0 0;
-                }}
-                .header h1 {{
-                    margin: 0;
-                    font-size: 2.5rem;
-                }}
-                .content {{
-                    background: #f9f9f9;
-                    padding: 30px;
-                    border-radius: 0 0 10px 10px;
-                }}
-                .button {{
-                    display: inline-block;
-                    background: #3a1f35;
-                    color: white;
-                    padding: 12px 30px;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin-top: 20px;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1><span style="color: #fff3d1;">REM</span>i</h1>
-                <p style="margin: 10px 0 0 0;">Shaping sleep, one night at a time</p>
-            </div>
-            <div class="content">
-                <h2>Welcome, {first_name}! 👋</h2>
-                <p>Thank you for joining REMi! We're so excited to help you on your sleep training journey.</p>
-                <p>Your account has been successfully created with the username: <strong>{username}</strong></p>
-                <p>You can now:</p>
-                <ul>
-                    <li>💬 Chat with our AI sleep specialist for personalized advice</li>
-                    <li>🏘️ Join the Village community to connect with other parents</li>
-                    <li>👥 Add friends and share experiences</li>
-                    <li>📝 Get expert guidance on sleep training methods</li>
-                </ul>
-                <p>We're here to support you every step of the way. If you have any questions, don't hesitate to reach out!</p>
-                <p>Sweet dreams! 🌙</p>
-                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
-                    Best regards,<br>
-                    The REMi Team
-                </p>
-            </div>
-        </body>
-        </html>
-        '''
-        
-        resend_client = resend.Resend(api_key=resend_api_key)
-        
-        params = {
-            "from": resend_from_email,
-            "to": [email],
-            "subject": "Welcome to REMi! 🌙",
-            "html": html_content
-        }
-        
-        email_response = resend_client.emails.send(params)
-        safe_log('info', 'Welcome email sent successfully')
-        return True
-    except Exception as e:
-        safe_log('error', 'Error sending welcome email')
-        # Don't fail signup if email fails
-        return False
+    return base_title
 
-def send_verification_email(email, first_name, verification_token):
-    """Send email verification email to new users"""
-    if not RESEND_AVAILABLE:
-        safe_log('info', 'Email sending disabled. Would send verification email')
-        return False
-    
-    resend_api_key = os.getenv('RESEND_API_KEY')
-    resend_from_email = os.getenv('RESEND_FROM_EMAIL', 'noreply@remi.app')
-    frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
-    
-    if not resend_api_key:
-        print("Warning: RESEND_API_KEY not set. Email sending disabled.")
-        return False
-    
-    try:
-        verification_url = f"{frontend_url}/verify-email?token={verification_token}"
-        resend_client = resend.Resend(api_key=resend_api_key)
-        
-        html_content = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: 'Nunito', Arial, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                }}
-                .header {{
-                    background: #3a1f35;
-                    color: white;
-                    padding: 30px;
-                    text-align: center;
-                    border-radius: 10px 10px 0 0;
-                }}
-                .header h1 {{
-                    margin: 0;
-                    font-size: 2.5rem;
-                }}
-                .content {{
-                    background: #f9f9f9;
-                    padding: 30px;
-                    border-radius: 0 0 10px 10px;
-                }}
-                .button {{
-                    display: inline-block;
-                    background: #3a1f35;
-                    color: white;
-                    padding: 12px 30px;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin-top: 20px;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1><span style="color: #fff3d1;">REM</span>i</h1>
-                <p style="margin: 10px 0 0 0;">Shaping sleep, one night at a time</p>
-            </div>
-            <div class="content">
-                <h2>Welcome, {first_name}! 👋</h2>
-                <p>Thank you for joining REMi! We're excited to help you on your sleep training journey.</p>
-                <p>To complete your registration, please verify your email address by clicking the button below:</p>
-                <div style="text-align: center; margin: 30px 0;">
-                    <a href="{verification_url}" class="button">Verify Email Address</a>
-                </div>
-                <p>Or copy and paste this link into your browser:</p>
-                <p style="word-break: break-all; color: #666; font-size: 0.9rem;">{verification_url}</p>
-                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
-                    This link will expire in 24 hours. If you didn't create an account with REMi, you can safely ignore this email.
-                </p>
-                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
-                    Best regards,<br>
-                    The REMi Team
-                </p>
-            </div>
-        </body>
-        </html>
-        '''
-        
-        params = {
-            "from": resend_from_email,
-            "to": [email],
-            "subject": "Verify your REMi account 🌙",
-            "html": html_content
-        }
-        
-        email_response = resend_client.emails.send(params)
-        safe_log('info', 'Verification email sent successfully')
-        return True
-    except Exception as e:
-        safe_log('error', 'Error sending verification email')
-        return False
 
-def send_password_reset_email(email, first_name, reset_token):
-    """Send password reset email"""
-    if not RESEND_AVAILABLE:
-        safe_log('info', 'Email sending disabled. Would send password reset email')
-        return False
-    
-    resend_api_key = os.getenv('RESEND_API_KEY')
-    resend_from_email = os.getenv('RESEND_FROM_EMAIL', 'noreply@remi.app')
-    frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
-    
-    if not resend_api_key:
-        print("Warning: RESEND_API_KEY not set. Email sending disabled.")
-        return False
-    
-    try:
-        reset_url = f"{frontend_url}/reset-password?token={reset_token}"
-        resend_client = resend.Resend(api_key=resend_api_key)
-        
-        html_content = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: 'Nunito', Arial, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                }}
-                .header {{
-                    background: #3a1f35;
-                    color: white;
-                    padding: 30px;
-                    text-align: center;
-                    border-radius: 10px 10px 0 0;
-                }}
-                .header h1 {{
-                    margin: 0;
-                    font-size: 2.5rem;
-                }}
-                .content {{
-                    background: #f9f9f9;
-                    padding: 30px;
-                    border-radius: 0 0 10px 10px;
-                }}
-                .button {{
-                    display: inline-block;
-                    background: #3a1f35;
-                    color: white;
-                    padding: 12px 30px;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin-top: 20px;
-                }}
-                .warning {{
-                    background: #fff3cd;
-                    border-left: 4px solid #ffc107;
-                    padding: 15px;
-                    margin: 20px 0;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1><span style="color: #fff3d1;">REM</span>i</h1>
-                <p style="margin: 10px 0 0 0;">Shaping sleep, one night at a time</p>
-            </div>
-            <div class="content">
-                <h2>Hello, {first_name}!</h2>
-                <p>We received a request to reset your password for your REMi account.</p>
-                <p>Click the button below to reset your password:</p>
-                <div style="text-align: center; margin: 30px 0;">
-                    <a href="{reset_url}" class="button">Reset Password</a>
-                </div>
-                <p>Or copy and paste this link into your browser:</p>
-                <p style="word-break: break-all; color: #666; font-size: 0.9rem;">{reset_url}</p>
-                <div class="warning">
-                    <strong>⚠️ Security Notice:</strong> This link will expire in 1 hour. If you didn't request a password reset, please ignore this email and your password will remain unchanged.
-                </div>
-                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
-                    Best regards,<br>
-                    The REMi Team
-                </p>
-            </div>
-        </body>
-        </html>
-        '''
-        
-        params = {
-            "from": resend_from_email,
-            "to": [email],
-            "subject": "Reset your REMi password 🔒",
-            "html": html_content
-        }
-        
-        email_response = resend_client.emails.send(params)
-        safe_log('info', 'Password reset email sent successfully')
-        return True
-    except Exception as e:
-        safe_log('error', 'Error sending password reset email')
-        return False
+def assign_conversation_title(conversation_id, user_id, message):
+    """Title a conversation from its first message, unique among the user's titles"""
+    return Conversation.assign_unique_title(conversation_id, user_id, generate_conversation_title(message))
 
 app = Flask(__name__)
 
+# Number of reverse proxies in front of the app (Railway's edge in production; 0 when
+# serving clients directly). Their X-Forwarded-For entries give the client address
+# that rate limits and LLM admission are keyed on.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '1'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
 # Rate limiting configuration
+# Counters are kept in a SQLite file shared by all workers on the host (see rate_limit_storage)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"  # Use in-memory storage (consider Redis for production)
+    strategy="moving-window",
+    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', DEFAULT_RATE_LIMIT_STORAGE_URI)
 )
 
 # CORS configuration - secure by default
@@ -434,10 +161,21 @@ else:
 CORS(app, resources={r"/api/*": {
     "origins": allowed_origins,
     "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    "allow_headers": ["Content-Type", "Authorization"],
-    "expose_headers": ["Cache-Control", "X-Accel-Buffering"]
+    "allow_headers": ["Content-Type", "Authorization", "Last-Event-ID"],
+    "expose_headers": ["Cache-Control", "X-Accel-Buffering", "X-Stream-Id", "Retry-After"]
 }})
 
+# Track in-flight requests (worker saturation) for /api/metrics
+@app.before_request
+def track_request_start():
+    g.request_started = time.monotonic()
+    gauge_add('requests_in_flight', 1)
+
+@app.teardown_request
+def track_request_end(exc=None):
+    if 'request_started' in g:
+        gauge_add('requests_in_flight', -1)
+
 # Security headers
 @app.after_request
 def set_security_headers(response):
@@ -452,6 +190,15 @@ def set_security_headers(response):
 # Initialize database
 init_db()
 
+# Deliver queued transactional emails in the background
+start_outbox_worker()
+
+# Run queued background jobs (username cascades, account purges)
+start_job_runner()
+
+# Append buffered LLM usage rows
+start_usage_writer()
+
 # Load API key from environment variable
 gemini_api_key = os.getenv('GEMINI_API_KEY')
 
@@ -491,6 +238,10 @@ BAD_NAME_WORDS = {
 
 MAX_BABY_AGE_MONTHS = 60
 
+# Keyset pagination of conversations and messages
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
 
 def contains_banned_language(value):
     if not value:
@@ -499,14 +250,6 @@ def contains_banned_language(value):
     return any(word in normalized for word in BAD_NAME_WORDS)
 
 
-def calculate_age_months(birth_date):
-    today = datetime.utcnow().date()
-    months = (today.year - birth_date.year) * 12 + (today.month - birth_date.month)
-    if today.day < birth_date.day:
-        months -= 1
-    return months
-
-
 def validate_baby_birthdate(birth_date_str):
     try:
         birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d').date()
@@ -539,238 +282,127 @@ def touch_forum_user(cursor, username):
     )
 
 
-def get_gemini_response(message, conversation_history=None, user_context=None, stream=False):
+def get_gemini_response(message, conversation_history=None, user_context_block=None, stream=False, conversation_summary=None, related_turns=None, usage=None):
     """Get response from Gemini API with sleep training specialization"""
-    if not gemini_api_key:
+    if not llm_configured():
         raise ValueError("Gemini API key not configured. Please set GEMINI_API_KEY environment variable.")
     
-    genai.configure(api_key=gemini_api_key)
-    # Use faster model for quicker responses
-    # Use gemini-flash-latest (the correct alias for the fastest model)
-    model = genai.GenerativeModel('gemini-flash-latest')
+    model = get_chat_model()
     
-    # Sleep training specialist prompt
-    sleep_specialist_prompt = """# REM-i — System Prompt
-
-## Role
-You are REM-i, a gentle baby sleep consultant. You help tired parents reduce night wakings and build healthy, sustainable sleep habits while protecting attachment and following safe-sleep guidelines.
-
-## Priorities (in order)
-1. Safety first  
-   • You are not a medical professional and do not provide medical diagnoses.  
-   • If red flags appear (poor weight gain or growth concerns, breathing issues, persistent snoring, reflux with pain, suspected allergy, fever, chronic illness, apnea events, recurrent vomiting, significant developmental delay, under 12 weeks, preterm without corrected-age use, or reported unsafe sleep), pause coaching and advise consulting their pediatrician.  
-   • Always include safe-sleep basics: firm flat sleep surface, baby on back, no soft bedding or bumpers, smoke-free, avoid overheating, no inclined sleepers or weighted sleepwear. If parents bed-share, offer harm-reduction tips and recommend discussing risks with their clinician.  
-   • Suspend intensive training during illness, major travel disruption, or immunization day if the parent prefers.
-
-Output style (strict)
-- Plain text only. No markdown or code blocks.  
-- Be brief and scannable: aim for 6–10 sentences or ~120–180 words.  
-- Prefer short lines. Use at most 3–5 bullets when listing steps.  
-- Never reveal chain-of-thought; give ready-to-use steps only.
-
-3. Age-appropriate coaching  
-   Use corrected age until 24 months for preterm babies.  
-   • 0–3 months: no formal sleep training; focus on soothing, day/night cues, flexible routines.  
-   • 4–6 months: gentle methods only; establish routine, optimize naps; consider gradual night-weaning if appropriate.  
-   • 7–18 months: gentle first; structured check-ins optional with explicit consent.  
-   • 18–36 months: strong routines, clear boundaries, choices, visual cues (ok-to-wake), crib/bed decisions.
-
-4. Parent-centered support  
-    Default response structure (after intake)
-    1) Empathy + restated goal (1 sentence)  
-    2) Tonight’s plan (3–5 short steps)  
-    3) Day plan (ranges only: naps, last-nap cutoff, bedtime window)  
-    4) Environment (max 3 items: dark, continuous white noise, safe setup)  
-    5) What to expect (1–2 lines) + when to pause or go gentler  
-    6) One follow-up question or a choice between two paths
-    Interaction rules
-    Ask only minimal follow-ups needed. Validate feelings. Be warm, nonjudgmental, concise. Offer 1–3 options that fit their values, capacity, and baby’s temperament. Protect feeding and milk supply; do not restrict feeds in young infants or where growth/supply is uncertain.
-If distress rises, suggest a gentler approach. During regressions/teething/travel: comfort first, slightly earlier bedtime, temporary flexibility; resume after 2–3 stable days. For twins/siblings: keep cues consistent, adapt per child. Do not promise zero wakes; focus on steady progress.
-
-5. Evidence-based and practical  
-   Use current pediatric sleep science. Avoid absolutes; give ranges, not rigid rules. Tailor to temperament and family context.
-
-## Output style
-Plain text only. Do not use markdown, symbols for formatting, or code blocks in responses.  
-Keep responses concise, scannable, and direct. Use short paragraphs and line breaks.  
-Never reveal internal chain-of-thought. Provide clear, user-ready steps only.
-
-## Conversation flow
-        
-### First message behavior (mandatory)
-Begin with a warm greeting and acknowledge whatever the parent already shared. Gather only the key details you still need before offering a plan, but adapt your questions to the parent’s tone and bandwidth. Ask at most 2–3 focused questions at once, referencing what the parent has already told you. If the parent skips a question or seems overwhelmed, summarize what’s still missing, explain why it helps, and then proceed with the best guidance you can using the information available. Do not delay support waiting for a perfect intake, and do not repeat long checklists verbatim.
-
-### After intake is answered
-1) If red flags are present, pause coaching and advise contacting their pediatrician. Offer comfort strategies and safe-sleep reminders without a training plan.  
-2) Otherwise, provide a brief, tailored plan with clear steps and realistic expectations.
-
-### Default response structure (after intake)
-1) Empathy + restated goal  
-2) Tonight’s plan (2–4 short steps)  
-3) Daytime plan (wake-window or nap-timing ranges, nap count, last-nap cutoff, target bedtime window)  
-4) Environment checklist (dark room, continuous white noise, safe-sleep setup, room temp)  
-5) What to expect (first 1–3 nights), how to handle tears, when to pause or reset  
-6) Options (1–3 methods matched to age/temperament: Fading, Chair, Pick Up/Put Down; plus a night-feed plan if appropriate)  
-7) One focused follow-up question or a choice between two paths
-
-### Interaction rules
-Be concise. Avoid overwhelming parents with long lists.  
-If details are missing mid-conversation, ask only the minimum follow-up needed to proceed.  
-When parents choose a method, provide a micro-plan for nights 1–3 and a simple adjustment rule (“if X, then Y”).  
-If distress escalates or the parent feels uneasy, recommend pausing and trying a gentler approach.  
-During regressions/teething/travel: prioritize comfort, slightly earlier bedtime, and temporary flexibility; resume plan after 2–3 stable days.  
-For twins/siblings: stagger starts if needed; keep cues consistent but individualized.  
-Do not promise zero night wakings; focus on progress and consistency.
-
-## Learning + Adaptation Rules
-Observe → Reflect → Adjust
-
-At the end of each plan, include one micro check-in to assess progress.
-Examples:
-* “How did last night go — easier, same, or harder?”
-* “Were there fewer, more, or the same number of night wakings?”
-* “Did your baby settle faster, slower, or about the same?”
-
-Use the parent’s response to adapt the next night’s plan.
-
-### Pattern Learning
-Identify recurring patterns (e.g., bedtime consistency, nap duration, settling method).
-
-Reflect those patterns back to parents so they can see improvement.
-Example: “It seems your baby settles best when bedtime stays within 15 minutes of 7:30 p.m. Let’s keep that tonight.”
-
-### Emotional Feedback
-Occasionally check in on the parent’s wellbeing (“How are you feeling today — exhausted, okay, or rested?”).
-
-Adjust tone accordingly: if “exhausted,” lead with warmth and reassurance before next steps.
-
-### Adaptive Planning
-Modify future plans based on reported outcomes.
-* If “easier” → reinforce success and maintain plan.
-* If “same” → offer a small tweak (e.g., shift bedtime, adjust settling steps).
-* If “harder” → simplify or pause training, increase comfort measures.
-
-### Progress Summaries
-Every few interactions, summarize visible gains:
-“Over the past few nights, you’ve gone from 4 wakes to 2 — that’s real progress.”
-
-Reinforce consistency and resilience.
-
-### Data Consistency
-Treat all user inputs (sleep times, wakings, feeds, emotional tone, chosen method) as contextual learning signals.
-
-Use them to make future recommendations more personalized without asking for additional manual tracking.
-
-## Method guidance (offer 1–3 options)
-Fading: reduce assistance gradually (time, intensity, or proximity) over several nights.  
-Chair Method: parent seated by crib; brief verbal/physical reassurance; increase distance every 1–3 nights.  
-Pick Up/Put Down: soothe to calm, put down drowsy; repeat with decreasing assistance.  
-Responsive settling: brief comforting before each escalation step; stop if distress rises.  
-Night-weaning (only when age/growth appropriate or cleared by clinician): reduce ounces or minutes gradually; preserve one feed if needed; avoid abrupt weans where supply risk exists.  
-Schedule tweaks/wake-to-sleep for habitual wakes when appropriate.
-
-## Scheduling rules
-Build around age-appropriate total day sleep and wake windows; provide ranges and a sample day anchored to their target wake-up time when possible.  
-Include: sample nap timings, caps as needed, last nap latest start, target bedtime window, and a practical night-feed plan.  
-Offer fallback plans for short naps, late naps, or off-days.
-
-## Safety and boundaries reminders
-Reinforce safe-sleep practices in plans.  
-Avoid unsafe recommendations (prone sleeping, inclined sleepers, soft bedding, weighted wearables for infants, overheating).  
-Respect culture and family preferences; be nonjudgmental and inclusive.  
-Encourage parents to seek medical advice when appropriate.
-
-## Closing prompt examples
-Would you like to start with Fading or the Chair approach tonight?  
-Do you want to keep one feed around 3–4 a.m., or begin gradual weaning?  
-Should we anchor wake-up to 7:00 a.m. or keep it flexible for a few days?
-
-"""
+    # Per-request prompt; the static specialist prompt is supplied by llm_provider
+    context_prompt = ""
     
     # Add user context (baby profiles and sleep goals) to prompt if available
-    if user_context:
-        context_section = "\n\n=== PARENT AND BABY INFORMATION ===\n"
-        
-        if user_context.get('baby_profiles') and len(user_context['baby_profiles']) > 0:
-            baby_profiles = user_context['baby_profiles']
-            if len(baby_profiles) == 1:
-                context_section += "Baby Information:\n"
-            else:
-                context_section += f"Baby Information ({len(baby_profiles)} babies):\n"
-            
-            for idx, bp in enumerate(baby_profiles, 1):
-                if len(baby_profiles) > 1:
-                    context_section += f"\nBaby {idx}:\n"
-                if bp.get('name'):
-                    context_section += f"- Baby's name: {bp['name']}\n"
-                if bp.get('age_months'):
-                    context_section += f"- Age: {bp['age_months']} months\n"
-                elif bp.get('birth_date'):
-                    context_section += f"- Birth date: {bp['birth_date']}\n"
-                if bp.get('sleep_issues'):
-                    context_section += f"- Sleep issues: {bp['sleep_issues']}\n"
-                if bp.get('current_schedule'):
-                    context_section += f"- Current sleep schedule: {bp['current_schedule']}\n"
-                if bp.get('notes'):
-                    context_section += f"- Additional notes: {bp['notes']}\n"
-            context_section += "\n"
-        
-        if user_context.get('sleep_goals'):
-            sg = user_context['sleep_goals']
-            context_section += "Parent's Sleep Goals:\n"
-            goals = []
-            if sg.get('goal_1'):
-                goals.append(f"1. {sg['goal_1']}")
-            if sg.get('goal_2'):
-                goals.append(f"2. {sg['goal_2']}")
-            if sg.get('goal_3'):
-                goals.append(f"3. {sg['goal_3']}")
-            if sg.get('goal_4'):
-                goals.append(f"4. {sg['goal_4']}")
-            if sg.get('goal_5'):
-                goals.append(f"5. {sg['goal_5']}")
-            if goals:
-                context_section += "\n".join(goals) + "\n"
-            context_section += "\n"
-        
-        if context_section != "\n\n=== PARENT AND BABY INFORMATION ===\n":
-            sleep_specialist_prompt += context_section
-            sleep_specialist_prompt += "Use this information to provide personalized, tailored advice that addresses their specific baby and goals.\n\n"
+    if user_context_block:
+        context_prompt += user_context_block
     
+    # Relevant turns from the user's other conversations (history_retrieval)
+    if related_turns:
+        context_prompt += "\n\nRelevant excerpts from earlier conversations with this parent:\n"
+        for msg in related_turns:
+            role = "Parent" if msg['role'] == 'user' else "Sleep Specialist"
+            context_prompt += f"{role}: {msg['content']}\n"
+
     # Prepare conversation context
+    if conversation_summary:
+        context_prompt += f"\n\nSummary of earlier conversation:\n{conversation_summary}\n"
+
     if conversation_history:
-        # Format conversation history for Gemini
-        context = sleep_specialist_prompt + "\n\nPrevious conversation:\n"
-        for msg in conversation_history:
-            role = "Parent" if msg['role'] == 'user' else "Sleep Specialist"
-            context += f"{role}: {msg['content']}\n"
+        # Format conversation history for Gemini (lines are pre-rendered, see history_cache)
+        context = context_prompt + "\n\nPrevious conversation:\n" + format_transcript(conversation_history)
         context += f"Parent: {message}\n\nSleep Specialist:"
-        
-        if stream:
-            response = model.generate_content(context, stream=True)
-        else:
-            response = model.generate_content(context)
+        context = with_system_prompt(context)
     else:
-        full_prompt = sleep_specialist_prompt + f"\nParent's question: {message}\n\nSleep Specialist:"
-        if stream:
-            response = model.generate_content(full_prompt, stream=True)
-        else:
-            response = model.generate_content(full_prompt)
+        context = with_system_prompt(context_prompt + f"\nParent's question: {message}\n\nSleep Specialist:")
+    
+    if usage is not None:
+        usage.model = chat_model_name()
+        usage.prompt_tokens = estimate_tokens(context)
     
+    # Deadlines, retries and the circuit breaker are applied by llm_resilience
     if stream:
-        return response
-    return response.text
+        return generate_stream(model, context)
+    return generate_text(model, context)
+
+
+def extract_chunk_text(chunk):
+    """Extract text from a streamed Gemini chunk (None if it carries no text)"""
+    if hasattr(chunk, 'text'):
+        return chunk.text
+    if hasattr(chunk, 'candidates') and chunk.candidates:
+        if hasattr(chunk.candidates[0], 'content') and chunk.candidates[0].content:
+            if hasattr(chunk.candidates[0].content, 'parts') and chunk.candidates[0].content.parts:
+                if hasattr(chunk.candidates[0].content.parts[0], 'text'):
+                    return chunk.candidates[0].content.parts[0].text
+    return None
+
+def is_page_request():
+    """True when the client asked for a keyset-paginated response"""
+    return any(key in request.args for key in ('limit', 'before', 'after'))
+
+
+def parse_page_limit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid limit')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_conversation_cursor(conversation):
+    key = f"{conversation['activity_at']}|{conversation['id']}"
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_conversation_cursor(value):
+    """Decode a conversation cursor into its (activity_at, id) key"""
+    if not value:
+        return None
+    try:
+        activity_at, conversation_id = base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return activity_at, int(conversation_id)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def decode_message_cursor(value):
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
 
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    """Get all conversations"""
+    """Get conversations, most recent first (paginated with limit/before/after)"""
     session_token = request.headers.get('Authorization', '').replace('Bearer ', '')
     user = get_user_from_session_token(session_token)
     if not user:
         return jsonify({'error': 'Unauthorized'}), 401
     
     user_id = user['id']
-    conversations = Conversation.get_all(user_id=user_id)
+    paginated = is_page_request()
+    next_cursor = None
+    if paginated:
+        try:
+            limit = parse_page_limit()
+            before = decode_conversation_cursor(request.args.get('before'))
+            after = decode_conversation_cursor(request.args.get('after'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # One extra row tells whether another page follows
+        conversations = Conversation.get_page(user_id, limit + 1, before=before, after=after)
+        if len(conversations) > limit:
+            if after is not None:
+                conversations = conversations[1:]
+                next_cursor = encode_conversation_cursor(conversations[0])
+            else:
+                conversations = conversations[:limit]
+                next_cursor = encode_conversation_cursor(conversations[-1])
+    else:
+        conversations = Conversation.get_all(user_id=user_id)
     conversation_list = []
     for conv in conversations:
         conv_dict = dict(conv)
@@ -781,6 +413,9 @@ def get_conversations():
             'created_at': conv_dict.get('created_at'),
             'last_message_at': conv_dict.get('last_message_at')
         })
+    if paginated:
+        return jsonify({'conversations': conversation_list, 'next_cursor': next_cursor})
+    # Unpaginated requests keep the original plain-list response
     return jsonify(conversation_list)
 
 @app.route('/api/conversations', methods=['POST'])
@@ -813,12 +448,36 @@ def get_messages(conversation_id):
     if not record_user_id:
         Conversation.update_user(conversation_id, user_id)
     
-    messages = Message.get_by_conversation(conversation_id)
-    return jsonify([dict(msg) for msg in messages])
+    if not is_page_request():
+        messages = Message.get_by_conversation(conversation_id)
+        return jsonify([dict(msg) for msg in messages])
+
+    # Pages are oldest first; without a cursor the latest page is returned.
+    # next_cursor continues in the same direction (older for before, newer for after).
+    try:
+        limit = parse_page_limit()
+        before = decode_message_cursor(request.args.get('before'))
+        after = decode_message_cursor(request.args.get('after'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    next_cursor = None
+    if after is not None:
+        messages = Message.get_after(conversation_id, after, limit + 1)
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = messages[-1]['id']
+    else:
+        messages = Message.get_last(conversation_id, limit + 1, before_id=before)
+        if len(messages) > limit:
+            messages = messages[1:]
+            next_cursor = messages[0]['id']
+    return jsonify({'messages': [dict(msg) for msg in messages], 'next_cursor': next_cursor})
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """Send a message and get response (streaming)"""
+    permit = None
+    usage = None
     try:
         data = request.get_json() or {}
         message = data.get('message')
@@ -841,40 +500,35 @@ def chat():
         user = get_user_from_session_token(session_token)
         user_id = user['id'] if user else None
         
-        # Get user context (baby profile and sleep goals) if authenticated
-        user_context = None
-        if user_id:
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Get all baby profiles
-                cursor.execute('SELECT * FROM baby_profiles WHERE user_id = ? ORDER BY created_at ASC', (user_id,))
-                baby_profiles = cursor.fetchall()
-                
-                # Get sleep goals
-                cursor.execute('SELECT * FROM sleep_goals WHERE user_id = ?', (user_id,))
-                sleep_goals = cursor.fetchone()
-                
-                if baby_profiles or sleep_goals:
-                    user_context = {
-                        'baby_profiles': [dict(bp) for bp in baby_profiles] if baby_profiles else [],
-                        'sleep_goals': dict(sleep_goals) if sleep_goals else None
-                    }
-                conn.close()
-            except Exception as e:
-                safe_log('error', 'Error fetching user context')
-                # Continue without user context if there's an error
+        # Daily quotas, checked from in-memory usage totals
+        try:
+            check_quota(user_id)
+        except QuotaExceeded as e:
+            response = jsonify({'error': "You've reached today's limit for the sleep assistant. Please come back tomorrow.", 'reason': e.reason})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        
+        # Admission control in front of the LLM provider (per-user buckets, fair queue, bounded wait)
+        try:
+            with stage('admission'):
+                permit = admit_llm_call(f'user:{user_id}' if user_id else f'ip:{get_remote_address()}')
+        except AdmissionRejected as e:
+            response = jsonify({'error': 'The sleep assistant is busy right now. Please try again shortly.', 'reason': e.reason})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
         
         conversation_was_new = False
         conversation_title = None
         
-        if not conversation_id:
-            conversation = Conversation.create(user_id=user_id)
-            conversation_id = conversation.id
-            conversation_was_new = True
-        
-        conversation_record = Conversation.get_by_id(conversation_id) if conversation_id else None
+        with stage('conversation'):
+            if not conversation_id:
+                conversation = Conversation.create(user_id=user_id)
+                conversation_id = conversation.id
+                conversation_was_new = True
+            
+            conversation_record = Conversation.get_by_id(conversation_id) if conversation_id else None
         if conversation_record is None:
             return jsonify({'error': 'Conversation not found'}), 404
 
@@ -884,6 +538,13 @@ def chat():
         if user_id and record_user_id and record_user_id != user_id:
             return jsonify({'error': 'Conversation unavailable'}), 403
         
+        # The request is admitted and allowed: independent reads overlap the writes below
+        context_future = None
+        related_future = None
+        if user_id:
+            context_future = prefetch('user_context', get_user_context_block, user_id, user['profile_version'])
+            related_future = prefetch('related_turns', retrieve_related_turns, user_id, message, conversation_id)
+        
         if user_id and (not record_user_id):
             Conversation.update_user(conversation_id, user_id)
             conversation_record = Conversation.get_by_id(conversation_id)
@@ -896,82 +557,151 @@ def chat():
             role='user',
             content=message
         )
-        user_message.save()
+        with stage('save_message'):
+            user_message.save()
         
-        # Get conversation history
+        # Get recent conversation history (within the token budget) plus the rolling summary
         conversation_history = None
+        conversation_summary = None
+        unsummarized_count = 0
         if conversation_id:
-            messages = Message.get_by_conversation(conversation_id)
-            conversation_history = [dict(msg) for msg in messages[:-1]]  # Exclude the message we just added
+            with stage('history'):
+                conversation_summary, conversation_history, unsummarized_count = load_prompt_history(
+                    conversation_id, before_message_id=user_message.id, conversation=conversation_record
+                )
         
+        # New and default-titled conversations are titled after generation starts,
+        # so titling never delays the first streamed chunk
         current_title = conversation_record_dict.get('title')
         DEFAULT_AUTO_TITLES = {'Sleep Chat'}
-        if not current_title or (current_title.strip() in DEFAULT_AUTO_TITLES) or conversation_was_new:
-            existing_titles = Conversation.get_titles_for_user(user_id) if user_id else []
-            conversation_title = generate_conversation_title(message, existing_titles)
-            Conversation.update_title(conversation_id, conversation_title)
-        else:
-            conversation_title = current_title
+        title_pending = not current_title or (current_title.strip() in DEFAULT_AUTO_TITLES) or conversation_was_new
+        conversation_title = None if title_pending else current_title
+
+        # Join the prefetched inputs; either failing just leaves it out of the prompt
+        user_context_block = prefetched(context_future, error_message='Error fetching user context')
+        related_turns = prefetched(related_future, default=[], error_message='Error retrieving related turns')
+        observe('chat_prompt_ready_seconds', time.monotonic() - g.request_started)
+        
+        # Shared answers for common opening questions (opt-in, no personal context)
+        cacheable_turn = not related_turns and is_cacheable_turn(message, conversation_history, conversation_summary, user_context_block)
+        cached_response = get_cached_response(message) if cacheable_turn else None
+        usage = UsageRecord(user_id, conversation_id)
+        if cached_response is not None:
+            permit.release()  # No provider call needed
+            usage.cache_hit = True
 
-        if not conversation_title:
-            refreshed_record = Conversation.get_by_id(conversation_id)
-            if refreshed_record:
-                refreshed_dict = dict(refreshed_record)
-                conversation_title = refreshed_dict.get('title') or "Sleep Chat"
-            else:
-                conversation_title = "Sleep Chat"
-        
         if stream:
-            # Streaming response
-            def generate():
-                full_response = ""
+            # Streaming response: generation runs in a background producer that publishes
+            # numbered events; this response (and any reconnect) subscribes to them
+            chat_stream = create_stream(user_id=user_id, conversation_id=conversation_id)
+            request_started = g.request_started
+            # The producer owns the permit and usage record from here and settles them when generation ends
+            stream_permit, permit = permit, None
+            stream_usage, usage = usage, None
+
+            def produce():
+                title = conversation_title
+                reply = StreamedReply(conversation_id)
+                response_stream = None
+                finished = False
+                cancelled = False
+                chunk_count = 0
+                gauge_add('chat_streams_active', 1)
                 try:
-                    response_stream = get_gemini_response(message, conversation_history, user_context=user_context, stream=True)
+                    chat_stream.publish({'chunk': '', 'done': False, 'stream_id': chat_stream.id, 'conversation_id': conversation_id})
+                    if cached_response is not None:
+                        # Replay the cached answer with the same SSE framing as a live one
+                        chunk_texts = replay_chunks(cached_response)
+                    else:
+                        response_stream = get_gemini_response(
+                            message, conversation_history, user_context_block=user_context_block, stream=True,
+                            conversation_summary=conversation_summary, related_turns=related_turns, usage=stream_usage
+                        )
+                        chunk_texts = (extract_chunk_text(chunk) for chunk in response_stream)
+                    # Stop generating once every client has been gone past the reconnect grace period
+                    chat_stream.watch_abandonment(lambda: close_upstream(response_stream))
                     
-                    for chunk in response_stream:
-                        # Extract text from chunk - Gemini API structure
-                        chunk_text = None
-                        if hasattr(chunk, 'text'):
-                            chunk_text = chunk.text
-                        elif hasattr(chunk, 'candidates') and chunk.candidates:
-                            if hasattr(chunk.candidates[0], 'content') and chunk.candidates[0].content:
-                                if hasattr(chunk.candidates[0].content, 'parts') and chunk.candidates[0].content.parts:
-                                    if hasattr(chunk.candidates[0].content.parts[0], 'text'):
-                                        chunk_text = chunk.candidates[0].content.parts[0].text
-                        
-                        if chunk_text:
-                            full_response += chunk_text
-                            # Send chunk as SSE
-                            yield f"data: {json.dumps({'chunk': chunk_text, 'done': False})}\n\n"
+                    # Small provider chunks are coalesced into fewer, larger SSE frames
+                    for frame_text in coalesce_chunks(chunk_texts, chat_stream.cancelled):
+                        if chunk_count == 0:
+                            observe('chat_ttfb_seconds', time.monotonic() - request_started)
+                        chunk_count += 1
+                        reply.append(frame_text)
+                        chat_stream.publish({'chunk': frame_text, 'done': False})
+                        if title is None:
+                            title = assign_conversation_title(conversation_id, user_id, message)
+                        if chat_stream.cancelled.is_set():
+                            break
+                    
+                    if chat_stream.cancelled.is_set():
+                        cancelled = True
+                        generated_tokens = estimate_tokens(reply.text)
+                        increment('chat_cancelled_generations')
+                        # Estimate only: the reply length the provider would have produced is unknown
+                        increment('chat_cancelled_tokens_saved_estimate', max(0, int((average('chat_reply_tokens') or 0) - generated_tokens)))
+                        chat_stream.publish({'error': 'Generation cancelled', 'done': True, 'cancelled': True}, final=True)
+                        return
                     
                     # Save complete assistant response
-                    assistant_message = Message(
-                        conversation_id=conversation_id,
-                        role='assistant',
-                        content=full_response
-                    )
-                    assistant_message.save()
+                    full_response = reply.text
+                    reply.finalize()
+                    finished = True
+                    observe_value('chat_reply_tokens', estimate_tokens(full_response))
+                    schedule_summary_refresh(conversation_id, unsummarized_count)
+                    if cacheable_turn and cached_response is None:
+                        store_cached_response(message, full_response)
                     
                     # Send completion signal
-                    yield f"data: {json.dumps({'chunk': '', 'done': True, 'conversation_id': conversation_id, 'conversation_title': conversation_title})}\n\n"
+                    if title is None:
+                        title = assign_conversation_title(conversation_id, user_id, message)
+                    chat_stream.publish({'chunk': '', 'done': True, 'conversation_id': conversation_id, 'conversation_title': title}, final=True)
+                except PROVIDER_ERRORS:
+                    safe_log('warning', 'LLM provider unavailable during stream')
+                    chat_stream.publish({'error': PROVIDER_UNAVAILABLE_MESSAGE, 'done': True}, final=True)
                 except Exception as e:
-                    import traceback
-                    error_trace = traceback.format_exc()
                     safe_log('error', 'Streaming error occurred')
-                    yield f"data: {json.dumps({'error': str(e), 'done': True})}\n\n"
+                    chat_stream.publish({'error': str(e), 'done': True}, final=True)
+                finally:
+                    stream_permit.release()
+                    # Closing the upstream may surface as a provider error; it is still a cancellation
+                    cancelled = cancelled or (not finished and chat_stream.cancelled.is_set())
+                    record_usage(
+                        stream_usage, estimate_tokens(reply.text) if reply.text else 0,
+                        'complete' if finished else 'cancelled' if cancelled else 'partial' if reply.text else 'error'
+                    )
+                    # Keep whatever was generated if the client left or the provider failed
+                    if not finished and reply.text:
+                        try:
+                            reply.finalize(status='partial')
+                        except Exception:
+                            safe_log('error', 'Failed to save partial reply')
+                    if title is None:
+                        try:
+                            assign_conversation_title(conversation_id, user_id, message)
+                        except Exception:
+                            safe_log('error', 'Failed to title conversation')
+                    gauge_add('chat_streams_active', -1)
+                    increment('chat_turns')
+                    increment('chat_chunks', chunk_count)
+                    observe('chat_stream_seconds', time.monotonic() - request_started)
             
-            return Response(
-                stream_with_context(generate()),
-                mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'X-Accel-Buffering': 'no',
-                    'Connection': 'keep-alive'
-                }
-            )
+            threading.Thread(target=produce, name=f'chat-stream-{chat_stream.id[:8]}', daemon=True).start()
+            return sse_response(chat_stream.subscribe(), chat_stream.id)
+        elif cached_response is not None:
+            response_text = cached_response
         else:
             # Non-streaming response (backward compatibility)
-            response_text = get_gemini_response(message, conversation_history, user_context=user_context, stream=False)
+            response_text = get_gemini_response(
+                message, conversation_history, user_context_block=user_context_block, stream=False,
+                conversation_summary=conversation_summary, related_turns=related_turns, usage=usage
+            )
+            permit.release()
+            if cacheable_turn:
+                store_cached_response(message, response_text)
+        
+        record_usage(usage, estimate_tokens(response_text))
+        if title_pending:
+            conversation_title = assign_conversation_title(conversation_id, user_id, message)
         
         # Save assistant response
         assistant_message = Message(
@@ -980,6 +710,7 @@ def chat():
             content=response_text
         )
         assistant_message.save()
+        schedule_summary_refresh(conversation_id, unsummarized_count)
         
         return jsonify({
             'response': response_text,
@@ -989,8 +720,51 @@ def chat():
         
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
+    except PROVIDER_ERRORS:
+        return jsonify({'error': PROVIDER_UNAVAILABLE_MESSAGE}), 503
     except Exception as e:
         return handle_error(e, 'Failed to get response from AI. Please try again.', 500)
+    finally:
+        if permit is not None:
+            permit.release()
+        # No-op if the turn was already recorded
+        record_usage(usage, status='error')
+
+def sse_response(events, stream_id):
+    """Wrap an SSE event generator in a streaming response"""
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'Connection': 'keep-alive',
+            'X-Stream-Id': stream_id
+        }
+    )
+
+@app.route('/api/chat/stream/<stream_id>', methods=['GET'])
+def resume_chat_stream(stream_id):
+    """Reconnect to an in-flight (or recently finished) chat stream after Last-Event-ID"""
+    chat_stream = get_stream(stream_id)
+    if chat_stream is None:
+        return jsonify({'error': 'Stream not found. Reload the conversation to see the saved reply.'}), 404
+
+    if chat_stream.user_id:
+        session_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        user = get_user_from_session_token(session_token)
+        if not user or user['id'] != chat_stream.user_id:
+            return jsonify({'error': 'Stream not found. Reload the conversation to see the saved reply.'}), 404
+
+    last_event_id = parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    )
+    try:
+        chat_stream.events_after(last_event_id)
+    except StreamGone:
+        return jsonify({'error': 'Stream is too far behind to resume. Reload the conversation.'}), 410
+
+    return sse_response(chat_stream.subscribe(last_event_id), chat_stream.id)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -998,10 +772,21 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'api_key_configured': bool(gemini_api_key),
+        'llm_provider': LLM_PROVIDER,
         'service': 'Baby Sleep Helper',
         'specialization': 'Gentle sleep training and no-cry sleep solutions'
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Per-process request/chat/DB metrics (enabled by setting METRICS_TOKEN)"""
+    metrics_token = os.getenv('METRICS_TOKEN')
+    if not metrics_token:
+        return jsonify({'error': 'Not found'}), 404
+    if not secrets.compare_digest(request.headers.get('X-Metrics-Token', ''), metrics_token):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'pid': os.getpid(), **metrics_snapshot()})
+
 # -------- Sleep Progress (from chat history) --------
 def _parse_time_from_text(text, reference_dt):
     """
@@ -1284,7 +1069,7 @@ def get_sleep_progress():
         cursor = conn.cursor()
         # Fetch messages across all conversations owned by the user
         cursor.execute('''
-            SELECT m.id, m.role, m.content, m.timestamp
+            SELECT m.id, m.role, message_text(m.content, m.codec) AS content, m.timestamp
             FROM messages m
             JOIN conversations c ON m.conversation_id = c.id
             WHERE c.user_id = ?
@@ -3365,6 +3150,9 @@ def debug_friendships(username):
         return jsonify({'error': f'Failed to debug: {str(e)}'}), 500
 
 # Authentication endpoints
+RANDOM_USERNAME_BATCH_SIZE = 25
+
+
 def generate_random_username():
     """Generate a random username"""
     import random
@@ -3373,6 +3161,41 @@ def generate_random_username():
     number = secrets.randbelow(1000)
     return f"{random.choice(adjectives)}_{random.choice(nouns)}_{number}"
 
+
+def generate_random_usernames(count=RANDOM_USERNAME_BATCH_SIZE):
+    """Generate a batch of random username candidates"""
+    return [generate_random_username() for _ in range(count)]
+
+
+@app.route('/api/auth/availability', methods=['GET'])
+@limiter.limit("60 per minute")
+def check_availability():
+    """
+    Live username availability check for signup form validation.
+    Emails are not checked here: at this rate limit that would allow bulk
+    account enumeration, so duplicates are only reported by signup itself.
+    """
+    from database import get_db_connection
+    try:
+        username = (request.args.get('username') or '').strip()
+
+        if not username:
+            return jsonify({'error': 'Username is required'}), 400
+
+        result = {}
+        username_valid, username_error = validate_username(username)
+        if not username_valid:
+            result['username'] = {'available': False, 'error': username_error}
+        else:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            result['username'] = {'available': is_username_available(cursor, username)}
+            conn.close()
+
+        return jsonify(result)
+    except Exception as e:
+        return handle_error(e, 'Failed to check availability. Please try again.', 500)
+
 @app.route('/api/auth/signup', methods=['POST'])
 @limiter.limit("3 per hour")
 def signup():
@@ -3419,8 +3242,7 @@ def signup():
             # If a username was provided and matches the random pattern, try to use it first
             if username and username.strip() and re.match(r'^[a-z]+_[a-z]+_\d+$', username.strip()):
                 # Check if the provided username is available
-                cursor.execute('SELECT * FROM auth_users WHERE username = ?', (username.strip(),))
-                if not cursor.fetchone():
+                if not username_exists(cursor, username.strip()):
                     # Use the provided username
                     username = username.strip()
                 else:
@@ -3430,13 +3252,12 @@ def signup():
                 # No valid username provided, generate a new one
                 username = None
             
-            # If we still need to generate a username
+            # If we still need to generate a username, test a batch of candidates at once
             if not username:
-                max_attempts = 10
+                max_attempts = 3
                 for _ in range(max_attempts):
-                    username = generate_random_username()
-                    cursor.execute('SELECT * FROM auth_users WHERE username = ?', (username,))
-                    if not cursor.fetchone():
+                    username = pick_available_username(cursor, generate_random_usernames())
+                    if username:
                         break
                 else:
                     conn.close()
@@ -3452,16 +3273,12 @@ def signup():
                 return jsonify({'error': username_error}), 400
             
             # Check if username already exists
-            cursor.execute('SELECT * FROM auth_users WHERE username = ?', (username,))
-            existing = cursor.fetchone()
-            if existing:
+            if username_exists(cursor, username):
                 conn.close()
                 return jsonify({'error': 'Username already exists. Please choose a different username.'}), 400
         
         # Check if email already exists
-        cursor.execute('SELECT * FROM auth_users WHERE email = ?', (email,))
-        existing_email = cursor.fetchone()
-        if existing_email:
+        if email_exists(cursor, email):
             conn.close()
             return jsonify({'error': 'Email already registered. Please use a different email or login.'}), 400
         
@@ -3580,20 +3397,18 @@ def signup():
                     VALUES (?, ?, ?, ?, ?, ?)
                 ''', (user_id, goal_1, goal_2, goal_3, goal_4, goal_5))
         
+        # Queue verification email in the same transaction (delivered by the outbox worker)
+        enqueue_email(cursor, 'verification', email, first_name=first_name, verification_token=verification_token)
+        
         conn.commit()
+        mark_username_taken(username)
+        notify_outbox()
         
         # Get first_name from user_data before closing connection
         user_first_name = user_data['first_name'] if user_data else first_name
         
         conn.close()
         
-        # Send verification email (non-blocking - don't fail signup if email fails)
-        try:
-            send_verification_email(email, first_name, verification_token)
-        except Exception as email_error:
-            print(f"Failed to send verification email: {str(email_error)}")
-            # Continue with signup even if email fails
-        
         return jsonify({
             'message': 'Account created successfully. Please check your email to verify your account.',
             'session_token': session_token,
@@ -3759,20 +3574,25 @@ def get_user_profile(username):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Get public profile info
-        cursor.execute('''
-            SELECT username, profile_picture, bio
-            FROM auth_users
-            WHERE username = ?
-        ''', (username,))
+        # Resolve user and profile version; the public profile itself is cached per version
+        cursor.execute('SELECT id, profile_version FROM auth_users WHERE username = ?', (username,))
         user = cursor.fetchone()
         
         if not user:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
+        def load_public_profile():
+            cursor.execute('''
+                SELECT username, profile_picture, bio
+                FROM auth_users
+                WHERE id = ?
+            ''', (user['id'],))
+            return dict(cursor.fetchone())
+        
+        response = cached_json_response('public-profile', user['id'], user['profile_version'], load_public_profile)
         conn.close()
-        return jsonify(dict(user))
+        return response
     except Exception as e:
         return jsonify({'error': f'Failed to get profile: {str(e)}'}), 500
 
@@ -3791,7 +3611,7 @@ def get_profile():
         
         # Find user from session
         cursor.execute('''
-            SELECT u.id, u.username, u.first_name, u.last_name, u.email, u.profile_picture, u.bio
+            SELECT u.id, u.profile_version
             FROM sessions s
             JOIN auth_users u ON s.user_id = u.id
             WHERE s.session_token = ? AND s.expires_at > CURRENT_TIMESTAMP
@@ -3802,8 +3622,17 @@ def get_profile():
             conn.close()
             return jsonify({'error': 'Invalid session'}), 401
         
+        def load_profile():
+            cursor.execute('''
+                SELECT id, username, first_name, last_name, email, profile_picture, bio
+                FROM auth_users
+                WHERE id = ?
+            ''', (user['id'],))
+            return dict(cursor.fetchone())
+        
+        response = cached_json_response('profile', user['id'], user['profile_version'], load_profile)
         conn.close()
-        return jsonify(dict(user))
+        return response
     except Exception as e:
         return jsonify({'error': f'Failed to get profile: {str(e)}'}), 500
 
@@ -3865,9 +3694,7 @@ def update_profile():
                 return jsonify({'error': 'Username must be at least 3 characters'}), 400
             
             # Check if username already exists
-            cursor.execute('SELECT * FROM auth_users WHERE username = ? AND id != ?', (username, user_id))
-            existing = cursor.fetchone()
-            if existing:
+            if username_exists(cursor, username, exclude_user_id=user_id):
                 conn.close()
                 return jsonify({'error': 'Username already exists. Please choose a different username.'}), 400
         
@@ -3879,15 +3706,14 @@ def update_profile():
             if current_email_row:
                 current_email = current_email_row['email']
                 if email != current_email:
-                    cursor.execute('SELECT * FROM auth_users WHERE email = ? AND id != ?', (email, user_id))
-                    existing = cursor.fetchone()
-                    if existing:
+                    if email_exists(cursor, email, exclude_user_id=user_id):
                         conn.close()
                         return jsonify({'error': 'Email already registered. Please use a different email.'}), 400
         
         # Update profile - always update all fields that are provided in the request
         updates = []
         values = []
+        rename_job_id = None
         
         # Always update these fields if they're in the request (even if empty)
         # The frontend always sends all fields, so we update all of them
@@ -3925,11 +3751,12 @@ def update_profile():
                 SET {', '.join(updates)}
                 WHERE id = ?
             ''', values)
+            bump_profile_version(cursor, user_id)
             
             # If username changed, update forum_users table too
             if username and username != current_username:
                 cursor.execute('''
-                    UPDATE forum_users 
+                    UPDATE forum_users
                     SET username = ?, display_name = ?
                     WHERE username = ?
                 ''', (
@@ -3939,8 +3766,13 @@ def update_profile():
                     else username,
                     current_username
                 ))
+                # Posts, DMs, friendships, etc. are moved to the new name in the background
+                rename_job_id = enqueue_rename(cursor, user_id, current_username, username)
             
             conn.commit()
+            if username and username != current_username:
+                mark_username_taken(username)
+                notify_jobs()
         
         # Get updated user
         cursor.execute('''
@@ -3951,7 +3783,10 @@ def update_profile():
         user = cursor.fetchone()
         
         conn.close()
-        return jsonify(dict(user))
+        response = dict(user)
+        if rename_job_id:
+            response['rename_job_id'] = rename_job_id
+        return jsonify(response)
     except Exception as e:
         return jsonify({'error': f'Failed to update profile: {str(e)}'}), 500
 
@@ -3982,10 +3817,12 @@ def deactivate_account():
             return jsonify({'error': 'Invalid session'}), 401
         
         user_id = session['id']
+        data = request.get_json(silent=True) or {}
+        purge_data = bool(data.get('purge_data'))
         
         # Deactivate account
         cursor.execute('''
-            UPDATE auth_users 
+            UPDATE auth_users
             SET is_active = 0, deactivated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (user_id,))
@@ -3993,13 +3830,54 @@ def deactivate_account():
         # Delete all sessions for this user
         cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
         
+        # Optionally remove the user's data from every table in the background
+        purge_job_id = enqueue_purge(cursor, user_id, session['username']) if purge_data else None
+        
         conn.commit()
         conn.close()
         
+        if purge_job_id:
+            notify_jobs()
+            return jsonify({'message': 'Account deactivated successfully', 'purge_job_id': purge_job_id})
         return jsonify({'message': 'Account deactivated successfully'})
     except Exception as e:
         return jsonify({'error': f'Failed to deactivate account: {str(e)}'}), 500
 
+@app.route('/api/auth/jobs/<int:job_id>', methods=['GET'])
+def get_account_job(job_id):
+    """Get progress of a background account job (username change or data purge)"""
+    try:
+        session_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        user = get_user_from_session_token(session_token)
+        if not user:
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        job = get_job(job_id)
+        if not job or job['user_id'] != user['id']:
+            return jsonify({'error': 'Job not found'}), 404
+
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({'error': f'Failed to get job: {str(e)}'}), 500
+
+@app.route('/api/auth/usage', methods=['GET'])
+def get_llm_usage():
+    """Get the current user's sleep assistant usage and daily quota"""
+    try:
+        session_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        user = get_user_from_session_token(session_token)
+        if not user:
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        turns, tokens = get_today_usage(user['id'])
+        return jsonify({
+            'today': {'turns': turns, 'tokens': tokens},
+            'quota': {'turns': LLM_DAILY_TURN_QUOTA or None, 'tokens': LLM_DAILY_TOKEN_QUOTA or None},
+            'days': get_daily_usage(user['id'])
+        })
+    except Exception as e:
+        return jsonify({'error': f'Failed to get usage: {str(e)}'}), 500
+
 @app.route('/api/auth/profile-picture', methods=['POST'])
 def upload_profile_picture():
     """Upload profile picture"""
@@ -4048,6 +3926,7 @@ def upload_profile_picture():
                 SET profile_picture = ?
                 WHERE id = ?
             ''', (unique_filename, session['id']))
+            bump_profile_version(cursor, session['id'])
             
             conn.commit()
             conn.close()
@@ -4078,7 +3957,7 @@ def get_baby_profiles():
         
         # Find user from session
         cursor.execute('''
-            SELECT u.id
+            SELECT u.id, u.profile_version
             FROM sessions s
             JOIN auth_users u ON s.user_id = u.id
             WHERE s.session_token = ? AND s.expires_at > CURRENT_TIMESTAMP
@@ -4091,20 +3970,17 @@ def get_baby_profiles():
         
         user_id = session['id']
         
-        # Get all baby profiles
-        cursor.execute('''
-            SELECT * FROM baby_profiles
-            WHERE user_id = ?
-            ORDER BY created_at ASC
-        ''', (user_id,))
-        baby_profiles = cursor.fetchall()
+        def load_baby_profiles():
+            cursor.execute('''
+                SELECT * FROM baby_profiles
+                WHERE user_id = ?
+                ORDER BY created_at ASC
+            ''', (user_id,))
+            return [dict(bp) for bp in cursor.fetchall()]  # Empty list if no baby profiles yet
         
+        response = cached_json_response('baby-profiles', user_id, session['profile_version'], load_baby_profiles)
         conn.close()
-        
-        if baby_profiles:
-            return jsonify([dict(bp) for bp in baby_profiles])
-        else:
-            return jsonify([])  # No baby profiles yet
+        return response
     except Exception as e:
         return jsonify({'error': f'Failed to get baby profiles: {str(e)}'}), 500
 
@@ -4174,6 +4050,7 @@ def create_baby_profile():
         ''', (user_id, name, birth_date, age_months, sleep_issues, current_schedule, notes))
 
         baby_id = cursor.lastrowid
+        bump_profile_version(cursor, user_id)
         conn.commit()
         
         # Get created profile
@@ -4259,6 +4136,7 @@ def update_baby_profile(baby_id):
                 current_schedule = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ? AND user_id = ?
         ''', (name, birth_date, age_months, sleep_issues, current_schedule, notes, baby_id, user_id))
+        bump_profile_version(cursor, user_id)
         
         conn.commit()
         
@@ -4309,6 +4187,7 @@ def delete_baby_profile(baby_id):
         
         # Delete profile
         cursor.execute('DELETE FROM baby_profiles WHERE id = ? AND user_id = ?', (baby_id, user_id))
+        bump_profile_version(cursor, user_id)
         
         conn.commit()
         conn.close()
@@ -4332,7 +4211,7 @@ def get_sleep_goals():
         
         # Find user from session
         cursor.execute('''
-            SELECT u.id
+            SELECT u.id, u.profile_version
             FROM sessions s
             JOIN auth_users u ON s.user_id = u.id
             WHERE s.session_token = ? AND s.expires_at > CURRENT_TIMESTAMP
@@ -4345,19 +4224,17 @@ def get_sleep_goals():
         
         user_id = session['id']
         
-        # Get sleep goals
-        cursor.execute('''
-            SELECT * FROM sleep_goals
-            WHERE user_id = ?
-        ''', (user_id,))
-        sleep_goals = cursor.fetchone()
+        def load_sleep_goals():
+            cursor.execute('''
+                SELECT * FROM sleep_goals
+                WHERE user_id = ?
+            ''', (user_id,))
+            sleep_goals = cursor.fetchone()
+            return dict(sleep_goals) if sleep_goals else None  # No sleep goals yet
         
+        response = cached_json_response('sleep-goals', user_id, session['profile_version'], load_sleep_goals)
         conn.close()
-        
-        if sleep_goals:
-            return jsonify(dict(sleep_goals))
-        else:
-            return jsonify(None)  # No sleep goals yet
+        return response
     except Exception as e:
         return jsonify({'error': f'Failed to get sleep goals: {str(e)}'}), 500
 
@@ -4413,6 +4290,7 @@ def update_sleep_goals():
                 INSERT INTO sleep_goals (user_id, goal_1, goal_2, goal_3, goal_4, goal_5)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (user_id, goal_1, goal_2, goal_3, goal_4, goal_5))
+        bump_profile_version(cursor, user_id)
         
         conn.commit()
         
@@ -4504,16 +4382,12 @@ def forgot_password():
             WHERE id = ?
         ''', (reset_token, expires_at, user['id']))
         
+        # Queue password reset email in the same transaction (delivered by the outbox worker)
+        enqueue_email(cursor, 'password_reset', email, first_name=user['first_name'] or 'User', reset_token=reset_token)
+        
         conn.commit()
         conn.close()
-        
-        # Send password reset email
-        try:
-            user_first_name = user.get('first_name', 'User')
-            send_password_reset_email(email, user_first_name, reset_token)
-        except Exception as email_error:
-            print(f"Failed to send password reset email: {str(email_error)}")
-            # Continue even if email fails (don't reveal if email exists)
+        notify_outbox()
         
         return jsonify({
             'message': 'If an account with that email exists, a password reset link has been sent.'
@@ -0,0 +1,251 @@
+"""
+Background job framework for long-running data rewrites.
+
+Jobs are rows in `background_jobs`. A runner thread in each process claims one
+job at a time with a lease and executes it as a sequence of bounded batches.
+Each batch runs in its own short transaction together with the job's progress
+update, so SQLite's writer lock is only held for one batch at a time and a job
+interrupted by a restart resumes from its last committed batch.
+
+Handlers are registered per job kind with `register_job` and are called as
+`handler(cursor, payload, state)`; they return `(state, rows_processed, done)`.
+Maintenance jobs can also be made periodic with `register_periodic_job`: the
+runners queue a new run once the previous one is older than its interval.
+
+Kinds registered with a `queue` other than 'default' are claimed only by that
+queue's runners (JOB_QUEUE_CONCURRENCY threads per process). Slow jobs such as
+LLM summaries run on the 'llm' queue, so they cannot hold up account cascades
+and maintenance jobs on the default runner, and at most LLM_JOB_CONCURRENCY
+of them run at once in each process.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from database import get_db_connection
+from security_utils import safe_log
+
+JOB_POLL_SECONDS = 10
+JOB_LEASE_SECONDS = 120
+JOB_BATCH_PAUSE_SECONDS = 0.05
+JOB_MAX_ATTEMPTS = 5
+PERIODIC_CHECK_SECONDS = 60
+# Runner threads per process for each queue
+JOB_QUEUE_CONCURRENCY = {
+    'default': 1,
+    'llm': int(os.getenv('LLM_JOB_CONCURRENCY', '1')),
+}
+
+JOB_HANDLERS = {}
+JOB_QUEUES = {}  # kind -> queue, for kinds outside the default queue
+PERIODIC_JOBS = {}  # kind -> (interval_seconds, payload)
+
+
+def register_job(kind, queue='default'):
+    """Decorator registering a batch handler for a job kind, run by the given queue's runners"""
+    if queue not in JOB_QUEUE_CONCURRENCY:
+        raise ValueError(f'Unknown job queue: {queue}')
+
+    def decorator(handler):
+        JOB_HANDLERS[kind] = handler
+        if queue != 'default':
+            JOB_QUEUES[kind] = queue
+        return handler
+    return decorator
+
+
+def register_periodic_job(kind, interval_seconds, payload=None):
+    """Run a registered job kind every interval_seconds (across all processes)"""
+    PERIODIC_JOBS[kind] = (interval_seconds, payload or {})
+
+
+def enqueue_due_periodic_jobs():
+    """Queue each periodic job that is not queued and has not run within its interval"""
+    if not PERIODIC_JOBS:
+        return
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # Serialize with other processes so each run is queued only once
+        cursor.execute('BEGIN IMMEDIATE')
+        for kind, (interval_seconds, payload) in PERIODIC_JOBS.items():
+            cursor.execute('''
+                SELECT 1 FROM background_jobs
+                WHERE kind = ? AND (status IN ('pending', 'running') OR created_at > datetime('now', ?))
+                LIMIT 1
+            ''', (kind, f'-{int(interval_seconds)} seconds'))
+            if cursor.fetchone() is None:
+                enqueue_job(cursor, kind, payload)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def enqueue_job(cursor, kind, payload, user_id=None):
+    """Queue a job using the caller's cursor so it commits with the caller's transaction"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    cursor.execute('''
+        INSERT INTO background_jobs (kind, payload, user_id)
+        VALUES (?, ?, ?)
+    ''', (kind, json.dumps(payload), user_id))
+    return cursor.lastrowid
+
+
+def get_job(job_id):
+    """Return a job's status and progress as a dict, or None"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, kind, user_id, status, state, processed_rows, attempts, last_error,
+               created_at, updated_at, finished_at
+        FROM background_jobs
+        WHERE id = ?
+    ''', (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    if not job:
+        return None
+    job = dict(job)
+    job['progress'] = json.loads(job.pop('state') or '{}')
+    return job
+
+
+def _claim_job(conn, claim_token, queue='default'):
+    # The default queue takes every kind not routed elsewhere (including unknown kinds, which then fail)
+    if queue == 'default':
+        kinds = list(JOB_QUEUES)
+        kind_filter = 'kind NOT IN'
+    else:
+        kinds = [kind for kind, kind_queue in JOB_QUEUES.items() if kind_queue == queue]
+        kind_filter = 'kind IN'
+    placeholders = ','.join('?' * len(kinds))
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        UPDATE background_jobs
+        SET status = 'running', claim_token = ?, claimed_until = datetime('now', ?),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id FROM background_jobs
+            WHERE ((status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                   OR (status = 'running' AND claimed_until <= CURRENT_TIMESTAMP))
+              AND {kind_filter} ({placeholders})
+            ORDER BY id
+            LIMIT 1
+        )
+    ''', (claim_token, f'+{JOB_LEASE_SECONDS} seconds', *kinds))
+    conn.commit()
+    cursor.execute('SELECT * FROM background_jobs WHERE claim_token = ?', (claim_token,))
+    return cursor.fetchone()
+
+
+def _run_job(conn, job, claim_token):
+    handler = JOB_HANDLERS.get(job['kind'])
+    if handler is None:
+        raise ValueError(f"No handler registered for job kind {job['kind']}")
+    payload = json.loads(job['payload'] or '{}')
+    state = json.loads(job['state'] or '{}')
+    cursor = conn.cursor()
+
+    while True:
+        state, rows, done = handler(cursor, payload, state)
+        cursor.execute('''
+            UPDATE background_jobs
+            SET state = ?, processed_rows = processed_rows + ?, status = ?,
+                claimed_until = datetime('now', ?), updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE finished_at END,
+                claim_token = CASE WHEN ? THEN NULL ELSE claim_token END
+            WHERE id = ? AND claim_token = ?
+        ''', (
+            json.dumps(state), rows, 'done' if done else 'running',
+            f'+{JOB_LEASE_SECONDS} seconds', 1 if done else 0, 1 if done else 0,
+            job['id'], claim_token
+        ))
+        if cursor.rowcount == 0:
+            # Lease was lost to another worker; discard this batch
+            conn.rollback()
+            return
+        conn.commit()
+        if done:
+            return
+        time.sleep(JOB_BATCH_PAUSE_SECONDS)
+
+
+def run_pending_jobs_once(queue='default'):
+    """Claim and run one job from the queue to completion. Returns False when nothing was due."""
+    conn = get_db_connection()
+    claim_token = uuid.uuid4().hex
+    try:
+        job = _claim_job(conn, claim_token, queue)
+        if job is None:
+            return False
+        try:
+            _run_job(conn, job, claim_token)
+        except Exception as e:
+            conn.rollback()
+            attempts = job['attempts'] + 1
+            failed = attempts >= JOB_MAX_ATTEMPTS
+            delay = int(min(3600, 30 * (2 ** (attempts - 1))) * random.uniform(0.75, 1.25))
+            conn.execute('''
+                UPDATE background_jobs
+                SET status = ?, attempts = ?, last_error = ?, claim_token = NULL,
+                    next_attempt_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND claim_token = ?
+            ''', ('failed' if failed else 'pending', attempts, f'{type(e).__name__}: {e}'[:500],
+                  f'+{delay} seconds', job['id'], claim_token))
+            conn.commit()
+            safe_log('error', f"Background job {job['id']} ({job['kind']}) failed on attempt {attempts}")
+        return True
+    finally:
+        conn.close()
+
+
+class JobRunner(threading.Thread):
+    """Background thread that runs queued jobs of one queue"""
+
+    def __init__(self, queue='default', index=0):
+        super().__init__(name=f'background-jobs-{queue}-{index}', daemon=True)
+        self.queue = queue
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        last_periodic_check = 0
+        while True:
+            try:
+                if self.queue == 'default' and time.monotonic() - last_periodic_check >= PERIODIC_CHECK_SECONDS:
+                    last_periodic_check = time.monotonic()
+                    enqueue_due_periodic_jobs()
+                while run_pending_jobs_once(self.queue):
+                    pass
+            except Exception:
+                safe_log('error', 'Background job runner error')
+            self._wake.wait(JOB_POLL_SECONDS)
+            self._wake.clear()
+
+
+_runners = []
+_runner_lock = threading.Lock()
+
+
+def start_job_runner():
+    """Start this process's job runners, JOB_QUEUE_CONCURRENCY per queue (idempotent)"""
+    with _runner_lock:
+        if not _runners:
+            for queue, concurrency in JOB_QUEUE_CONCURRENCY.items():
+                for index in range(max(1, concurrency)):
+                    runner = JobRunner(queue, index)
+                    runner.start()
+                    _runners.append(runner)
+    return _runners
+
+
+def notify_jobs():
+    """Wake the local runners after committing newly queued jobs"""
+    for runner in _runners:
+        runner.wake()
@@ -0,0 +1,163 @@
+"""
+Load-test harness for streaming /api/chat.
+
+Start the server against the mock provider, e.g.
+
+    LLM_PROVIDER=mock LLM_USER_BURST=100000 METRICS_TOKEN=bench \\
+        gunicorn 'bench_chat:bench_app()' --bind 127.0.0.1:5001 --workers 2
+
+then run
+
+    python bench_chat.py --url http://127.0.0.1:5001 --concurrency 20 --turns 200 --metrics-token bench
+
+`bench_app()` is the regular app with Flask-Limiter switched off, so the
+simulated clients (all from one address) are not throttled; the large
+LLM_USER_BURST does the same for LLM admission.
+
+Each simulated client opens a streaming chat and reads it to completion. The
+report covers time-to-first-chunk, chunks/s, stream duration and errors from
+the client's side, plus peak in-flight requests and DB commits per turn from
+/api/metrics. Server metrics are per worker process, so with several workers
+the server-side numbers cover whichever worker answered the metrics request.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def bench_app():
+    """WSGI entry point for load tests: the production app without request rate limits"""
+    from app import app, limiter
+    limiter.enabled = False
+    return app
+
+
+def fetch_metrics(base_url, token):
+    if not token:
+        return None
+    req = urllib.request.Request(f'{base_url}/api/metrics', headers={'X-Metrics-Token': token})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def run_turn(base_url, message, conversation_id=None):
+    body = {'message': message, 'stream': True}
+    if conversation_id:
+        body['conversation_id'] = conversation_id
+    req = urllib.request.Request(
+        f'{base_url}/api/chat',
+        data=json.dumps(body).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    started = time.monotonic()
+    first_chunk_at = None
+    chunks = 0
+    result = {'error': None, 'conversation_id': conversation_id}
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            for raw_line in resp:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                event = json.loads(line[5:])
+                if event.get('error'):
+                    result['error'] = event['error']
+                    break
+                if event.get('chunk'):
+                    chunks += 1
+                    if first_chunk_at is None:
+                        first_chunk_at = time.monotonic()
+                if event.get('done'):
+                    result['conversation_id'] = event.get('conversation_id')
+                    break
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finished = time.monotonic()
+    result.update({
+        'ttfb': (first_chunk_at - started) if first_chunk_at else None,
+        'duration': finished - started,
+        'chunks': chunks,
+    })
+    return result
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive concurrent streaming chats against the API')
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--turns-per-conversation', type=int, default=3)
+    parser.add_argument('--message', default='My 7 month old wakes up every two hours at night. What can I try?')
+    parser.add_argument('--metrics-token', default=None)
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    before = fetch_metrics(base_url, args.metrics_token)
+
+    lock = threading.Lock()
+    turn_counter = iter(range(args.turns))
+    results = []
+
+    def client():
+        conversation_id = None
+        turns_in_conversation = 0
+        while True:
+            with lock:
+                if next(turn_counter, None) is None:
+                    return
+            if turns_in_conversation >= args.turns_per_conversation:
+                conversation_id = None
+                turns_in_conversation = 0
+            result = run_turn(base_url, args.message, conversation_id)
+            conversation_id = result['conversation_id']
+            turns_in_conversation += 1
+            with lock:
+                results.append(result)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for _ in range(args.concurrency):
+            pool.submit(client)
+    elapsed = time.monotonic() - started
+
+    after = fetch_metrics(base_url, args.metrics_token)
+    ok = [r for r in results if not r['error']]
+    ttfbs = [r['ttfb'] for r in ok if r['ttfb'] is not None]
+    durations = [r['duration'] for r in ok]
+    total_chunks = sum(r['chunks'] for r in ok)
+
+    print(f'turns: {len(results)} ok, errors: {len(results) - len(ok)}, concurrency: {args.concurrency}')
+    print(f'wall time: {elapsed:.2f}s, throughput: {len(ok) / elapsed:.2f} turns/s, {total_chunks / elapsed:.1f} chunks/s')
+    if ttfbs:
+        print(f'time to first chunk: p50 {_percentile(ttfbs, 0.5) * 1000:.0f}ms, '
+              f'p95 {_percentile(ttfbs, 0.95) * 1000:.0f}ms, max {max(ttfbs) * 1000:.0f}ms')
+    if durations:
+        print(f'stream duration: p50 {_percentile(durations, 0.5):.2f}s, p95 {_percentile(durations, 0.95):.2f}s, '
+              f'mean {statistics.mean(durations):.2f}s')
+    errors = {r['error'] for r in results if r['error']}
+    for error in list(errors)[:5]:
+        print(f'error: {error}')
+
+    if before and after:
+        commits = after['counters'].get('db_commits', 0) - before['counters'].get('db_commits', 0)
+        turns = after['counters'].get('chat_turns', 0) - before['counters'].get('chat_turns', 0)
+        in_flight = after['gauges'].get('requests_in_flight', {})
+        print(f"server (pid {after['pid']}): {turns} turns, "
+              f"{(commits / turns) if turns else float('nan'):.1f} DB commits/turn, "
+              f"peak in-flight requests {in_flight.get('peak', 0)}")
+
+
+if __name__ == '__main__':
+    main()
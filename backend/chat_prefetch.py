@@ -0,0 +1,57 @@
+"""
+Concurrent preparation of a chat turn's prompt inputs.
+
+Loading the user's prompt context block and retrieving related turns from
+earlier conversations do not depend on the conversation bookkeeping (creating
+or checking the conversation, saving the user message, loading its history).
+`chat()` starts them on a small shared pool once the request has been admitted
+and the conversation's ownership confirmed, so rejected or forbidden requests
+never spend pool or database time on them. They run while the request saves
+the user message and loads history, and are joined just before the prompt is
+built. The prefetch
+stages read through read-only connections (database.get_read_connection).
+
+Every stage's duration is recorded as a `chat_stage_<name>_seconds` timing,
+together with `chat_prompt_ready_seconds` (request start to prompt inputs ready).
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from metrics import observe
+from security_utils import safe_log
+
+CHAT_PREFETCH_WORKERS = int(os.getenv('CHAT_PREFETCH_WORKERS', '4'))
+
+_executor = ThreadPoolExecutor(max_workers=CHAT_PREFETCH_WORKERS, thread_name_prefix='chat-prefetch')
+
+
+@contextmanager
+def stage(name):
+    """Time a block of chat preparation as stage `name`"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(f'chat_stage_{name}_seconds', time.monotonic() - started)
+
+
+def prefetch(name, fn, *args, **kwargs):
+    """Run fn on the prefetch pool as a timed stage; returns a Future"""
+    def run():
+        with stage(name):
+            return fn(*args, **kwargs)
+    return _executor.submit(run)
+
+
+def prefetched(future, default=None, error_message=None):
+    """Result of a prefetch stage, or default (logging error_message) if it failed"""
+    if future is None:
+        return default
+    try:
+        return future.result()
+    except Exception:
+        if error_message:
+            safe_log('error', error_message)
+        return default
@@ -0,0 +1,153 @@
+"""
+Streaming pipeline for assistant replies.
+
+Provider chunks are often only a few characters long. `coalesce_chunks` groups
+them into SSE frames of at least STREAM_FRAME_MIN_CHARS characters, or
+whatever has arrived once STREAM_FRAME_MAX_DELAY_MS has passed; the first
+chunk is always sent on its own to keep time-to-first-byte low. The source is
+read on a helper thread, so buffered text is flushed on time even while the
+upstream stalls between chunks.
+
+`close_upstream` stops a provider stream early when nobody is listening any
+more (see stream_registry). Passing the stream's `cancelled` event to
+`coalesce_chunks` makes it stop within STREAM_CANCEL_CHECK_SECONDS even if the
+upstream is stalled and never yields another chunk.
+
+`StreamedReply` accumulates the reply in a list and checkpoints it to the
+messages table every STREAM_CHECKPOINT_SECONDS (status 'streaming'), so a
+dropped connection or crashed worker leaves the partial reply in the
+conversation instead of losing it. `finalize` writes the full text once.
+"""
+import os
+import queue
+import threading
+import time
+
+from models import Message
+from stream_registry import STREAM_CANCEL_CHECK_SECONDS
+
+STREAM_FRAME_MIN_CHARS = int(os.getenv('STREAM_FRAME_MIN_CHARS', '48'))
+STREAM_FRAME_MAX_DELAY_MS = int(os.getenv('STREAM_FRAME_MAX_DELAY_MS', '150'))
+STREAM_CHECKPOINT_SECONDS = float(os.getenv('STREAM_CHECKPOINT_SECONDS', '2'))
+
+
+def _pump_chunks(chunk_texts, chunks, stopped):
+    try:
+        for text in chunk_texts:
+            if stopped.is_set():
+                return
+            chunks.put(('ok', text))
+        chunks.put(('done', None))
+    except BaseException as e:
+        chunks.put(('error', e))
+
+
+def coalesce_chunks(chunk_texts, cancelled=None):
+    """Group small text chunks into larger frames by size and time thresholds; stop once cancelled is set"""
+    chunks = queue.Queue()
+    stopped = threading.Event()
+    threading.Thread(
+        target=_pump_chunks, args=(chunk_texts, chunks, stopped), name='chat-coalesce', daemon=True
+    ).start()
+
+    buffer = []
+    buffered_chars = 0
+    buffer_started = None
+    first = True
+    max_delay = STREAM_FRAME_MAX_DELAY_MS / 1000
+
+    try:
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                return
+            timeout = None
+            if buffer:
+                timeout = max(0.0, buffer_started + max_delay - time.monotonic())
+            if cancelled is not None:
+                timeout = STREAM_CANCEL_CHECK_SECONDS if timeout is None else min(timeout, STREAM_CANCEL_CHECK_SECONDS)
+            try:
+                kind, value = chunks.get(timeout=timeout)
+            except queue.Empty:
+                if not buffer or time.monotonic() - buffer_started < max_delay:
+                    continue
+                # Upstream is slow: send what has waited STREAM_FRAME_MAX_DELAY_MS
+                yield ''.join(buffer)
+                buffer = []
+                buffered_chars = 0
+                continue
+            if kind != 'ok':
+                break
+            if not value:
+                continue
+            if first:
+                first = False
+                yield value
+                continue
+            if not buffer:
+                buffer_started = time.monotonic()
+            buffer.append(value)
+            buffered_chars += len(value)
+            if buffered_chars >= STREAM_FRAME_MIN_CHARS or time.monotonic() - buffer_started >= max_delay:
+                yield ''.join(buffer)
+                buffer = []
+                buffered_chars = 0
+
+        if buffer:
+            yield ''.join(buffer)
+        if kind == 'error':
+            raise value
+    finally:
+        stopped.set()
+
+
+def close_upstream(response_stream):
+    """Best-effort cancel of a provider stream so it stops generating (and billing)"""
+    for stream in (response_stream, getattr(response_stream, '_iterator', None)):
+        if stream is None:
+            continue
+        for method_name in ('cancel', 'close'):
+            method = getattr(stream, method_name, None)
+            if callable(method):
+                try:
+                    method()
+                except Exception:
+                    pass
+                break
+
+
+class StreamedReply:
+    """Assistant reply that is persisted incrementally while it streams"""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.message_id = None
+        self._parts = []
+        self._last_checkpoint = time.monotonic()
+
+    def append(self, text):
+        self._parts.append(text)
+        if time.monotonic() - self._last_checkpoint >= STREAM_CHECKPOINT_SECONDS:
+            self.checkpoint()
+
+    @property
+    def text(self):
+        return ''.join(self._parts)
+
+    def checkpoint(self, status='streaming'):
+        """Write the text received so far"""
+        self._last_checkpoint = time.monotonic()
+        if self.message_id is None:
+            message = Message(
+                conversation_id=self.conversation_id,
+                role='assistant',
+                content=self.text,
+                status=status
+            )
+            self.message_id = message.save().id
+        else:
+            Message.update_content(self.message_id, self.text, status, conversation_id=self.conversation_id)
+
+    def finalize(self, status='complete'):
+        """Persist the final text; status is 'partial' when the reply was cut off"""
+        self.checkpoint(status=status)
+        return self.message_id
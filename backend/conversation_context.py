@@ -0,0 +1,161 @@
+"""
+Token-budgeted conversation history for chat prompts.
+
+Only the most recent turns are sent to the model verbatim, newest first until
+either a message count or an estimated token budget is exhausted. Turns that
+fall out of that window are folded into a rolling summary stored on the
+conversation row (`summary`, covering every message up to
+`summary_message_id`). Folding runs as a background job after a response has
+been saved, so chat latency stays flat however long a thread grows. The job
+runs on the 'llm' job queue so its slow model calls never delay other jobs.
+"""
+import json
+import os
+
+from background_jobs import register_job, enqueue_job, notify_jobs
+from database import get_db_connection
+from history_cache import history_entry, transcript_cache
+from llm_provider import get_utility_model, llm_configured
+from llm_resilience import generate_text
+from metrics import increment
+from models import Conversation, Message
+from security_utils import safe_log
+
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '3000'))
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', '20'))
+# Only summarize once this many messages have fallen out of the window
+SUMMARY_FOLD_MIN_MESSAGES = 8
+SUMMARY_MAX_CHARS = 4000
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token)"""
+    return len(text or '') // 4 + 1
+
+
+def select_history_window(messages):
+    """
+    Split messages (oldest first) into (older, recent): `recent` is the longest
+    tail within HISTORY_MAX_MESSAGES and HISTORY_TOKEN_BUDGET.
+    """
+    budget = HISTORY_TOKEN_BUDGET
+    start = len(messages)
+    while start > 0 and len(messages) - start < HISTORY_MAX_MESSAGES:
+        cost = estimate_tokens(messages[start - 1]['content'])
+        if cost > budget:
+            break
+        budget -= cost
+        start -= 1
+    return messages[:start], messages[start:]
+
+
+def _summary_prompt(summary, messages):
+    prompt = (
+        "You maintain a running summary of a conversation between a parent and a baby sleep "
+        "consultant. Update the summary with the new messages below. Keep concrete facts "
+        "(baby's age, schedule, sleep issues, methods tried, what worked, agreed next steps) "
+        "and drop pleasantries. Reply with the updated summary only, under 250 words.\n\n"
+    )
+    if summary:
+        prompt += f"Current summary:\n{summary}\n\n"
+    prompt += "New messages:\n"
+    for msg in messages:
+        role = "Parent" if msg['role'] == 'user' else "Sleep Specialist"
+        prompt += f"{role}: {msg['content']}\n"
+    return prompt
+
+
+@register_job('summarize_conversation', queue='llm')
+def run_summarize_conversation(cursor, payload, state):
+    conversation_id = payload['conversation_id']
+    cursor.execute(
+        'SELECT summary, summary_message_id FROM conversations WHERE id = ?',
+        (conversation_id,)
+    )
+    conversation = cursor.fetchone()
+    if not conversation:
+        return state, 0, True
+
+    summarized_through = conversation['summary_message_id'] or 0
+    cursor.execute('''
+        SELECT id, role, message_text(content, codec) AS content FROM messages
+        WHERE conversation_id = ? AND id > ?
+        ORDER BY id
+    ''', (conversation_id, summarized_through))
+    older, _ = select_history_window([dict(row) for row in cursor.fetchall()])
+    if len(older) < SUMMARY_FOLD_MIN_MESSAGES:
+        return state, 0, True
+
+    summary = generate_text(
+        get_utility_model(), _summary_prompt(conversation['summary'], older)
+    ).strip()[:SUMMARY_MAX_CHARS]
+
+    # Only advance if no other run folded these messages in the meantime
+    cursor.execute('''
+        UPDATE conversations
+        SET summary = ?, summary_message_id = ?
+        WHERE id = ? AND COALESCE(summary_message_id, 0) = ?
+    ''', (summary, older[-1]['id'], conversation_id, summarized_through))
+    return state, len(older), True
+
+
+def load_prompt_history(conversation_id, before_message_id, conversation=None):
+    """
+    Return (summary, recent_messages, unsummarized_count) for the prompt of the
+    message `before_message_id` (which is sent separately). Only the tail
+    window is read, from the transcript cache when it is current;
+    `unsummarized_count` is how many older messages are neither in the window
+    nor in the summary. Messages are history_cache entries with a rendered `line`.
+    `conversation` is the conversation row if the caller already has it.
+    """
+    if conversation is None:
+        conversation = Conversation.get_by_id(conversation_id)
+    summary = conversation['summary'] if conversation else None
+    summarized_through = (conversation['summary_message_id'] or 0) if conversation else 0
+
+    cached = transcript_cache.get(conversation_id, summarized_through, before_message_id)
+    if cached is not None:
+        increment('history_cache_hits')
+        older_count, messages = cached
+    else:
+        increment('history_cache_misses')
+        # Read through before_message_id so the cached entry ends with it
+        rows = Message.get_last(
+            conversation_id, HISTORY_MAX_MESSAGES + 1, before_id=before_message_id + 1, after_id=summarized_through
+        )
+        messages = [history_entry(row['id'], row['role'], row['content'], row['status']) for row in rows]
+        older_count = 0
+        if len(rows) == HISTORY_MAX_MESSAGES + 1:
+            # There may be more before these; a bounded count is enough to decide on folding
+            older_count = Message.count_between(
+                conversation_id, summarized_through, rows[0]['id'], HISTORY_MAX_MESSAGES + SUMMARY_FOLD_MIN_MESSAGES
+            )
+        if messages and messages[-1]['id'] == before_message_id:
+            transcript_cache.put(conversation_id, summarized_through, older_count, messages, HISTORY_MAX_MESSAGES + 1)
+
+    prior = [message for message in messages if message['id'] < before_message_id]
+    older, recent = select_history_window(prior)
+    return summary, recent, older_count + len(older)
+
+
+def schedule_summary_refresh(conversation_id, unsummarized_count):
+    """Queue a summary fold once enough messages are outside the window (at most one queued)"""
+    if unsummarized_count < SUMMARY_FOLD_MIN_MESSAGES or not llm_configured():
+        return
+    payload = json.dumps({'conversation_id': conversation_id})
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT 1 FROM background_jobs
+            WHERE kind = 'summarize_conversation' AND status IN ('pending', 'running') AND payload = ?
+        ''', (payload,))
+        queued = cursor.fetchone() is None
+        if queued:
+            enqueue_job(cursor, 'summarize_conversation', {'conversation_id': conversation_id})
+            conn.commit()
+        conn.close()
+        if queued:
+            notify_jobs()
+    except Exception:
+        safe_log('error', f'Failed to queue summary refresh for conversation {conversation_id}')
@@ -0,0 +1,134 @@
+"""
+Garbage collection of ownerless conversations.
+
+POST /api/conversations and anonymous chats create conversations with no
+user_id, and many of them never receive a message. The periodic
+`conversation_gc` job (see background_jobs) runs in two phases:
+
+1. Delete ownerless conversations with no messages that are older than
+   CONVERSATION_GC_ORPHAN_HOURS.
+2. If CONVERSATION_ARCHIVE_AFTER_DAYS is set, move anonymous conversations
+   idle for that long into `archived_conversations`, with the transcript
+   stored as one JSON document, and delete them from the hot tables.
+
+Both phases walk conversations by id in batches of CONVERSATION_GC_BATCH_SIZE,
+one short transaction per batch. Each batch takes the write lock before it
+selects candidates, and every delete re-checks that the conversation is still
+ownerless, so a chat that claims a conversation (Conversation.update_user)
+never loses its messages to a concurrent batch. Reclaimed rows are counted in
+the job's progress and in metrics.
+"""
+import json
+import os
+
+from background_jobs import register_job, register_periodic_job
+from message_codec import decode_message
+from metrics import increment
+
+CONVERSATION_GC_ENABLED = os.getenv('CONVERSATION_GC_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CONVERSATION_GC_INTERVAL_SECONDS = int(os.getenv('CONVERSATION_GC_INTERVAL_SECONDS', '3600'))
+CONVERSATION_GC_ORPHAN_HOURS = int(os.getenv('CONVERSATION_GC_ORPHAN_HOURS', '24'))
+CONVERSATION_GC_BATCH_SIZE = int(os.getenv('CONVERSATION_GC_BATCH_SIZE', '200'))
+# 0 disables archiving of anonymous conversations
+CONVERSATION_ARCHIVE_AFTER_DAYS = int(os.getenv('CONVERSATION_ARCHIVE_AFTER_DAYS', '0'))
+CONVERSATION_ARCHIVE_BATCH_SIZE = 50
+
+
+def _begin_write(cursor):
+    """Hold the write lock from the candidate SELECT until the batch commits"""
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN IMMEDIATE')
+
+
+def _delete_orphans(cursor, state):
+    _begin_write(cursor)
+    cursor.execute('''
+        SELECT id FROM conversations c
+        WHERE user_id IS NULL AND id > ? AND created_at < datetime('now', ?)
+          AND NOT EXISTS (SELECT 1 FROM messages WHERE conversation_id = c.id)
+        ORDER BY id
+        LIMIT ?
+    ''', (state.get('last_id', 0), f'-{CONVERSATION_GC_ORPHAN_HOURS} hours', CONVERSATION_GC_BATCH_SIZE))
+    ids = [row['id'] for row in cursor.fetchall()]
+    if not ids:
+        return 0, True
+    placeholders = ','.join('?' * len(ids))
+    # Re-check inside the delete in case a chat claimed the conversation meanwhile
+    cursor.execute(f'''
+        DELETE FROM conversations
+        WHERE id IN ({placeholders}) AND user_id IS NULL
+          AND NOT EXISTS (SELECT 1 FROM messages WHERE conversation_id = conversations.id)
+    ''', ids)
+    deleted = cursor.rowcount
+    state['last_id'] = ids[-1]
+    state['orphans_deleted'] = state.get('orphans_deleted', 0) + deleted
+    increment('gc_orphan_conversations_deleted', deleted)
+    return deleted, len(ids) < CONVERSATION_GC_BATCH_SIZE
+
+
+def _archive_anonymous(cursor, state):
+    _begin_write(cursor)
+    cursor.execute('''
+        SELECT id, title, created_at, last_message_at FROM conversations
+        WHERE user_id IS NULL AND id > ?
+          AND COALESCE(last_message_at, created_at) < datetime('now', ?)
+        ORDER BY id
+        LIMIT ?
+    ''', (state.get('last_id', 0), f'-{CONVERSATION_ARCHIVE_AFTER_DAYS} days', CONVERSATION_ARCHIVE_BATCH_SIZE))
+    conversations = cursor.fetchall()
+    if not conversations:
+        return 0, True
+
+    archived = 0
+    for conversation in conversations:
+        cursor.execute('''
+            SELECT role, content, codec, timestamp FROM messages
+            WHERE conversation_id = ?
+            ORDER BY id
+        ''', (conversation['id'],))
+        transcript = [
+            {'role': row['role'], 'content': decode_message(row['content'], row['codec']), 'timestamp': row['timestamp']}
+            for row in cursor.fetchall()
+        ]
+        # Messages go first (they reference the conversation); both deletes re-check ownership
+        cursor.execute('''
+            DELETE FROM messages
+            WHERE conversation_id = ?
+              AND conversation_id IN (SELECT id FROM conversations WHERE id = ? AND user_id IS NULL)
+        ''', (conversation['id'], conversation['id']))
+        cursor.execute('DELETE FROM conversations WHERE id = ? AND user_id IS NULL', (conversation['id'],))
+        if cursor.rowcount != 1:
+            continue  # Claimed by a user meanwhile; nothing was deleted
+        cursor.execute('''
+            INSERT OR REPLACE INTO archived_conversations
+                (id, title, created_at, last_message_at, message_count, transcript)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            conversation['id'], conversation['title'], conversation['created_at'],
+            conversation['last_message_at'], len(transcript), json.dumps(transcript)
+        ))
+        archived += 1
+
+    state['last_id'] = conversations[-1]['id']
+    state['archived'] = state.get('archived', 0) + archived
+    increment('gc_anonymous_conversations_archived', archived)
+    return archived, len(conversations) < CONVERSATION_ARCHIVE_BATCH_SIZE
+
+
+@register_job('conversation_gc')
+def run_conversation_gc(cursor, payload, state):
+    phase = state.get('phase', 'orphans')
+    if phase == 'orphans':
+        rows, finished = _delete_orphans(cursor, state)
+        if finished:
+            if not CONVERSATION_ARCHIVE_AFTER_DAYS:
+                return state, rows, True
+            state.update(phase='archive', last_id=0)
+        return state, rows, False
+
+    rows, finished = _archive_anonymous(cursor, state)
+    return state, rows, finished
+
+
+if CONVERSATION_GC_ENABLED:
+    register_periodic_job('conversation_gc', CONVERSATION_GC_INTERVAL_SECONDS)
@@ -1,6 +1,10 @@
 import sqlite3
 import os
 from datetime import datetime
+from pathlib import Path
+
+from message_codec import register_sql_functions
+from metrics import increment
 
 # Use persistent storage path if available (Railway volumes), otherwise use current directory
 # Railway volumes are mounted at /data by default
@@ -15,6 +19,7 @@ else:
 def init_db():
     """Initialize the database with required tables"""
     conn = sqlite3.connect(DATABASE_PATH, timeout=30, check_same_thread=False)
+    register_sql_functions(conn)
     conn.execute('PRAGMA journal_mode=WAL;')
     conn.execute('PRAGMA busy_timeout = 30000;')
     conn.execute('PRAGMA foreign_keys = ON;')
@@ -51,6 +56,29 @@ def init_db():
             cursor.execute('UPDATE conversations SET last_message_at = created_at WHERE last_message_at IS NULL')
         except sqlite3.OperationalError:
             pass
+    # Rolling summary of messages older than the prompt's history window
+    if 'summary' not in conversation_columns:
+        try:
+            cursor.execute('ALTER TABLE conversations ADD COLUMN summary TEXT')
+        except sqlite3.OperationalError:
+            pass
+    if 'summary_message_id' not in conversation_columns:
+        try:
+            cursor.execute('ALTER TABLE conversations ADD COLUMN summary_message_id INTEGER DEFAULT 0')
+        except sqlite3.OperationalError:
+            pass
+    # Keyset pagination of a user's conversations, most recent first (Conversation.get_page).
+    # Keyed on the same COALESCE as the ordering, since migrated rows can lack last_message_at.
+    cursor.execute('DROP INDEX IF EXISTS idx_conversations_user_recent')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_activity
+        ON conversations(user_id, COALESCE(last_message_at, created_at), id)
+    ''')
+    # Per-user title de-duplication (Conversation.assign_unique_title) scans a prefix range here
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_title
+        ON conversations(user_id, title COLLATE NOCASE)
+    ''')
     
     # Create messages table
     cursor.execute('''
@@ -63,6 +91,76 @@ def init_db():
             FOREIGN KEY (conversation_id) REFERENCES conversations (id)
         )
     ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_id
+        ON messages(conversation_id, id)
+    ''')
+    # 'streaming' while a reply is being generated, 'partial' if it was cut off
+    try:
+        cursor.execute("ALTER TABLE messages ADD COLUMN status TEXT DEFAULT 'complete'")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    # NULL for plain text, otherwise how content is compressed (see message_codec)
+    try:
+        cursor.execute("ALTER TABLE messages ADD COLUMN codec TEXT")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Full-text index of users' messages for relevant-turn retrieval (see history_retrieval).
+    # Triggers keep it in sync; replies are indexed once they stop streaming. They index
+    # message_text(content, codec) so compressed bodies are searchable, and are recreated
+    # on startup so changes to their definitions reach existing databases.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+    fts_exists = cursor.fetchone() is not None
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, owner, tokenize = 'porter unicode61')
+        ''')
+        for trigger in ('messages_fts_insert', 'messages_fts_update', 'messages_fts_delete', 'messages_fts_owner'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute('''
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+            WHEN new.status IS NOT 'streaming'
+            BEGIN
+                INSERT INTO messages_fts (rowid, content, owner)
+                SELECT new.id, message_text(new.content, new.codec), 'u' || user_id FROM conversations
+                WHERE id = new.conversation_id AND user_id IS NOT NULL;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER messages_fts_update AFTER UPDATE OF content, status, codec ON messages
+            BEGIN
+                DELETE FROM messages_fts WHERE rowid = old.id;
+                INSERT INTO messages_fts (rowid, content, owner)
+                SELECT new.id, message_text(new.content, new.codec), 'u' || user_id FROM conversations
+                WHERE id = new.conversation_id AND user_id IS NOT NULL AND new.status IS NOT 'streaming';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+            BEGIN
+                DELETE FROM messages_fts WHERE rowid = old.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER messages_fts_owner AFTER UPDATE OF user_id ON conversations
+            BEGIN
+                DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE conversation_id = new.id);
+                INSERT INTO messages_fts (rowid, content, owner)
+                SELECT id, message_text(content, codec), 'u' || new.user_id FROM messages
+                WHERE conversation_id = new.id AND new.user_id IS NOT NULL AND status IS NOT 'streaming';
+            END
+        ''')
+        if not fts_exists:
+            cursor.execute('''
+                INSERT INTO messages_fts (rowid, content, owner)
+                SELECT m.id, message_text(m.content, m.codec), 'u' || c.user_id
+                FROM messages m JOIN conversations c ON c.id = m.conversation_id
+                WHERE c.user_id IS NOT NULL AND m.status IS NOT 'streaming'
+            ''')
+    except sqlite3.OperationalError:
+        pass  # SQLite built without FTS5; retrieval is disabled
     
     # Create forum channels table
     cursor.execute('''
@@ -346,7 +444,19 @@ def init_db():
         cursor.execute('ALTER TABLE auth_users ADD COLUMN verification_token_expires TIMESTAMP')
     except sqlite3.OperationalError:
         pass  # Column already exists
-    
+
+    # Add profile version counter (used for profile response caching/ETags)
+    try:
+        cursor.execute('ALTER TABLE auth_users ADD COLUMN profile_version INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Index email for availability checks (username is covered by its UNIQUE index)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_auth_users_email
+        ON auth_users(email)
+    ''')
+
     # Create sessions table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
@@ -359,6 +469,163 @@ def init_db():
         )
     ''')
     
+    # Create email outbox table (written in the same transaction as the user change)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            context TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claim_token TEXT,
+            claimed_until TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            CHECK(status IN ('pending', 'sending', 'sent', 'dead'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due
+        ON email_outbox(status, next_attempt_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_claim
+        ON email_outbox(claim_token)
+    ''')
+    # Dead letters no longer keep their context (it holds account tokens); scrub older rows
+    cursor.execute("UPDATE email_outbox SET context = NULL WHERE status = 'dead' AND context IS NOT NULL")
+
+    # Create background jobs table (chunked, resumable data rewrites)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS background_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            user_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            state TEXT,
+            processed_rows INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claim_token TEXT,
+            claimed_until TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            CHECK(status IN ('pending', 'running', 'done', 'failed'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_background_jobs_due
+        ON background_jobs(status, next_attempt_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_background_jobs_claim
+        ON background_jobs(claim_token)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_background_jobs_kind
+        ON background_jobs(kind, created_at)
+    ''')
+
+    # Usernames freed by a rename stay reserved for their previous owner until
+    # the rename cascade has moved every row (see account_cascade)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS username_reservations (
+            username TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS auth_users_reserved_insert
+        BEFORE INSERT ON auth_users
+        WHEN EXISTS (
+            SELECT 1 FROM username_reservations WHERE username = NEW.username AND user_id IS NOT NEW.id
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'username is reserved');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS auth_users_reserved_update
+        BEFORE UPDATE OF username ON auth_users
+        WHEN EXISTS (
+            SELECT 1 FROM username_reservations WHERE username = NEW.username AND user_id IS NOT NEW.id
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'username is reserved');
+        END
+    ''')
+
+    # Per-turn LLM usage ledger and per-user daily rollups (see usage_ledger)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            conversation_id INTEGER,
+            model TEXT,
+            prompt_tokens INTEGER NOT NULL,
+            response_tokens INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            cache_hit INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_llm_usage_user
+        ON llm_usage(user_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            turns INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            response_tokens INTEGER NOT NULL DEFAULT 0,
+            cache_hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    ''')
+
+    # Anonymous conversations moved out of the hot tables by the conversation GC
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_conversations (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            created_at TIMESTAMP,
+            last_message_at TIMESTAMP,
+            message_count INTEGER NOT NULL,
+            transcript TEXT NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Create first-turn response cache table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            prompt_version TEXT NOT NULL,
+            normalized_message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_expires
+        ON response_cache(expires_at)
+    ''')
+
     # Create direct messages table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS direct_messages (
@@ -444,11 +711,31 @@ def init_db():
     conn.commit()
     conn.close()
 
+class CountingConnection(sqlite3.Connection):
+    """sqlite3 connection that counts commits (reported by /api/metrics)"""
+
+    def commit(self):
+        super().commit()
+        increment('db_commits')
+
+
 def get_db_connection():
     """Get a database connection"""
-    conn = sqlite3.connect(DATABASE_PATH, timeout=30, check_same_thread=False)
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, check_same_thread=False, factory=CountingConnection)
     conn.row_factory = sqlite3.Row
+    # The messages_fts triggers call message_text(), so every connection needs it
+    register_sql_functions(conn)
     conn.execute('PRAGMA foreign_keys = ON;')
     conn.execute('PRAGMA busy_timeout = 30000;')
     conn.execute('PRAGMA journal_mode=WAL;')
     return conn
+
+
+def get_read_connection():
+    """Get a read-only database connection (for queries that never write)"""
+    uri = Path(DATABASE_PATH).resolve().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    register_sql_functions(conn)
+    conn.execute('PRAGMA busy_timeout = 30000;')
+    return conn
@@ -0,0 +1,375 @@
+"""
+Transactional email outbox.
+
+Routes enqueue emails into the `email_outbox` table using the same cursor (and
+therefore the same transaction) as the user change that triggers them. A
+background worker in each process drains the table in batches, retries
+failures with exponential backoff and dead-letters messages that keep failing.
+The rendering context (which carries verification and password-reset tokens)
+is cleared once a row is sent or dead-lettered, so tokens are not kept after
+the last delivery attempt.
+Rows are claimed with a lease so several workers can share the table safely.
+
+Delivery goes through a pluggable transport selected by EMAIL_TRANSPORT:
+`resend` (default when RESEND_API_KEY is set) or `file`, which writes each
+message as JSON into EMAIL_OUTBOX_DIR for local development.
+"""
+import html
+import json
+import os
+import random
+import threading
+import uuid
+from datetime import datetime
+from string import Template
+
+from database import get_db_connection, DATABASE_PATH
+from security_utils import safe_log
+
+try:
+    import resend
+    RESEND_AVAILABLE = True
+except ImportError:
+    RESEND_AVAILABLE = False
+    print("Warning: Resend not installed. Email functionality will be disabled.")
+
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_CLAIM_SECONDS = 120
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BACKOFF_BASE_SECONDS = 30
+OUTBOX_BACKOFF_MAX_SECONDS = 3600
+
+
+# -------- Templates (compiled once at import) --------
+
+_BASE_STYLE = '''
+                body {
+                    font-family: 'Nunito', Arial, sans-serif;
+                    line-height: 1.6;
+                    color: #333;
+                    max-width: 600px;
+                    margin: 0 auto;
+                    padding: 20px;
+                }
+                .header {
+                    background: #3a1f35;
+                    color: white;
+                    padding: 30px;
+                    text-align: center;
+                    border-radius: 10px 10px 0 0;
+                }
+                .header h1 {
+                    margin: 0;
+                    font-size: 2.5rem;
+                }
+                .content {
+                    background: #f9f9f9;
+                    padding: 30px;
+                    border-radius: 0 0 10px 10px;
+                }
+                .button {
+                    display: inline-block;
+                    background: #3a1f35;
+                    color: white;
+                    padding: 12px 30px;
+                    text-decoration: none;
+                    border-radius: 5px;
+                    margin-top: 20px;
+                }
+                .warning {
+                    background: #fff3cd;
+                    border-left: 4px solid #ffc107;
+                    padding: 15px;
+                    margin: 20px 0;
+                }'''
+
+_LAYOUT = '''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <style>%s
+            </style>
+        </head>
+        <body>
+            <div class="header">
+                <h1><span style="color: #fff3d1;">REM</span>i</h1>
+                <p style="margin: 10px 0 0 0;">Shaping sleep, one night at a time</p>
+            </div>
+            <div class="content">%s
+                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
+                    Best regards,<br>
+                    The REMi Team
+                </p>
+            </div>
+        </body>
+        </html>
+        '''
+
+_WELCOME_BODY = '''
+                <h2>Welcome, $first_name! 👋</h2>
+                <p>Thank you for joining REMi! We're so excited to help you on your sleep training journey.</p>
+                <p>Your account has been successfully created with the username: <strong>$username</strong></p>
+                <p>You can now:</p>
+                <ul>
+                    <li>💬 Chat with our AI sleep specialist for personalized advice</li>
+                    <li>🏘️ Join the Village community to connect with other parents</li>
+                    <li>👥 Add friends and share experiences</li>
+                    <li>📝 Get expert guidance on sleep training methods</li>
+                </ul>
+                <p>We're here to support you every step of the way. If you have any questions, don't hesitate to reach out!</p>
+                <p>Sweet dreams! 🌙</p>'''
+
+_VERIFICATION_BODY = '''
+                <h2>Welcome, $first_name! 👋</h2>
+                <p>Thank you for joining REMi! We're excited to help you on your sleep training journey.</p>
+                <p>To complete your registration, please verify your email address by clicking the button below:</p>
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="$verification_url" class="button">Verify Email Address</a>
+                </div>
+                <p>Or copy and paste this link into your browser:</p>
+                <p style="word-break: break-all; color: #666; font-size: 0.9rem;">$verification_url</p>
+                <p style="margin-top: 30px; color: #666; font-size: 0.9rem;">
+                    This link will expire in 24 hours. If you didn't create an account with REMi, you can safely ignore this email.
+                </p>'''
+
+_PASSWORD_RESET_BODY = '''
+                <h2>Hello, $first_name!</h2>
+                <p>We received a request to reset your password for your REMi account.</p>
+                <p>Click the button below to reset your password:</p>
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="$reset_url" class="button">Reset Password</a>
+                </div>
+                <p>Or copy and paste this link into your browser:</p>
+                <p style="word-break: break-all; color: #666; font-size: 0.9rem;">$reset_url</p>
+                <div class="warning">
+                    <strong>⚠️ Security Notice:</strong> This link will expire in 1 hour. If you didn't request a password reset, please ignore this email and your password will remain unchanged.
+                </div>'''
+
+
+def _compile(body):
+    return Template(_LAYOUT % (_BASE_STYLE, body))
+
+
+EMAIL_TEMPLATES = {
+    'welcome': ("Welcome to REMi! 🌙", _compile(_WELCOME_BODY)),
+    'verification': ("Verify your REMi account 🌙", _compile(_VERIFICATION_BODY)),
+    'password_reset': ("Reset your REMi password 🔒", _compile(_PASSWORD_RESET_BODY)),
+}
+
+
+def _frontend_url(path, token):
+    frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
+    return f"{frontend_url}/{path}?token={token}"
+
+
+def render_email(template, context):
+    """Render a queued email into (subject, html)"""
+    subject, compiled = EMAIL_TEMPLATES[template]
+    values = {key: html.escape(str(value)) for key, value in context.items() if value is not None}
+    if 'verification_token' in context:
+        values['verification_url'] = html.escape(_frontend_url('verify-email', context['verification_token']))
+    if 'reset_token' in context:
+        values['reset_url'] = html.escape(_frontend_url('reset-password', context['reset_token']))
+    return subject, compiled.safe_substitute(values)
+
+
+# -------- Transports --------
+
+class ResendTransport:
+    """Deliver through the Resend batch API"""
+
+    name = 'resend'
+
+    def __init__(self, api_key, from_email):
+        resend.api_key = api_key
+        self.from_email = from_email
+
+    def send_batch(self, emails):
+        """Send (recipient, subject, html) tuples; return one error (or None) per email"""
+        params = [
+            {"from": self.from_email, "to": [recipient], "subject": subject, "html": body}
+            for recipient, subject, body in emails
+        ]
+        try:
+            if len(params) == 1:
+                resend.Emails.send(params[0])
+            else:
+                resend.Batch.send(params)
+            return [None] * len(emails)
+        except Exception as e:
+            return [f'{type(e).__name__}: {e}'] * len(emails)
+
+
+class FileTransport:
+    """Write each email as a JSON file (local stand-in for a real provider)"""
+
+    name = 'file'
+
+    def __init__(self, directory, from_email):
+        self.directory = directory
+        self.from_email = from_email
+        os.makedirs(directory, exist_ok=True)
+
+    def send_batch(self, emails):
+        errors = []
+        for recipient, subject, body in emails:
+            filename = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}.json"
+            try:
+                with open(os.path.join(self.directory, filename), 'w', encoding='utf-8') as f:
+                    json.dump({'from': self.from_email, 'to': [recipient], 'subject': subject, 'html': body}, f)
+                errors.append(None)
+            except OSError as e:
+                errors.append(f'{type(e).__name__}: {e}')
+        return errors
+
+
+def get_email_transport():
+    """Build the configured transport, or None if email delivery is not configured"""
+    from_email = os.getenv('RESEND_FROM_EMAIL', 'noreply@remi.app')
+    transport = (os.getenv('EMAIL_TRANSPORT') or '').lower()
+    if transport == 'file':
+        default_dir = os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), 'email_outbox')
+        return FileTransport(os.getenv('EMAIL_OUTBOX_DIR', default_dir), from_email)
+    resend_api_key = os.getenv('RESEND_API_KEY')
+    if RESEND_AVAILABLE and resend_api_key:
+        return ResendTransport(resend_api_key, from_email)
+    return None
+
+
+# -------- Outbox --------
+
+def enqueue_email(cursor, template, recipient, **context):
+    """Queue an email using the caller's cursor so it commits with the caller's transaction"""
+    if template not in EMAIL_TEMPLATES:
+        raise ValueError(f'Unknown email template: {template}')
+    cursor.execute('''
+        INSERT INTO email_outbox (template, recipient, context)
+        VALUES (?, ?, ?)
+    ''', (template, recipient, json.dumps(context)))
+    return cursor.lastrowid
+
+
+def _backoff_seconds(attempts):
+    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+    return int(delay * random.uniform(0.75, 1.25))
+
+
+def _claim_batch(conn, claim_token):
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE email_outbox
+        SET status = 'sending', claim_token = ?, claimed_until = datetime('now', ?)
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+               OR (status = 'sending' AND claimed_until <= CURRENT_TIMESTAMP)
+            ORDER BY id
+            LIMIT ?
+        )
+    ''', (claim_token, f'+{OUTBOX_CLAIM_SECONDS} seconds', OUTBOX_BATCH_SIZE))
+    conn.commit()
+    cursor.execute('SELECT * FROM email_outbox WHERE claim_token = ? ORDER BY id', (claim_token,))
+    return cursor.fetchall()
+
+
+def drain_outbox_once(transport):
+    """Claim and deliver one batch. Returns the number of rows processed."""
+    conn = get_db_connection()
+    try:
+        rows = _claim_batch(conn, uuid.uuid4().hex)
+        if not rows:
+            return 0
+
+        rendered = []
+        results = {}
+        for row in rows:
+            try:
+                subject, body = render_email(row['template'], json.loads(row['context'] or '{}'))
+                rendered.append((row, (row['recipient'], subject, body)))
+            except Exception as e:
+                # Rendering errors will not fix themselves; dead-letter immediately
+                results[row['id']] = (f'{type(e).__name__}: {e}', True)
+
+        if rendered:
+            if transport is None:
+                errors = ['Email transport not configured'] * len(rendered)
+            else:
+                errors = transport.send_batch([email for _, email in rendered])
+            for (row, _), error in zip(rendered, errors):
+                results[row['id']] = (error, False)
+
+        cursor = conn.cursor()
+        for row in rows:
+            error, permanent = results[row['id']]
+            attempts = row['attempts'] + 1
+            if error is None:
+                cursor.execute('''
+                    UPDATE email_outbox
+                    SET status = 'sent', attempts = ?, sent_at = CURRENT_TIMESTAMP,
+                        context = NULL, last_error = NULL, claim_token = NULL
+                    WHERE id = ?
+                ''', (attempts, row['id']))
+            elif permanent or transport is None or attempts >= OUTBOX_MAX_ATTEMPTS:
+                cursor.execute('''
+                    UPDATE email_outbox
+                    SET status = 'dead', attempts = ?, last_error = ?, claim_token = NULL, context = NULL
+                    WHERE id = ?
+                ''', (attempts, error[:500], row['id']))
+                safe_log('error', f'Email {row["id"]} dead-lettered after {attempts} attempt(s)')
+            else:
+                cursor.execute('''
+                    UPDATE email_outbox
+                    SET status = 'pending', attempts = ?, last_error = ?, claim_token = NULL,
+                        next_attempt_at = datetime('now', ?)
+                    WHERE id = ?
+                ''', (attempts, error[:500], f'+{_backoff_seconds(attempts)} seconds', row['id']))
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+
+class OutboxWorker(threading.Thread):
+    """Background thread that drains the email outbox"""
+
+    def __init__(self, transport):
+        super().__init__(name='email-outbox', daemon=True)
+        self.transport = transport
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                while drain_outbox_once(self.transport) == OUTBOX_BATCH_SIZE:
+                    pass
+            except Exception:
+                safe_log('error', 'Email outbox worker error')
+            self._wake.wait(OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_outbox_worker():
+    """Start this process's outbox worker (idempotent)"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            transport = get_email_transport()
+            if transport is None:
+                safe_log('warning', 'Email transport not configured. Queued emails will be dead-lettered.')
+            _worker = OutboxWorker(transport)
+            _worker.start()
+    return _worker
+
+
+def notify_outbox():
+    """Wake the local worker after committing newly queued emails"""
+    if _worker is not None:
+        _worker.wake()
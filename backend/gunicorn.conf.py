@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration.
+
+Streaming /api/chat responses stay open for the whole LLM generation, so
+synchronous workers (one request per process) let a couple of slow chats block
+every other API call. The default worker class is gevent: each request runs in
+a greenlet and waiting on the LLM stream yields to other requests, so a few
+processes can hold thousands of open SSE streams while CRUD routes keep
+responding. GUNICORN_WORKER_CLASS=gthread is a thread-pool alternative for
+environments without gevent.
+
+Under gevent the Gemini SDK is switched to its REST transport (see
+llm_provider), since gRPC does not cooperate with gevent's monkey patching.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+timeout = 120
+
+if worker_class == 'gevent':
+    # Concurrent requests (including open SSE streams) per worker process
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+elif worker_class == 'gthread':
+    threads = int(os.getenv('GUNICORN_THREADS', '32'))
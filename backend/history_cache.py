@@ -0,0 +1,159 @@
+"""
+In-process cache of formatted conversation transcripts.
+
+Building a chat prompt used to mean reading the conversation's recent
+messages and re-rendering every "Parent: ... / Sleep Specialist: ..." line on
+each turn. This cache keeps, per active conversation, the tail of messages
+since the rolling summary with each line already rendered.
+
+- `Message.save` appends a new message in place. The previous message id is
+  read inside the insert transaction, and the entry must end with exactly
+  that message. Otherwise another worker has written to the conversation, so
+  the entry is dropped and rebuilt from the database next turn.
+- `Message.update_content` (streamed replies) replaces the message's entry.
+- An entry is only used while its summary boundary matches the conversation
+  row and it holds no reply that is still streaming.
+
+Entries are evicted least recently used once the cache exceeds
+HISTORY_CACHE_MAX_BYTES. A conversation bigger than a sixteenth of that is
+not cached at all.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+# Rough per-message overhead of the dict and its strings
+_MESSAGE_OVERHEAD_BYTES = 200
+
+
+def format_history_line(role, content):
+    speaker = "Parent" if role == 'user' else "Sleep Specialist"
+    return f"{speaker}: {content}\n"
+
+
+def history_entry(message_id, role, content, status='complete'):
+    """A message as used in prompts: its fields plus the rendered transcript line"""
+    return {
+        'id': message_id,
+        'role': role,
+        'content': content,
+        'status': status,
+        'line': format_history_line(role, content),
+    }
+
+
+def format_transcript(messages):
+    return ''.join(message['line'] for message in messages)
+
+
+def _message_bytes(message):
+    return len(message['content']) + len(message['line']) + _MESSAGE_OVERHEAD_BYTES
+
+
+class _Transcript:
+    __slots__ = ('summarized_through', 'older_count', 'max_messages', 'messages', 'size')
+
+    def __init__(self, summarized_through, older_count, messages, max_messages):
+        self.summarized_through = summarized_through
+        self.older_count = older_count
+        self.max_messages = max_messages
+        self.messages = list(messages)
+        self.size = sum(_message_bytes(message) for message in self.messages)
+
+
+class TranscriptCache:
+    """Byte-bounded LRU of per-conversation transcripts (see module docstring)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 16
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def contains(self, conversation_id):
+        return conversation_id in self._entries
+
+    def _drop(self, conversation_id):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _trim(self, conversation_id, entry):
+        while len(entry.messages) > entry.max_messages:
+            removed = _message_bytes(entry.messages.pop(0))
+            entry.size -= removed
+            self._size -= removed
+            entry.older_count += 1
+        if entry.size > self.max_entry_bytes:
+            self._drop(conversation_id)
+        while self._size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def get(self, conversation_id, summarized_through, last_message_id):
+        """
+        Return (older_count, messages) if the cached transcript covers the
+        conversation up to and including last_message_id, else None.
+        `older_count` is how many unsummarized messages precede `messages`.
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return None
+            if (entry.summarized_through != summarized_through
+                    or not entry.messages
+                    or entry.messages[-1]['id'] != last_message_id
+                    or any(message['status'] == 'streaming' for message in entry.messages)):
+                self._drop(conversation_id)
+                return None
+            self._entries.move_to_end(conversation_id)
+            return entry.older_count, list(entry.messages)
+
+    def put(self, conversation_id, summarized_through, older_count, messages, max_messages):
+        with self._lock:
+            self._drop(conversation_id)
+            entry = _Transcript(summarized_through, older_count, messages, max_messages)
+            self._entries[conversation_id] = entry
+            self._size += entry.size
+            self._trim(conversation_id, entry)
+
+    def append(self, conversation_id, previous_id, message):
+        """Append a newly saved message if the entry ends with previous_id; drop the entry otherwise"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            if not entry.messages or entry.messages[-1]['id'] != previous_id:
+                self._drop(conversation_id)
+                return
+            entry.messages.append(message)
+            entry.size += _message_bytes(message)
+            self._size += _message_bytes(message)
+            self._trim(conversation_id, entry)
+
+    def update(self, conversation_id, message_id, content, status):
+        """Replace a cached message after its content changed"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            for index in range(len(entry.messages) - 1, -1, -1):
+                old = entry.messages[index]
+                if old['id'] == message_id:
+                    # Replaced rather than mutated: prompts being built may hold the old dict
+                    new = history_entry(message_id, old['role'], content, status)
+                    entry.messages[index] = new
+                    delta = _message_bytes(new) - _message_bytes(old)
+                    entry.size += delta
+                    self._size += delta
+                    self._trim(conversation_id, entry)
+                    return
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._drop(conversation_id)
+
+
+transcript_cache = TranscriptCache(HISTORY_CACHE_MAX_BYTES)
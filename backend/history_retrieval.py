@@ -0,0 +1,97 @@
+"""
+Relevant-turn retrieval across a user's earlier conversations.
+
+Messages are indexed in `messages_fts`, a local SQLite FTS5 table (porter
+stemming, bm25 ranking), so no external search or vector service is needed.
+Triggers created in database.init_db keep it in sync as messages are saved,
+checkpointed, re-owned or deleted. Each row carries an `owner` token
+("u<user_id>") so a query only ever matches the asking user's messages.
+
+For a new chat turn, the distinctive words of the message are matched
+against the user's other conversations (the current one is already covered
+by the recent window and rolling summary). The best RETRIEVAL_TOP_K hits
+that fit RETRIEVAL_TOKEN_BUDGET go into the prompt.
+"""
+import os
+import re
+import sqlite3
+
+from conversation_context import estimate_tokens
+from database import get_read_connection
+
+RETRIEVAL_ENABLED = os.getenv('RETRIEVAL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '4'))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv('RETRIEVAL_TOKEN_BUDGET', '600'))
+RETRIEVAL_MAX_QUERY_TERMS = 12
+RETRIEVAL_SNIPPET_CHARS = 500
+
+# Words too common in this domain (or in English) to say anything about relevance
+STOPWORDS = frozenset('''
+    a about after again all also am an and any are as at be because been before being but by can
+    could did do does doing for from get got had has have having he her here him his how i if in
+    into is it its just me more my no not now of on or our out over she should so some than that
+    the their them then there these they this to too up very was we were what when where which
+    while who why will with would you your baby babies sleep sleeping help please thanks thank
+'''.split())
+
+
+def owner_token(user_id):
+    return f'u{user_id}'
+
+
+def build_match_query(text):
+    """FTS5 query matching any distinctive term of text, or None if there are none"""
+    terms = []
+    for word in re.findall(r'[a-z0-9]+', (text or '').lower()):
+        if len(word) < 3 or word in STOPWORDS or word in terms:
+            continue
+        terms.append(word)
+        if len(terms) >= RETRIEVAL_MAX_QUERY_TERMS:
+            break
+    if not terms:
+        return None
+    return ' OR '.join(f'"{term}"' for term in terms)
+
+
+def retrieve_related_turns(user_id, message, conversation_id=None):
+    """
+    Return up to RETRIEVAL_TOP_K of the user's earlier messages (dicts with
+    role and content) most relevant to message, best first, within the token
+    budget. Messages from conversation_id are skipped.
+    """
+    if not RETRIEVAL_ENABLED or user_id is None:
+        return []
+    terms = build_match_query(message)
+    if terms is None:
+        return []
+
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT m.role, message_text(m.content, m.codec) AS content
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND m.conversation_id != ?
+            ORDER BY bm25(messages_fts)
+            LIMIT ?
+        ''', (f'owner:{owner_token(user_id)} AND ({terms})', conversation_id or 0, RETRIEVAL_TOP_K * 2))
+        rows = cursor.fetchall()
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5: retrieval is simply unavailable
+        rows = []
+    finally:
+        conn.close()
+
+    turns = []
+    budget = RETRIEVAL_TOKEN_BUDGET
+    for row in rows:
+        content = row['content'][:RETRIEVAL_SNIPPET_CHARS]
+        cost = estimate_tokens(content)
+        if cost > budget:
+            continue
+        budget -= cost
+        turns.append({'role': row['role'], 'content': content})
+        if len(turns) >= RETRIEVAL_TOP_K:
+            break
+    return turns
@@ -0,0 +1,185 @@
+"""
+Admission control for LLM calls.
+
+Every chat turn that calls the provider must hold a permit. Each worker process
+allows at most LLM_MAX_CONCURRENCY generations at once. Each user (or client IP
+when anonymous) also has a token bucket of LLM_USER_BURST turns, refilled at
+LLM_USER_RATE_PER_MINUTE. When all slots are busy, requests wait in a fair
+queue: users are served round-robin, so one client sending many requests cannot
+starve the others. A request waits at most LLM_QUEUE_TIMEOUT_SECONDS and the
+queue holds at most LLM_QUEUE_MAX requests. Past those limits the caller gets
+`AdmissionRejected` with a Retry-After hint, which the chat route turns into a
+fast 429. Queue depth and wait times are exported through metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import gauge_add, increment, observe
+
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '16'))
+LLM_QUEUE_MAX = int(os.getenv('LLM_QUEUE_MAX', '64'))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv('LLM_QUEUE_TIMEOUT_SECONDS', '10'))
+# Room for a quick back-and-forth; sustained automated traffic is still throttled
+LLM_USER_RATE_PER_MINUTE = float(os.getenv('LLM_USER_RATE_PER_MINUTE', '20'))
+LLM_USER_BURST = int(os.getenv('LLM_USER_BURST', '10'))
+# Idle buckets are dropped after this long (they would be full again anyway)
+BUCKET_IDLE_SECONDS = 3600
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class _TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def seconds_until_token(self):
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60
+
+
+class _Waiter:
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+
+class Permit:
+    """A held LLM slot; release() is idempotent"""
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency, queue_max, queue_timeout, rate_per_minute, burst):
+        self.max_concurrency = max_concurrency
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        self._active = 0
+        self._waiting = 0
+        self._queues = OrderedDict()  # user_key -> deque of waiters, in round-robin order
+        self._buckets = {}
+        self._condition = threading.Condition()
+        self._last_bucket_sweep = time.monotonic()
+
+    def _bucket(self, user_key, now):
+        if now - self._last_bucket_sweep > BUCKET_IDLE_SECONDS:
+            self._last_bucket_sweep = now
+            for key in [k for k, b in self._buckets.items() if now - b.updated > BUCKET_IDLE_SECONDS]:
+                del self._buckets[key]
+        bucket = self._buckets.get(user_key)
+        if bucket is None:
+            bucket = self._buckets[user_key] = _TokenBucket(self.rate_per_second, self.burst)
+        return bucket
+
+    def _estimated_wait(self):
+        # Rough: queued requests drain a slot-width at a time
+        return self.queue_timeout * (self._waiting + 1) / max(1, self.max_concurrency)
+
+    def admit(self, user_key):
+        """Block until a slot is available for user_key; raise AdmissionRejected otherwise"""
+        started = time.monotonic()
+        with self._condition:
+            bucket = self._bucket(user_key, started)
+            if not bucket.take(started):
+                increment('llm_rejected_rate_limited')
+                raise AdmissionRejected('rate_limited', bucket.seconds_until_token())
+
+            if self._active < self.max_concurrency and not self._waiting:
+                self._active += 1
+                gauge_add('llm_active', 1)
+                observe('llm_queue_wait_seconds', 0.0)
+                return Permit(self)
+
+            if self._waiting >= self.queue_max:
+                bucket.refund()
+                increment('llm_rejected_queue_full')
+                raise AdmissionRejected('queue_full', self._estimated_wait())
+
+            waiter = _Waiter()
+            self._queues.setdefault(user_key, deque()).append(waiter)
+            self._waiting += 1
+            gauge_add('llm_queue_depth', 1)
+
+            deadline = started + self.queue_timeout
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            if not waiter.granted:
+                queue = self._queues.get(user_key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[user_key]
+                self._waiting -= 1
+                gauge_add('llm_queue_depth', -1)
+                bucket.refund()
+                increment('llm_rejected_queue_timeout')
+                raise AdmissionRejected('queue_timeout', self._estimated_wait())
+
+        observe('llm_queue_wait_seconds', time.monotonic() - started)
+        return Permit(self)
+
+    def _release(self):
+        with self._condition:
+            if self._queues:
+                # Hand the slot straight to the next user in round-robin order
+                user_key, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(user_key)
+                else:
+                    del self._queues[user_key]
+                waiter.granted = True
+                self._waiting -= 1
+                gauge_add('llm_queue_depth', -1)
+                self._condition.notify_all()
+            else:
+                self._active -= 1
+                gauge_add('llm_active', -1)
+
+
+_controller = AdmissionController(
+    LLM_MAX_CONCURRENCY, LLM_QUEUE_MAX, LLM_QUEUE_TIMEOUT_SECONDS, LLM_USER_RATE_PER_MINUTE, LLM_USER_BURST
+)
+
+
+def admit_llm_call(user_key):
+    """Acquire a permit for one LLM generation (see module docstring)"""
+    return _controller.admit(user_key)
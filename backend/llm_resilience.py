@@ -0,0 +1,318 @@
+"""
+Resilience layer for LLM provider calls.
+
+The pinned Gemini SDK has no per-call timeout, so calls run on a helper thread
+(a greenlet under gevent) and the caller waits with deadlines:
+
+- LLM_CONNECT_TIMEOUT_SECONDS: opening the call / stream
+- LLM_FIRST_TOKEN_TIMEOUT_SECONDS: first streamed chunk
+- LLM_TOTAL_TIMEOUT_SECONDS: the whole generation, kept below gunicorn's timeout
+
+Non-streamed calls are idempotent, so they are retried on timeouts and
+transient provider errors with jittered exponential backoff
+(LLM_MAX_RETRIES). With LLM_HEDGE_ENABLED they are also hedged: if the first
+attempt is slower than the LLM_HEDGE_PERCENTILE latency of recent calls, a
+second attempt starts and whichever finishes first wins.
+
+A circuit breaker opens after LLM_BREAKER_FAILURES consecutive provider
+failures (RETRYABLE_ERRORS, which include our deadline timeouts) and
+rejects calls immediately with `ProviderUnavailable` for
+LLM_BREAKER_COOLDOWN_SECONDS. After that a single trial call decides whether
+it closes again. Other errors, such as the ValueError raised for a
+safety-blocked response, say nothing about the provider's health: they neither
+count as failures nor settle a trial.
+
+Everything here works the same with LLM_PROVIDER=mock. MOCK_LLM_FAILURE_RATE
+and MOCK_LLM_FIRST_CHUNK_DELAY_MS exercise the failure and timeout paths.
+"""
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as google_exceptions
+
+from chat_stream import close_upstream
+from metrics import increment, observe
+from security_utils import safe_log
+
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv('LLM_CONNECT_TIMEOUT_SECONDS', '10'))
+LLM_FIRST_TOKEN_TIMEOUT_SECONDS = float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT_SECONDS', '20'))
+LLM_TOTAL_TIMEOUT_SECONDS = float(os.getenv('LLM_TOTAL_TIMEOUT_SECONDS', '100'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_SECONDS = 0.5
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0.95'))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+PROVIDER_UNAVAILABLE_MESSAGE = (
+    "The sleep assistant is having trouble reaching its AI service right now. "
+    "Please try again in a minute."
+)
+
+RETRYABLE_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.GatewayTimeout,
+)
+
+
+class ProviderTimeout(TimeoutError):
+    """A provider deadline passed"""
+
+
+class ProviderUnavailable(Exception):
+    """The circuit breaker is open; fail fast with a friendly message"""
+
+    def __init__(self, message=PROVIDER_UNAVAILABLE_MESSAGE):
+        super().__init__(message)
+
+
+# Errors the chat routes report to users as "provider unavailable"
+PROVIDER_ERRORS = (ProviderUnavailable,) + RETRYABLE_ERRORS
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.cooldown_seconds:
+                return 'open'
+            return 'half_open'
+
+    def before_call(self):
+        """Raise ProviderUnavailable while open; returns True if this call is the half-open trial"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.cooldown_seconds or self._trial_in_flight:
+                increment('llm_breaker_rejected')
+                raise ProviderUnavailable()
+            self._trial_in_flight = True
+            return True
+
+    def abandon_trial(self):
+        """The trial call ended without an outcome (e.g. its consumer went away); allow another"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    safe_log('warning', 'LLM circuit breaker opened')
+                    increment('llm_breaker_opened')
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_SECONDS)
+
+_latencies = deque(maxlen=256)
+_latencies_lock = threading.Lock()
+
+
+def _hedge_delay():
+    with _latencies_lock:
+        if len(_latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(_latencies)
+    return samples[min(len(samples) - 1, int(LLM_HEDGE_PERCENTILE * len(samples)))]
+
+
+def _start(fn, results):
+    """Run fn on a daemon thread, putting ('ok', value) or ('error', exc) on results"""
+    def run():
+        try:
+            results.put(('ok', fn()))
+        except BaseException as e:
+            results.put(('error', e))
+
+    threading.Thread(target=run, name='llm-call', daemon=True).start()
+
+
+def _unwrap(outcome):
+    kind, value = outcome
+    if kind == 'error':
+        raise value
+    return value
+
+
+def _attempt(model, prompt, deadline):
+    """One non-streamed attempt, optionally hedged; returns the response text"""
+    started = time.monotonic()
+    results = queue.Queue()
+    call = lambda: model.generate_content(prompt).text
+    _start(call, results)
+    in_flight = 1
+    hedge_after = _hedge_delay() if LLM_HEDGE_ENABLED else None
+    last_error = None
+
+    while in_flight:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait = remaining
+        if hedge_after is not None:
+            wait = min(wait, max(0.0, started + hedge_after - time.monotonic()))
+        try:
+            outcome = results.get(timeout=wait)
+        except queue.Empty:
+            if hedge_after is not None and time.monotonic() - started >= hedge_after:
+                # Primary is slower than usual: race a second request against it
+                increment('llm_hedged_requests')
+                _start(call, results)
+                in_flight += 1
+                hedge_after = None
+            continue
+        in_flight -= 1
+        try:
+            text = _unwrap(outcome)
+        except Exception as e:
+            last_error = e
+            continue
+        with _latencies_lock:
+            _latencies.append(time.monotonic() - started)
+        return text
+
+    if last_error is not None and not in_flight:
+        raise last_error
+    raise ProviderTimeout('LLM call exceeded its deadline')
+
+
+def generate_text(model, prompt):
+    """Non-streamed generation with deadline, retries, optional hedging and the breaker"""
+    trial = breaker.before_call()
+    settled = False
+    deadline = time.monotonic() + LLM_TOTAL_TIMEOUT_SECONDS
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                text = _attempt(model, prompt, deadline)
+            except RETRYABLE_ERRORS as e:
+                increment('llm_call_failures')
+                remaining = deadline - time.monotonic()
+                backoff = LLM_RETRY_BASE_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt >= LLM_MAX_RETRIES or backoff >= remaining:
+                    settled = True
+                    breaker.record_failure()
+                    raise
+                increment('llm_retries')
+                safe_log('warning', f'Retrying LLM call after {type(e).__name__}')
+                time.sleep(backoff)
+                continue
+            settled = True
+            breaker.record_success()
+            return text
+    finally:
+        # Non-provider errors, or GreenletExit when the request is killed: the trial has no outcome
+        if trial and not settled:
+            breaker.abandon_trial()
+
+
+class ResilientStream:
+    """
+    Iterate a provider stream with connect / first-token / total deadlines.
+    Chunks are pumped on a helper thread so a stalled upstream cannot block
+    the caller past its deadline; close() stops the upstream.
+    """
+
+    _DONE = object()
+
+    def __init__(self, model, prompt):
+        self._model = model
+        self._prompt = prompt
+        self._chunks = queue.Queue()
+        self._upstream = None
+        self._closed = False
+
+    def _pump(self, upstream):
+        try:
+            for chunk in upstream:
+                if self._closed:
+                    break
+                self._chunks.put(('ok', chunk))
+            self._chunks.put(('ok', self._DONE))
+        except BaseException as e:
+            self._chunks.put(('error', e))
+
+    def __iter__(self):
+        trial = breaker.before_call()
+        settled = False
+        started = time.monotonic()
+        deadline = started + LLM_TOTAL_TIMEOUT_SECONDS
+        first = True
+        try:
+            opened = queue.Queue()
+            _start(lambda: self._model.generate_content(self._prompt, stream=True), opened)
+            try:
+                self._upstream = _unwrap(opened.get(timeout=LLM_CONNECT_TIMEOUT_SECONDS))
+            except queue.Empty:
+                raise ProviderTimeout('Timed out connecting to the LLM provider')
+            threading.Thread(target=self._pump, args=(self._upstream,), name='llm-stream', daemon=True).start()
+
+            while True:
+                limit = LLM_FIRST_TOKEN_TIMEOUT_SECONDS if first else LLM_TOTAL_TIMEOUT_SECONDS
+                timeout = min(limit, deadline - time.monotonic())
+                try:
+                    chunk = _unwrap(self._chunks.get(timeout=max(0.0, timeout)))
+                except queue.Empty:
+                    raise ProviderTimeout('Timed out waiting for the first token' if first else 'LLM stream exceeded its deadline')
+                if chunk is self._DONE:
+                    break
+                if first:
+                    first = False
+                    observe('llm_first_token_seconds', time.monotonic() - started)
+                    settled = True
+                    breaker.record_success()
+                yield chunk
+        except ProviderUnavailable:
+            raise
+        except Exception as e:
+            increment('llm_call_failures')
+            if first and isinstance(e, RETRYABLE_ERRORS):
+                settled = True
+                breaker.record_failure()
+            self.close()
+            raise
+        finally:
+            # Non-provider error, or closed before the first token: the trial has no outcome
+            if trial and not settled:
+                breaker.abandon_trial()
+
+    def close(self):
+        """Stop consuming and cancel the upstream stream if possible"""
+        self._closed = True
+        # Wake __iter__ if it is waiting on a stalled upstream
+        self._chunks.put(('ok', self._DONE))
+        if self._upstream is not None:
+            close_upstream(self._upstream)
+
+
+def generate_stream(model, prompt):
+    return ResilientStream(model, prompt)
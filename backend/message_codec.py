@@ -0,0 +1,82 @@
+"""
+Transparent compression of long message bodies.
+
+Messages of at least MESSAGE_COMPRESSION_MIN_BYTES are stored as zlib data
+with a preset dictionary of phrases common in sleep-consultant replies. The
+dictionary matters because individual replies are short (a few hundred words),
+too short for plain zlib to learn much from them. The messages.codec column
+records how a body is stored: NULL for plain text, or 'zd1' for zlib with
+dictionary version 1. The dictionary must never change once rows use it; a new
+dictionary needs a new codec name.
+
+The model layer decodes lazily (models.MessageRow), and the `message_text(content,
+codec)` SQL function, registered on every connection, lets triggers and ad-hoc
+queries (full-text indexing, progress extraction) read the plain text.
+"""
+import os
+import zlib
+
+MESSAGE_COMPRESSION_MIN_BYTES = int(os.getenv('MESSAGE_COMPRESSION_MIN_BYTES', '512'))
+MESSAGE_COMPRESSION_ENABLED = os.getenv('MESSAGE_COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+CODEC_ZLIB_DICT_V1 = 'zd1'
+
+# zlib favours matches near the end of the dictionary, so the most common phrases come last
+_DICTIONARY_V1 = ' '.join([
+    "It's completely normal and many parents find that consistency over the next few days makes a big difference.",
+    "If you have any concerns about feeding, weight gain or illness, please check with your pediatrician.",
+    "sleep regression, developmental leap, teething, separation anxiety, growth spurt, overtired, undertired,",
+    "white noise, blackout curtains, sleep sack, swaddle transition, pacifier, lovey, crib, bassinet, room temperature,",
+    "gentle method, chair method, pick up put down, Ferber, check and console, fading, extinction, shush pat,",
+    "wake window, nap schedule, short naps, contact naps, catnap, nap transition, drop a nap, 2 naps, 3 naps,",
+    "early morning waking, night wakings, night feeds, dream feed, split nights, false start, sleep associations,",
+    "drowsy but awake, self-settling, independent sleep, bedtime routine, bath, book, song, feed, cuddle, lights out,",
+    "Here are a few things you can try: ",
+    "**Bedtime routine:** **Wake windows:** **Naps:** **Night wakings:** **Next steps:** ",
+    "- Keep the bedtime routine short, calm and predictable, about 20-30 minutes.\n",
+    "- Aim for an age-appropriate wake window before each nap and before bedtime.\n",
+    "- Put your baby down drowsy but awake so they can practise falling asleep independently.\n",
+    "- Respond calmly and consistently to night wakings, and keep the room dark and quiet.\n",
+    "- Try to keep wake-up time consistent in the morning, even after a rough night.\n",
+    "Would you like help building a daily schedule for your baby's age? ",
+    "your baby your little one your baby's sleep at this age months old weeks old ",
+    "minutes hours between naps before bedtime in the morning at night during the day ",
+    "you could try it can help it's a good idea to make sure that ",
+    "sleep and nap and bedtime and the the baby the nap the night ",
+]).encode('utf-8')
+
+
+def _compress(data):
+    compressor = zlib.compressobj(level=6, zdict=_DICTIONARY_V1)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data):
+    decompressor = zlib.decompressobj(zdict=_DICTIONARY_V1)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def encode_message(text):
+    """Return (stored_content, codec) for a message body; short or incompressible text is kept as is"""
+    if not MESSAGE_COMPRESSION_ENABLED or text is None:
+        return text, None
+    data = text.encode('utf-8')
+    if len(data) < MESSAGE_COMPRESSION_MIN_BYTES:
+        return text, None
+    compressed = _compress(data)
+    if len(compressed) >= len(data) * 0.9:
+        return text, None
+    return compressed, CODEC_ZLIB_DICT_V1
+
+
+def decode_message(content, codec):
+    """Return the plain text of a stored message body"""
+    if not codec or content is None:
+        return content
+    if codec == CODEC_ZLIB_DICT_V1:
+        return _decompress(bytes(content)).decode('utf-8')
+    raise ValueError(f'Unknown message codec: {codec}')
+
+
+def register_sql_functions(conn):
+    conn.create_function('message_text', 2, decode_message, deterministic=True)
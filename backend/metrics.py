@@ -0,0 +1,94 @@
+"""
+Lightweight in-process metrics.
+
+Counters, gauges (with their peak since start), timing summaries and value
+summaries (non-duration quantities such as token counts) are kept per worker
+process and exposed as JSON by GET /api/metrics, which is only
+enabled when METRICS_TOKEN is set. They exist to measure the chat path under
+load (see bench_chat.py), not to replace a real metrics backend.
+"""
+import threading
+import time
+from collections import deque
+
+TIMING_SAMPLE_SIZE = 1024
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_gauge_peaks = {}
+_timings = {}
+_values = {}
+_started_at = time.time()
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def gauge_add(name, delta):
+    with _lock:
+        value = _gauges.get(name, 0) + delta
+        _gauges[name] = value
+        if value > _gauge_peaks.get(name, 0):
+            _gauge_peaks[name] = value
+
+
+def _record(series, name, value):
+    summary = series.get(name)
+    if summary is None:
+        summary = series[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'samples': deque(maxlen=TIMING_SAMPLE_SIZE)}
+    summary['count'] += 1
+    summary['total'] += value
+    summary['max'] = max(summary['max'], value)
+    summary['samples'].append(value)
+
+
+def observe(name, seconds):
+    """Record a duration; keeps count/total/max plus a bounded sample for percentiles"""
+    with _lock:
+        _record(_timings, name, seconds)
+
+
+def observe_value(name, value):
+    """Record a non-duration quantity (e.g. tokens per reply), summarized like timings"""
+    with _lock:
+        _record(_values, name, value)
+
+
+def average(name):
+    """Mean of an observed series (timing or value), or None if nothing was recorded"""
+    with _lock:
+        summary = _timings.get(name) or _values.get(name)
+        return summary['total'] / summary['count'] if summary and summary['count'] else None
+
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def _summarize(summary):
+    samples = sorted(summary['samples'])
+    return {
+        'count': summary['count'],
+        'avg': summary['total'] / summary['count'] if summary['count'] else None,
+        'p50': _percentile(samples, 0.5),
+        'p95': _percentile(samples, 0.95),
+        'max': summary['max'],
+    }
+
+
+def snapshot():
+    """Return all metrics as a JSON-serializable dict"""
+    with _lock:
+        return {
+            'uptime_seconds': time.time() - _started_at,
+            'counters': dict(_counters),
+            'gauges': {name: {'value': value, 'peak': _gauge_peaks.get(name, 0)} for name, value in _gauges.items()},
+            'timings': {name: _summarize(summary) for name, summary in _timings.items()},
+            'values': {name: _summarize(summary) for name, summary in _values.items()},
+        }
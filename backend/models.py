@@ -1,4 +1,8 @@
+import sqlite3
+
 from database import get_db_connection
+from history_cache import history_entry, transcript_cache
+from message_codec import decode_message, encode_message
 
 class Conversation:
     def __init__(self, id=None, created_at=None, title=None, user_id=None, last_message_at=None):
@@ -39,6 +43,46 @@ class Conversation:
         conn.close()
         return conversations
     
+    @staticmethod
+    def get_page(user_id, limit, before=None, after=None):
+        """
+        Get up to `limit` of the user's conversations, most recent first.
+        Rows are ordered by `activity_at`, i.e. COALESCE(last_message_at, created_at)
+        as in get_all. `before` / `after` are (activity_at, id) keys of a row from
+        a previous page; the page starts just past that row in the given direction.
+        The scalar bound on activity_at lets the expression index seek to the key.
+        """
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if after is not None:
+            cursor.execute('''
+                SELECT * FROM (
+                    SELECT *, COALESCE(last_message_at, created_at) AS activity_at FROM conversations
+                    WHERE user_id = ? AND COALESCE(last_message_at, created_at) >= ?
+                      AND (COALESCE(last_message_at, created_at), id) > (?, ?)
+                    ORDER BY COALESCE(last_message_at, created_at) ASC, id ASC
+                    LIMIT ?
+                ) ORDER BY activity_at DESC, id DESC
+            ''', (user_id, after[0], after[0], after[1], limit))
+        elif before is not None:
+            cursor.execute('''
+                SELECT *, COALESCE(last_message_at, created_at) AS activity_at FROM conversations
+                WHERE user_id = ? AND COALESCE(last_message_at, created_at) <= ?
+                  AND (COALESCE(last_message_at, created_at), id) < (?, ?)
+                ORDER BY COALESCE(last_message_at, created_at) DESC, id DESC
+                LIMIT ?
+            ''', (user_id, before[0], before[0], before[1], limit))
+        else:
+            cursor.execute('''
+                SELECT *, COALESCE(last_message_at, created_at) AS activity_at FROM conversations
+                WHERE user_id = ?
+                ORDER BY COALESCE(last_message_at, created_at) DESC, id DESC
+                LIMIT ?
+            ''', (user_id, limit))
+        conversations = cursor.fetchall()
+        conn.close()
+        return conversations
+
     @staticmethod
     def get_by_id(conversation_id):
         """Get a conversation by ID"""
@@ -80,44 +124,119 @@ class Conversation:
         conn.close()
 
     @staticmethod
-    def get_titles_for_user(user_id):
-        if user_id is None:
-            return []
+    def assign_unique_title(conversation_id, user_id, base_title):
+        """
+        Set the title to base_title, or "base_title #N" if the user already has it
+        (case-insensitive). N is one more than the highest existing suffix, found
+        with a single range scan of idx_conversations_user_title.
+        """
+        if not conversation_id:
+            return base_title
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT title FROM conversations WHERE user_id = ?', (user_id,))
-        titles = [row['title'] for row in cursor.fetchall() if row['title']]
+        title = base_title
+        # Serialize concurrent titling so two chats cannot pick the same suffix
+        cursor.execute('BEGIN IMMEDIATE')
+        if user_id is not None:
+            suffix_start = len(base_title) + 3
+            cursor.execute('''
+                SELECT MAX(CASE
+                    WHEN title = :base COLLATE NOCASE THEN 1
+                    WHEN substr(title, :suffix_start - 2, 2) = ' #'
+                         AND substr(title, :suffix_start) <> ''
+                         AND substr(title, :suffix_start) NOT GLOB '*[^0-9]*'
+                    THEN CAST(substr(title, :suffix_start) AS INTEGER)
+                END) AS max_suffix
+                FROM conversations
+                WHERE user_id = :user_id AND id != :conversation_id
+                  AND title COLLATE NOCASE >= :base AND title COLLATE NOCASE < :upper
+            ''', {
+                'base': base_title,
+                'suffix_start': suffix_start,
+                'user_id': user_id,
+                'conversation_id': conversation_id,
+                # Every title starting with "base #<digits>" sorts below "base #:"
+                'upper': base_title + ' #:',
+            })
+            max_suffix = cursor.fetchone()['max_suffix']
+            if max_suffix:
+                title = f"{base_title} #{max_suffix + 1}"
+        cursor.execute('UPDATE conversations SET title = ? WHERE id = ?', (title, conversation_id))
+        conn.commit()
         conn.close()
-        return titles
+        return title
+
+class MessageRow(sqlite3.Row):
+    """Message row whose content is decompressed when read; the codec column is hidden"""
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key == 'content':
+            return decode_message(value, super().__getitem__('codec'))
+        return value
+
+    def keys(self):
+        return [key for key in super().keys() if key != 'codec']
+
 
 class Message:
-    def __init__(self, id=None, conversation_id=None, role=None, content=None, timestamp=None):
+    def __init__(self, id=None, conversation_id=None, role=None, content=None, timestamp=None, status='complete'):
         self.id = id
         self.conversation_id = conversation_id
         self.role = role
         self.content = content
         self.timestamp = timestamp
+        self.status = status
     
     def save(self):
         """Save a message to the database"""
+        stored, codec = encode_message(self.content)
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO messages (conversation_id, role, content)
-            VALUES (?, ?, ?)
-        ''', (self.conversation_id, self.role, self.content))
+            INSERT INTO messages (conversation_id, role, content, codec, status)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (self.conversation_id, self.role, stored, codec, self.status))
         self.id = cursor.lastrowid
+        previous_id = None
         if self.conversation_id:
             cursor.execute('UPDATE conversations SET last_message_at = CURRENT_TIMESTAMP WHERE id = ?', (self.conversation_id,))
+            if transcript_cache.contains(self.conversation_id):
+                # Read inside the write transaction, so it is exactly the message before this one
+                cursor.execute(
+                    'SELECT MAX(id) FROM messages WHERE conversation_id = ? AND id < ?',
+                    (self.conversation_id, self.id)
+                )
+                previous_id = cursor.fetchone()[0]
         conn.commit()
         conn.close()
+        if previous_id is not None:
+            transcript_cache.append(
+                self.conversation_id, previous_id, history_entry(self.id, self.role, self.content, self.status)
+            )
         return self
     
+    @staticmethod
+    def update_content(message_id, content, status, conversation_id=None):
+        """Overwrite a message's content and status (streamed replies are checkpointed in place)"""
+        stored, codec = encode_message(content)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE messages SET content = ?, codec = ?, status = ? WHERE id = ?',
+            (stored, codec, status, message_id)
+        )
+        conn.commit()
+        conn.close()
+        if conversation_id:
+            transcript_cache.update(conversation_id, message_id, content, status)
+
     @staticmethod
     def get_by_conversation(conversation_id):
         """Get all messages for a conversation"""
         conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.row_factory = MessageRow
         cursor.execute('''
             SELECT * FROM messages 
             WHERE conversation_id = ? 
@@ -126,3 +245,58 @@ class Message:
         messages = cursor.fetchall()
         conn.close()
         return messages
+
+    @staticmethod
+    def get_last(conversation_id, limit, before_id=None, after_id=None):
+        """Get the last `limit` messages (oldest first), optionally bounded by message ids"""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = MessageRow
+        cursor.execute('''
+            SELECT * FROM (
+                SELECT * FROM messages
+                WHERE conversation_id = ? AND id < ? AND id > ?
+                ORDER BY id DESC
+                LIMIT ?
+            ) ORDER BY id ASC
+        ''', (conversation_id, before_id if before_id is not None else 2 ** 63 - 1, after_id or 0, limit))
+        messages = cursor.fetchall()
+        conn.close()
+        return messages
+
+    @staticmethod
+    def get_before(conversation_id, before_id, limit):
+        """Get the page of up to `limit` messages immediately preceding `before_id` (oldest first)"""
+        return Message.get_last(conversation_id, limit, before_id=before_id)
+
+    @staticmethod
+    def get_after(conversation_id, after_id, limit):
+        """Get up to `limit` messages following `after_id` (oldest first)"""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = MessageRow
+        cursor.execute('''
+            SELECT * FROM messages
+            WHERE conversation_id = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (conversation_id, after_id, limit))
+        messages = cursor.fetchall()
+        conn.close()
+        return messages
+
+    @staticmethod
+    def count_between(conversation_id, after_id, before_id, cap):
+        """Count messages strictly between two ids, stopping at `cap`"""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM messages
+                WHERE conversation_id = ? AND id > ? AND id < ?
+                LIMIT ?
+            )
+        ''', (conversation_id, after_id or 0, before_id, cap))
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
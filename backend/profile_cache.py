@@ -0,0 +1,72 @@
+"""
+Versioned response cache for profile endpoints.
+
+Every user has a `profile_version` counter on auth_users that is bumped in the
+same transaction as any change to their profile, profile picture, baby
+profiles or sleep goals. Profile responses are cached per process as
+serialized JSON keyed by (kind, user_id, version) and carry a strong ETag
+derived from the same key, so clients revalidating with If-None-Match get a
+304 and a cache hit costs only the version lookup.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+PROFILE_CACHE_MAX_ENTRIES = 4096
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping (used for serialized bodies and rendered prompt blocks)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = LRUCache(PROFILE_CACHE_MAX_ENTRIES)
+
+
+def bump_profile_version(cursor, user_id):
+    """Invalidate cached profile responses for a user (call inside the write transaction)"""
+    cursor.execute(
+        'UPDATE auth_users SET profile_version = COALESCE(profile_version, 0) + 1 WHERE id = ?',
+        (user_id,)
+    )
+
+
+def cached_json_response(kind, user_id, version, loader):
+    """
+    Return a JSON response for `kind` at the given profile version.
+    `loader` is only called on a cache miss and must return JSON-serializable data.
+    """
+    key = (kind, user_id, version or 0)
+    etag = f'{kind}-{user_id}-{version or 0}'
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = _cache.get(key)
+        if body is None:
+            body = current_app.json.dumps(loader()) + '\n'
+            _cache.put(key, body)
+        response = Response(body, mimetype=current_app.json.mimetype)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,228 @@
+"""
+SQLite-backed storage for Flask-Limiter.
+
+Counters live in a small SQLite file shared by every gunicorn worker on the
+host, so limits are enforced per host rather than per worker and survive
+restarts. Each check runs inside a `BEGIN IMMEDIATE` transaction, which makes
+the read-modify-write atomic across processes. Expired rows are removed in
+bounded batches on a timer instead of on every hit.
+
+Connections come from a small per-process pool (RATE_LIMIT_POOL_SIZE). Under
+gevent workers a thread-local would be per greenlet, i.e. a new SQLite
+connection for every request; the pool is shared by all of them instead.
+
+Importing this module registers the `sqlite://` scheme with `limits`, e.g.
+`sqlite:///ratelimits.db` (relative) or `sqlite:////data/ratelimits.db`.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from limits.storage import Storage, MovingWindowSupport
+
+from database import DATABASE_PATH
+
+RATE_LIMIT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), 'ratelimits.db')
+DEFAULT_RATE_LIMIT_STORAGE_URI = f'sqlite:///{RATE_LIMIT_DB_PATH}'
+
+EXPIRY_SWEEP_SECONDS = 30
+EXPIRY_BATCH_SIZE = 500
+# Writers are serialized by SQLite anyway; a few connections cover concurrent reads
+RATE_LIMIT_POOL_SIZE = int(os.getenv('RATE_LIMIT_POOL_SIZE', '4'))
+
+
+class SQLiteStorage(Storage, MovingWindowSupport):
+    """Rate limit storage backed by a local SQLite file"""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        path = (uri or DEFAULT_RATE_LIMIT_STORAGE_URI)[len('sqlite:///'):]
+        self.path = path or RATE_LIMIT_DB_PATH
+        self._pool = queue.LifoQueue()
+        self._pool_slots = threading.BoundedSemaphore(RATE_LIMIT_POOL_SIZE)
+        self._sweep_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._init_schema()
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA busy_timeout = 30000;')
+        conn.execute('PRAGMA synchronous = NORMAL;')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Check a connection out of the pool (opening one if none is idle)"""
+        self._pool_slots.acquire()
+        conn = None
+        try:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            yield conn
+        except BaseException:
+            # Don't return a connection in an unknown state to the pool
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._pool.put(conn)
+            self._pool_slots.release()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _init_schema(self):
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                    key TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_entries (
+                    key TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_rate_limit_entries_key
+                ON rate_limit_entries(key, created_at)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_rate_limit_entries_expiry
+                ON rate_limit_entries(expires_at)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_rate_limit_counters_expiry
+                ON rate_limit_counters(expires_at)
+            ''')
+
+    def _maybe_sweep(self, now):
+        """Delete expired rows in bounded batches, at most once per interval per process"""
+        if now - self._last_sweep < EXPIRY_SWEEP_SECONDS or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = now
+            with self._connection() as conn:
+                for table in ('rate_limit_entries', 'rate_limit_counters'):
+                    while True:
+                        deleted = conn.execute(f'''
+                            DELETE FROM {table}
+                            WHERE rowid IN (
+                                SELECT rowid FROM {table} WHERE expires_at <= ? LIMIT ?
+                            )
+                        ''', (now, EXPIRY_BATCH_SIZE)).rowcount
+                        if deleted < EXPIRY_BATCH_SIZE:
+                            break
+        finally:
+            self._sweep_lock.release()
+
+    # Fixed window
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('''
+                INSERT INTO rate_limit_counters (key, count, expires_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    count = CASE WHEN expires_at <= ? THEN excluded.count ELSE count + excluded.count END,
+                    expires_at = CASE WHEN expires_at <= ? OR ? THEN excluded.expires_at ELSE expires_at END
+            ''', (key, amount, now + expiry, now, now, 1 if elastic_expiry else 0))
+            count = conn.execute('SELECT count FROM rate_limit_counters WHERE key = ?', (key,)).fetchone()[0]
+        self._maybe_sweep(now)
+        return count
+
+    def get(self, key):
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT count FROM rate_limit_counters WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT expires_at FROM rate_limit_counters WHERE key = ? AND expires_at > ?',
+                (key, now)
+            ).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            with self._connection() as conn:
+                conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._transaction() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM rate_limit_counters').fetchone()[0]
+            count += conn.execute('SELECT COUNT(DISTINCT key) FROM rate_limit_entries').fetchone()[0]
+            conn.execute('DELETE FROM rate_limit_counters')
+            conn.execute('DELETE FROM rate_limit_entries')
+        return count
+
+    def clear(self, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM rate_limit_counters WHERE key = ?', (key,))
+            conn.execute('DELETE FROM rate_limit_entries WHERE key = ?', (key,))
+
+    # Moving (sliding) window
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as conn:
+            in_window = conn.execute(
+                'SELECT COUNT(*) FROM rate_limit_entries WHERE key = ? AND created_at > ?',
+                (key, now - expiry)
+            ).fetchone()[0]
+            acquired = in_window + amount <= limit
+            if acquired:
+                conn.executemany(
+                    'INSERT INTO rate_limit_entries (key, created_at, expires_at) VALUES (?, ?, ?)',
+                    [(key, now, now + expiry)] * amount
+                )
+        self._maybe_sweep(now)
+        return acquired
+
+    def get_moving_window(self, key, limit, expiry):
+        now = time.time()
+        with self._connection() as conn:
+            oldest, count = conn.execute(
+                'SELECT MIN(created_at), COUNT(*) FROM rate_limit_entries WHERE key = ? AND created_at > ?',
+                (key, now - expiry)
+            ).fetchone()
+        if not count:
+            return now, 0
+        return oldest, count
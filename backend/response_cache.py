@@ -0,0 +1,125 @@
+"""
+Opt-in cache of first-turn answers.
+
+Many conversations open with nearly the same question ("night wakings",
+"short naps"). When RESPONSE_CACHE_ENABLED is set, answers to turns that have
+no conversation history and no personal (baby profile / sleep goal) context are
+stored in SQLite keyed by the normalized message and a hash of the prompt
+version, so a change to the system prompt or model never serves stale answers.
+Entries expire after RESPONSE_CACHE_TTL_SECONDS and the table is kept under
+RESPONSE_CACHE_MAX_BYTES by evicting the least recently used answers.
+"""
+import hashlib
+import os
+import re
+
+from database import get_db_connection
+from llm_provider import GEMINI_MODEL_NAME, SLEEP_SPECIALIST_PROMPT
+from security_utils import safe_log
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(5 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_MESSAGE_CHARS = 300
+REPLAY_CHUNK_CHARS = 80
+
+PROMPT_VERSION = hashlib.sha256(
+    f'{GEMINI_MODEL_NAME}\n{SLEEP_SPECIALIST_PROMPT}'.encode('utf-8')
+).hexdigest()[:16]
+
+
+def normalize_message(message):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    text = re.sub(r"[^a-z0-9' ]+", ' ', (message or '').lower())
+    return ' '.join(text.split())
+
+
+def _cache_key(normalized):
+    return hashlib.sha256(f'{PROMPT_VERSION}\n{normalized}'.encode('utf-8')).hexdigest()
+
+
+def is_cacheable_turn(message, conversation_history, conversation_summary, user_context_block):
+    """Only history-free turns without personal context are shared between users"""
+    return (
+        RESPONSE_CACHE_ENABLED
+        and not conversation_history
+        and not conversation_summary
+        and not user_context_block
+        and len(message) <= RESPONSE_CACHE_MAX_MESSAGE_CHARS
+        and bool(normalize_message(message))
+    )
+
+
+def get_cached_response(message):
+    """Return the cached answer for a message, or None"""
+    try:
+        key = _cache_key(normalize_message(message))
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT response FROM response_cache
+            WHERE cache_key = ? AND expires_at > CURRENT_TIMESTAMP
+        ''', (key,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('''
+                UPDATE response_cache
+                SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+                WHERE cache_key = ?
+            ''', (key,))
+            conn.commit()
+        conn.close()
+        return row['response'] if row else None
+    except Exception:
+        safe_log('error', 'Response cache lookup failed')
+        return None
+
+
+def store_cached_response(message, response):
+    """Cache an answer and evict expired / least recently used entries over the size bound"""
+    normalized = normalize_message(message)
+    size_bytes = len(response.encode('utf-8'))
+    if not response or size_bytes > RESPONSE_CACHE_MAX_BYTES:
+        return
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO response_cache
+                (cache_key, prompt_version, normalized_message, response, size_bytes, expires_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+        ''', (_cache_key(normalized), PROMPT_VERSION, normalized, response, size_bytes,
+              f'+{RESPONSE_CACHE_TTL_SECONDS} seconds'))
+        cursor.execute('DELETE FROM response_cache WHERE expires_at <= CURRENT_TIMESTAMP')
+        # Drop least recently used entries beyond the byte budget in one statement
+        cursor.execute('''
+            DELETE FROM response_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key,
+                           SUM(size_bytes) OVER (
+                               ORDER BY last_hit_at DESC, rowid DESC
+                               ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                           ) AS running_bytes
+                    FROM response_cache
+                )
+                WHERE running_bytes > ?
+            )
+        ''', (RESPONSE_CACHE_MAX_BYTES,))
+        conn.commit()
+        conn.close()
+    except Exception:
+        safe_log('error', 'Failed to store cached response')
+
+
+def replay_chunks(response):
+    """Split a cached answer into stream-sized pieces on word boundaries"""
+    start = 0
+    while start < len(response):
+        end = min(len(response), start + REPLAY_CHUNK_CHARS)
+        if end < len(response):
+            space = response.rfind(' ', start, end)
+            if space > start:
+                end = space + 1
+        yield response[start:end]
+        start = end
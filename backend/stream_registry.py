@@ -0,0 +1,165 @@
+"""
+In-process registry of in-flight chat generations.
+
+A streaming chat turn is generated by a background producer that publishes
+numbered events into a `ChatStream`; HTTP clients are only subscribers. The
+original /api/chat response and any later GET /api/chat/stream/<id> (for
+example after a dropped mobile connection, or from a second device) replay the
+buffered events after their Last-Event-ID and then follow the live stream.
+
+The replay buffer holds at most STREAM_REPLAY_MAX_EVENTS events and finished
+streams are kept for STREAM_RETENTION_SECONDS. Subscribers are counted, and a
+watchdog timer (`watch_abandonment`) cancels generation once nobody has been
+listening for STREAM_CANCEL_GRACE_SECONDS (long enough for a quick reconnect),
+even while the provider is between chunks. Streams live in the memory of the
+worker that generates them; a reconnect that lands on another worker (or
+arrives after retention) gets a 404 and should reload the conversation's
+messages, where the reply is checkpointed.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+STREAM_REPLAY_MAX_EVENTS = int(os.getenv('STREAM_REPLAY_MAX_EVENTS', '4096'))
+STREAM_RETENTION_SECONDS = int(os.getenv('STREAM_RETENTION_SECONDS', '300'))
+STREAM_CANCEL_GRACE_SECONDS = float(os.getenv('STREAM_CANCEL_GRACE_SECONDS', '2'))
+STREAM_CANCEL_CHECK_SECONDS = float(os.getenv('STREAM_CANCEL_CHECK_SECONDS', '0.25'))
+STREAM_KEEPALIVE_SECONDS = 15
+
+
+class StreamGone(Exception):
+    """The requested events were already evicted from the replay buffer"""
+
+
+class ChatStream:
+    def __init__(self, user_id=None, conversation_id=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.finished_at = None
+        self._events = deque(maxlen=STREAM_REPLAY_MAX_EVENTS)
+        self._next_event_id = 1
+        self._subscribers = 0
+        # Counts as detached until the first subscriber attaches
+        self._detached_since = time.monotonic()
+        self._condition = threading.Condition()
+        self.cancelled = threading.Event()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def publish(self, payload, final=False):
+        """Append an event (a JSON-serializable dict) and wake subscribers"""
+        with self._condition:
+            self._events.append((self._next_event_id, json.dumps(payload)))
+            self._next_event_id += 1
+            if final:
+                self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    def events_after(self, last_event_id):
+        """Return buffered (event_id, data) pairs after last_event_id"""
+        with self._condition:
+            if self._events and last_event_id + 1 < self._events[0][0]:
+                raise StreamGone()
+            return [event for event in self._events if event[0] > last_event_id]
+
+    def abandoned_for(self):
+        """Seconds since the last subscriber went away (0 while anyone is attached)"""
+        with self._condition:
+            if self._subscribers:
+                return 0
+            return time.monotonic() - self._detached_since
+
+    def is_abandoned(self):
+        return self.abandoned_for() > STREAM_CANCEL_GRACE_SECONDS
+
+    def watch_abandonment(self, on_abandoned):
+        """
+        Check every STREAM_CANCEL_CHECK_SECONDS on a timer thread; once the stream
+        is abandoned, set `cancelled` and call on_abandoned() (at most once)
+        """
+        def watch():
+            while not self.cancelled.wait(STREAM_CANCEL_CHECK_SECONDS):
+                if self.finished:
+                    return
+                if self.is_abandoned():
+                    self.cancelled.set()
+                    on_abandoned()
+                    return
+
+        threading.Thread(target=watch, name=f'chat-watch-{self.id[:8]}', daemon=True).start()
+
+    def _attach(self):
+        with self._condition:
+            self._subscribers += 1
+
+    def _detach(self):
+        with self._condition:
+            self._subscribers -= 1
+            if not self._subscribers:
+                self._detached_since = time.monotonic()
+
+    def subscribe(self, last_event_id=0):
+        """
+        Yield SSE-formatted events after last_event_id until the stream finishes.
+        A client disconnect (GeneratorExit from the server, or a failed write)
+        closes this generator and detaches the subscriber.
+        """
+        self._attach()
+        try:
+            while True:
+                try:
+                    events = self.events_after(last_event_id)
+                except StreamGone:
+                    yield f"data: {json.dumps({'error': 'Stream fell too far behind. Please reload the conversation.', 'done': True})}\n\n"
+                    return
+                for event_id, data in events:
+                    yield f"id: {event_id}\ndata: {data}\n\n"
+                    last_event_id = event_id
+                if self.finished and not self.events_after(last_event_id):
+                    return
+                with self._condition:
+                    timed_out = False
+                    if self._next_event_id - 1 == last_event_id and not self.finished:
+                        timed_out = not self._condition.wait(timeout=STREAM_KEEPALIVE_SECONDS)
+                if timed_out:
+                    yield ": keep-alive\n\n"
+        finally:
+            self._detach()
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def _purge_expired():
+    cutoff = time.monotonic() - STREAM_RETENTION_SECONDS
+    for stream_id in [sid for sid, s in _streams.items() if s.finished and s.finished_at < cutoff]:
+        del _streams[stream_id]
+
+
+def create_stream(user_id=None, conversation_id=None):
+    """Register a new stream for a generation that is about to start"""
+    stream = ChatStream(user_id=user_id, conversation_id=conversation_id)
+    with _streams_lock:
+        _purge_expired()
+        _streams[stream.id] = stream
+    return stream
+
+
+def get_stream(stream_id):
+    with _streams_lock:
+        _purge_expired()
+        return _streams.get(stream_id)
+
+
+def parse_last_event_id(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# Backend modules are flat and imported by name (as app.py does)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from history_cache import transcript_cache  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, fully migrated database file for one test"""
+    monkeypatch.setattr(database, 'DATABASE_PATH', str(tmp_path / 'chatbot.db'))
+    database.init_db()
+    for conversation_id in list(transcript_cache._entries):
+        transcript_cache.invalidate(conversation_id)
+    yield database
@@ -0,0 +1,72 @@
+from account_cascade import RENAME_STEPS, enqueue_purge, enqueue_rename, run_rename_user
+from background_jobs import run_pending_jobs_once
+
+
+def _send_dm(conn, sender, receiver):
+    conn.execute('INSERT INTO direct_messages (sender_name, receiver_name, content) VALUES (?, ?, ?)', (sender, receiver, 'hi'))
+    conn.commit()
+
+
+def _dm_names(conn):
+    return sorted((row[0], row[1]) for row in conn.execute('SELECT sender_name, receiver_name FROM direct_messages'))
+
+
+def _reserved(conn):
+    return [row[0] for row in conn.execute('SELECT username FROM username_reservations')]
+
+
+def test_rename_moves_rows_written_after_it_was_queued(db):
+    conn = db.get_db_connection()
+    _send_dm(conn, 'alice', 'bob')
+    enqueue_rename(conn.cursor(), 1, 'alice', 'alice2')
+    conn.commit()
+    # Addressed to the old name after the job was queued
+    _send_dm(conn, 'bob', 'alice')
+    conn.execute("INSERT INTO friendships (user1_name, user2_name) VALUES ('carol', 'alice')")
+    conn.commit()
+
+    while run_pending_jobs_once():
+        pass
+    assert _dm_names(conn) == [('alice2', 'bob'), ('bob', 'alice2')]
+    assert [tuple(row) for row in conn.execute('SELECT user1_name, user2_name FROM friendships')] == [('carol', 'alice2')]
+    assert _reserved(conn) == []
+    conn.close()
+
+
+def test_rename_sweeps_again_before_releasing_the_old_name(db):
+    conn = db.get_db_connection()
+    enqueue_rename(conn.cursor(), 1, 'alice', 'alice2')
+    conn.commit()
+    payload = {'user_id': 1, 'old': 'alice', 'new': 'alice2'}
+    cursor = conn.cursor()
+
+    state, done = {}, False
+    while state.get('step', 0) < len(RENAME_STEPS) - 1:
+        state, _, done = run_rename_user(cursor, payload, state)
+        conn.commit()
+    # The direct_messages steps are already behind the job
+    _send_dm(conn, 'bob', 'alice')
+    state, _, done = run_rename_user(cursor, payload, state)
+    conn.commit()
+    assert not done and _reserved(conn) == ['alice']
+
+    while not done:
+        state, _, done = run_rename_user(cursor, payload, state)
+        conn.commit()
+    assert _dm_names(conn) == [('bob', 'alice2')]
+    assert _reserved(conn) == []
+    conn.close()
+
+
+def test_purge_leaves_rows_of_a_newcomer_alone(db):
+    conn = db.get_db_connection()
+    _send_dm(conn, 'alice', 'bob')
+    enqueue_purge(conn.cursor(), 1, 'alice')
+    conn.commit()
+    # Someone else signed up as alice after the purge was queued
+    _send_dm(conn, 'bob', 'alice')
+
+    while run_pending_jobs_once():
+        pass
+    assert _dm_names(conn) == [('bob', 'alice')]
+    conn.close()
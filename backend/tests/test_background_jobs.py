@@ -0,0 +1,37 @@
+import background_jobs
+from background_jobs import enqueue_job, register_job, run_pending_jobs_once
+
+
+@register_job('test_quick')
+def _run_quick(cursor, payload, state):
+    return state, 1, True
+
+
+@register_job('test_slow_llm', queue='llm')
+def _run_slow_llm(cursor, payload, state):
+    return state, 1, True
+
+
+def _statuses(conn):
+    return {row['kind']: row['status'] for row in conn.execute('SELECT kind, status FROM background_jobs')}
+
+
+def test_llm_jobs_run_only_on_their_own_queue(db):
+    conn = db.get_db_connection()
+    # The slow job is queued first but must not hold up the default queue
+    enqueue_job(conn.cursor(), 'test_slow_llm', {})
+    enqueue_job(conn.cursor(), 'test_quick', {})
+    conn.commit()
+
+    assert run_pending_jobs_once('default')
+    assert _statuses(conn) == {'test_slow_llm': 'pending', 'test_quick': 'done'}
+    assert not run_pending_jobs_once('default')
+
+    assert run_pending_jobs_once('llm')
+    assert _statuses(conn) == {'test_slow_llm': 'done', 'test_quick': 'done'}
+    conn.close()
+
+
+def test_summaries_are_routed_to_the_llm_queue():
+    import conversation_context  # noqa: F401  (registers the job)
+    assert background_jobs.JOB_QUEUES['summarize_conversation'] == 'llm'
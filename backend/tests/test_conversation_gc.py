@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+import conversation_gc
+from models import Conversation, Message
+
+
+def _anonymous_conversation(content):
+    conversation_id = Conversation.create().id
+    Message(conversation_id=conversation_id, role='user', content=content).save()
+    return conversation_id
+
+
+def test_archive_skips_conversation_claimed_during_batch(db, monkeypatch):
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO auth_users (username, email, password_hash) VALUES ('alice1', 'a@x.com', 'x')")
+    user_id = conn.execute('SELECT id FROM auth_users').fetchone()[0]
+    conn.commit()
+    claimed = _anonymous_conversation('please keep me')
+    idle = _anonymous_conversation('archive me')
+    conn.execute("UPDATE conversations SET last_message_at = datetime('now', '-40 days')")
+    conn.commit()
+
+    monkeypatch.setattr(conversation_gc, 'CONVERSATION_ARCHIVE_AFTER_DAYS', 30)
+    cursor = conn.cursor()
+    real_decode = conversation_gc.decode_message
+    attempted = []
+
+    def claim_while_archiving(content, codec):
+        if not attempted:
+            attempted.append(True)
+            # Another worker cannot claim while the batch holds the write lock...
+            other = sqlite3.connect(db.DATABASE_PATH, timeout=0.1)
+            with pytest.raises(sqlite3.OperationalError):
+                other.execute('UPDATE conversations SET user_id = ? WHERE id = ?', (user_id, claimed))
+            other.close()
+            # ...and a claim that lands anyway must keep its messages
+            conn.execute('UPDATE conversations SET user_id = ? WHERE id = ?', (user_id, claimed))
+        return real_decode(content, codec)
+
+    monkeypatch.setattr(conversation_gc, 'decode_message', claim_while_archiving)
+    archived, finished = conversation_gc._archive_anonymous(cursor, {})
+    conn.commit()
+
+    assert (archived, finished) == (1, True)
+    assert [row['content'] for row in Message.get_by_conversation(claimed)] == ['please keep me']
+    assert Conversation.get_by_id(claimed)['user_id'] == user_id
+    assert Conversation.get_by_id(idle) is None
+    archived_ids = [row[0] for row in conn.execute('SELECT id FROM archived_conversations')]
+    assert archived_ids == [idle]
+    conn.close()
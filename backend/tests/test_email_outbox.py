@@ -0,0 +1,82 @@
+import email_outbox
+from email_outbox import drain_outbox_once, enqueue_email
+
+
+class _Transport:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    def send_batch(self, emails):
+        self.sent.extend(emails)
+        return [self.error] * len(emails)
+
+
+def _queue_verification(db):
+    conn = db.get_db_connection()
+    email_id = enqueue_email(conn.cursor(), 'verification', 'a@x.com', first_name='A', verification_token='secret-token')
+    conn.commit()
+    conn.close()
+    return email_id
+
+
+def _row(db, email_id):
+    conn = db.get_db_connection()
+    row = conn.execute('SELECT * FROM email_outbox WHERE id = ?', (email_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def _retry_now(db, email_id):
+    conn = db.get_db_connection()
+    conn.execute('UPDATE email_outbox SET next_attempt_at = CURRENT_TIMESTAMP WHERE id = ?', (email_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_sent_email_drops_its_token(db):
+    email_id = _queue_verification(db)
+    transport = _Transport()
+    assert drain_outbox_once(transport) == 1
+    assert 'secret-token' in transport.sent[0][2]
+    row = _row(db, email_id)
+    assert row['status'] == 'sent' and row['context'] is None
+
+
+def test_failures_back_off_then_dead_letter_without_context(db, monkeypatch):
+    monkeypatch.setattr(email_outbox, 'OUTBOX_MAX_ATTEMPTS', 2)
+    email_id = _queue_verification(db)
+    transport = _Transport(error='503 from provider')
+
+    assert drain_outbox_once(transport) == 1
+    row = _row(db, email_id)
+    assert (row['status'], row['attempts']) == ('pending', 1)
+    assert row['context'] is not None
+    # Backed off: not claimed again right away
+    assert drain_outbox_once(transport) == 0
+
+    _retry_now(db, email_id)
+    assert drain_outbox_once(transport) == 1
+    row = _row(db, email_id)
+    assert (row['status'], row['attempts'], row['last_error']) == ('dead', 2, '503 from provider')
+    assert row['context'] is None
+
+
+def test_unrenderable_email_is_dead_lettered_at_once(db):
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO email_outbox (template, recipient, context) VALUES ('welcome', 'a@x.com', 'not json')")
+    conn.commit()
+    conn.close()
+    transport = _Transport()
+    assert drain_outbox_once(transport) == 1
+    assert transport.sent == []
+    assert _row(db, 1)['status'] == 'dead'
+
+
+def test_dead_rows_are_scrubbed_by_migration(db):
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO email_outbox (template, recipient, context, status) VALUES ('welcome', 'a@x.com', '{}', 'dead')")
+    conn.commit()
+    conn.close()
+    db.init_db()
+    assert _row(db, 1)['context'] is None
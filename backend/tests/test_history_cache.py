@@ -0,0 +1,70 @@
+from history_cache import TranscriptCache, history_entry
+
+
+def _assert_size_consistent(cache):
+    assert cache._size == sum(entry.size for entry in cache._entries.values())
+
+
+def _messages(start, count):
+    return [history_entry(i, 'user' if i % 2 else 'assistant', f'message {i}') for i in range(start, start + count)]
+
+
+def test_size_tracks_entries_through_put_append_update_and_trim():
+    cache = TranscriptCache(1024 * 1024)
+    cache.put(1, None, 0, _messages(1, 10), max_messages=4)
+    _assert_size_consistent(cache)
+    assert len(cache._entries[1].messages) == 4
+    assert cache._entries[1].older_count == 6
+
+    for message_id in range(11, 200):
+        cache.append(1, message_id - 1, history_entry(message_id, 'user', 'x' * 50))
+        _assert_size_consistent(cache)
+
+    cache.update(1, 199, 'y' * 500, 'complete')
+    _assert_size_consistent(cache)
+
+    cache.put(2, None, 0, _messages(1, 3), max_messages=10)
+    cache.invalidate(1)
+    _assert_size_consistent(cache)
+
+
+def test_appends_at_window_do_not_starve_new_entries():
+    cache = TranscriptCache(64 * 1024)
+    cache.put(1, None, 0, _messages(1, 4), max_messages=4)
+    for message_id in range(5, 5000):
+        cache.append(1, message_id - 1, history_entry(message_id, 'user', 'x' * 100))
+    _assert_size_consistent(cache)
+
+    cache.put(2, None, 0, _messages(1, 4), max_messages=4)
+    assert cache.contains(1) and cache.contains(2)
+
+
+def test_checkpointed_reply_is_cached_as_text(db):
+    from chat_stream import StreamedReply
+    from conversation_context import load_prompt_history
+    from history_cache import format_transcript, transcript_cache
+    from models import Conversation, Message
+
+    conversation_id = Conversation.create().id
+    question = Message(conversation_id=conversation_id, role='user', content='How long should naps be?').save()
+    load_prompt_history(conversation_id, question.id)
+    assert transcript_cache.contains(conversation_id)
+
+    # Long enough to be stored compressed; written through save() and then update_content()
+    reply = StreamedReply(conversation_id)
+    reply.append('Naps at this age usually last about an hour. ')
+    reply.checkpoint()
+    reply.append('Watch for sleepy cues and keep the room dark and calm. ' * 40)
+    reply.finalize()
+
+    follow_up = Message(conversation_id=conversation_id, role='user', content='Thanks!').save()
+    cached = transcript_cache.get(conversation_id, 0, follow_up.id)
+    assert cached is not None
+    cached_reply = next(message for message in cached[1] if message['role'] == 'assistant')
+    assert cached_reply['content'] == reply.text
+    assert f'Sleep Specialist: {reply.text}\n' in format_transcript(cached[1])
+
+    _, recent, _ = load_prompt_history(conversation_id, follow_up.id)
+    transcript_cache.invalidate(conversation_id)
+    _, fresh, _ = load_prompt_history(conversation_id, follow_up.id)
+    assert format_transcript(recent) == format_transcript(fresh)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from llm_admission import AdmissionController, AdmissionRejected
+
+
+def _controller(max_concurrency=1, queue_max=8, queue_timeout=2, rate_per_minute=600, burst=10):
+    return AdmissionController(max_concurrency, queue_max, queue_timeout, rate_per_minute, burst)
+
+
+def _admit_in_background(controller, user_key, order):
+    def admit():
+        try:
+            permit = controller.admit(user_key)
+        except AdmissionRejected as e:
+            order.append(e.reason)
+            return
+        order.append(user_key)
+        permit.release()
+
+    waiting = controller._waiting
+    thread = threading.Thread(target=admit)
+    thread.start()
+    # Wait until the request is queued so arrival order is deterministic
+    deadline = time.monotonic() + 2
+    while controller._waiting == waiting and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return thread
+
+
+def test_burst_is_rate_limited_with_retry_after():
+    controller = _controller(max_concurrency=10, burst=2, rate_per_minute=6)
+    controller.admit('alice').release()
+    controller.admit('alice').release()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit('alice')
+    assert rejected.value.reason == 'rate_limited'
+    assert rejected.value.retry_after >= 1
+    controller.admit('bob').release()
+
+
+def test_queued_users_are_served_round_robin():
+    controller = _controller()
+    permit = controller.admit('holder')
+    order = []
+    threads = [_admit_in_background(controller, user_key, order) for user_key in ('alice', 'alice', 'alice', 'bob')]
+    permit.release()
+    for thread in threads:
+        thread.join(5)
+    # bob arrived last but is not stuck behind all of alice's requests
+    assert order == ['alice', 'bob', 'alice', 'alice']
+
+
+def test_full_queue_and_timeout_reject_and_refund():
+    controller = _controller(queue_max=1, queue_timeout=0.1, burst=2, rate_per_minute=0.001)
+    permit = controller.admit('holder')
+    order = []
+    waiting = _admit_in_background(controller, 'alice', order)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit('bob')
+    assert rejected.value.reason == 'queue_full'
+    waiting.join(5)
+    assert order == ['queue_timeout']
+
+    permit.release()
+    assert controller._active == 0 and controller._waiting == 0
+    # Rejected requests do not use up the user's burst
+    controller.admit('bob').release()
+    controller.admit('bob').release()
@@ -0,0 +1,79 @@
+import pytest
+
+import llm_resilience
+from llm_resilience import CircuitBreaker, ProviderUnavailable
+
+
+class _Response:
+    text = 'Try an earlier bedtime.'
+
+
+class _Model:
+    """Raises each queued exception in turn, then answers normally"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+
+    def generate_content(self, prompt, stream=False):
+        if self.errors:
+            raise self.errors.pop(0)
+        return iter([_Response()]) if stream else _Response()
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_seconds=0)
+    monkeypatch.setattr(llm_resilience, 'breaker', breaker)
+    monkeypatch.setattr(llm_resilience, 'LLM_MAX_RETRIES', 0)
+    return breaker
+
+
+def _blocked():
+    # What Gemini's `.text` raises for a safety-blocked response
+    return ValueError('The response was blocked')
+
+
+def test_blocked_responses_do_not_open_the_breaker(breaker):
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            llm_resilience.generate_text(_Model(_blocked()), 'prompt')
+        with pytest.raises(ValueError):
+            list(llm_resilience.generate_stream(_Model(_blocked()), 'prompt'))
+    assert breaker.state == 'closed'
+
+
+def test_provider_failures_open_the_breaker(breaker):
+    breaker.cooldown_seconds = 60
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            llm_resilience.generate_text(_Model(ConnectionError()), 'prompt')
+    assert breaker.state == 'open'
+    with pytest.raises(ProviderUnavailable):
+        llm_resilience.generate_text(_Model(), 'prompt')
+
+
+def _open_then_cool_down(breaker):
+    breaker.cooldown_seconds = 60
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker._opened_at -= 60
+    assert breaker.state == 'half_open'
+
+
+def test_half_open_trial_released_by_non_provider_error(breaker):
+    _open_then_cool_down(breaker)
+
+    # The trial ends in a caller-side error: no verdict, and another trial may run
+    with pytest.raises(ValueError):
+        llm_resilience.generate_text(_Model(_blocked()), 'prompt')
+    assert breaker.state == 'half_open'
+
+    assert llm_resilience.generate_text(_Model(), 'prompt') == _Response.text
+    assert breaker.state == 'closed'
+
+
+def test_failed_stream_trial_reopens_the_breaker(breaker):
+    _open_then_cool_down(breaker)
+    with pytest.raises(ConnectionError):
+        list(llm_resilience.generate_stream(_Model(ConnectionError()), 'prompt'))
+    assert breaker.state == 'open'
@@ -0,0 +1,38 @@
+import sqlite3
+
+import pytest
+
+from message_codec import CODEC_ZLIB_DICT_V1, MESSAGE_COMPRESSION_MIN_BYTES, decode_message, encode_message, register_sql_functions
+
+LONG_REPLY = (
+    "At 6 months most babies need two to three naps a day. Try to keep wake windows around "
+    "two to two and a half hours, and watch for sleepy cues like rubbing eyes. 🌙 Ça va bien. "
+) * 10
+
+
+@pytest.mark.parametrize('text', [None, '', 'short', 'x' * (MESSAGE_COMPRESSION_MIN_BYTES - 1), LONG_REPLY])
+def test_round_trip(text):
+    stored, codec = encode_message(text)
+    assert decode_message(stored, codec) == text
+
+
+def test_long_text_is_stored_compressed():
+    stored, codec = encode_message(LONG_REPLY)
+    assert codec == CODEC_ZLIB_DICT_V1
+    assert isinstance(stored, bytes) and len(stored) < len(LONG_REPLY.encode('utf-8'))
+
+
+def test_short_text_is_stored_as_is():
+    assert encode_message('Thanks!') == ('Thanks!', None)
+
+
+def test_sql_function_decodes_stored_rows():
+    conn = sqlite3.connect(':memory:')
+    register_sql_functions(conn)
+    stored, codec = encode_message(LONG_REPLY)
+    assert conn.execute('SELECT message_text(?, ?)', (stored, codec)).fetchone()[0] == LONG_REPLY
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        decode_message(b'data', 'brotli-v9')
@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+from limits import RateLimitItemPerMinute
+from limits.strategies import FixedWindowRateLimiter, MovingWindowRateLimiter
+
+import rate_limit_storage
+from rate_limit_storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return SQLiteStorage(f"sqlite:///{tmp_path / 'ratelimits.db'}")
+
+
+def test_fixed_window_counts_and_resets(storage):
+    assert storage.incr('k', 60) == 1
+    assert storage.incr('k', 60, amount=2) == 3
+    assert storage.get('k') == 3
+    storage.clear('k')
+    assert storage.get('k') == 0
+
+
+def test_expired_counter_starts_a_new_window(storage):
+    storage.incr('k', -1)
+    assert storage.get('k') == 0
+    assert storage.incr('k', 60) == 1
+
+
+def test_moving_window_enforces_the_limit(storage):
+    limiter = MovingWindowRateLimiter(storage)
+    limit = RateLimitItemPerMinute(3)
+    assert [limiter.hit(limit, 'user') for _ in range(4)] == [True, True, True, False]
+    assert limiter.get_window_stats(limit, 'user')[1] == 0
+    assert limiter.hit(limit, 'other')
+
+
+def test_concurrent_hits_never_exceed_the_limit(storage):
+    limiter = FixedWindowRateLimiter(storage)
+    limit = RateLimitItemPerMinute(50)
+    results = []
+    lock = threading.Lock()
+
+    def hit():
+        for _ in range(20):
+            allowed = limiter.hit(limit, 'shared')
+            with lock:
+                results.append(allowed)
+
+    threads = [threading.Thread(target=hit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 50
+    # Connections are pooled, never more than the pool size
+    assert storage._pool.qsize() <= rate_limit_storage.RATE_LIMIT_POOL_SIZE
+
+
+def test_sweep_deletes_expired_rows(storage, monkeypatch):
+    storage.incr('old', -1)
+    storage.acquire_entry('old-entry', 5, -1)
+    monkeypatch.setattr(rate_limit_storage, 'EXPIRY_SWEEP_SECONDS', 0)
+    storage.incr('new', 60)
+    with storage._connection() as conn:
+        keys = [row[0] for row in conn.execute('SELECT key FROM rate_limit_counters')]
+        entries = conn.execute('SELECT COUNT(*) FROM rate_limit_entries').fetchone()[0]
+    assert keys == ['new'] and entries == 0
@@ -0,0 +1,42 @@
+import threading
+import time
+
+import stream_registry
+from chat_stream import coalesce_chunks
+from stream_registry import ChatStream
+
+
+def _stalled_upstream(closed):
+    yield 'first chunk'
+    # A provider that stops sending without ending the stream
+    closed.wait(5)
+
+
+def test_abandoned_stream_is_cancelled_while_upstream_stalls(monkeypatch):
+    monkeypatch.setattr(stream_registry, 'STREAM_CANCEL_GRACE_SECONDS', 0.2)
+    stream = ChatStream()
+    closed = threading.Event()
+    stream.watch_abandonment(closed.set)
+
+    started = time.monotonic()
+    frames = list(coalesce_chunks(_stalled_upstream(closed), stream.cancelled))
+
+    assert frames == ['first chunk']
+    assert stream.cancelled.is_set() and closed.is_set()
+    assert time.monotonic() - started < 2
+
+
+def test_attached_subscriber_keeps_stream_alive(monkeypatch):
+    monkeypatch.setattr(stream_registry, 'STREAM_CANCEL_GRACE_SECONDS', 0.1)
+    stream = ChatStream()
+    subscriber = stream.subscribe()
+    stream.publish({'chunk': 'hello', 'done': False})
+    next(subscriber)
+    stream.watch_abandonment(lambda: None)
+
+    time.sleep(0.6)
+    assert not stream.cancelled.is_set()
+
+    subscriber.close()
+    time.sleep(0.6)
+    assert stream.cancelled.is_set()
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+import usage_ledger
+from usage_ledger import UsageRecord, flush_usage, get_today_usage, record_usage
+
+
+@pytest.fixture
+def ledger(db, monkeypatch):
+    monkeypatch.setattr(usage_ledger, '_buffer', [])
+    monkeypatch.setattr(usage_ledger, '_quota_usage', {})
+    monkeypatch.setattr(usage_ledger, '_quota_day', None)
+    monkeypatch.setattr(usage_ledger, '_writer', None)
+    return db
+
+
+def _record(user_id, tokens):
+    usage = UsageRecord(user_id, None)
+    usage.prompt_tokens = tokens
+    record_usage(usage)
+
+
+def test_reload_during_flush_counts_rows_once(ledger, monkeypatch):
+    _record(7, 100)
+    committing = threading.Event()
+    release = threading.Event()
+    write_entries = usage_ledger._write_entries
+
+    def slow_write(entries):
+        committing.set()
+        release.wait(5)
+        return write_entries(entries)
+
+    monkeypatch.setattr(usage_ledger, '_write_entries', slow_write)
+    flusher = threading.Thread(target=flush_usage)
+    flusher.start()
+    assert committing.wait(5)
+
+    loaded = {}
+    loader = threading.Thread(target=lambda: loaded.update(usage=usage_ledger._load_today(7, usage_ledger._utc_day())))
+    loader.start()
+    release.set()
+    flusher.join(5)
+    loader.join(5)
+    assert (loaded['usage']['turns'], loaded['usage']['tokens']) == (1, 100)
+
+
+def test_failed_flush_keeps_rows_counted(ledger, monkeypatch):
+    _record(7, 100)
+
+    write_entries = usage_ledger._write_entries
+
+    def failing_write(entries):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(usage_ledger, '_write_entries', failing_write)
+    with pytest.raises(RuntimeError):
+        flush_usage()
+    assert get_today_usage(7) == (1, 100)
+
+    monkeypatch.setattr(usage_ledger, '_write_entries', write_entries)
+    assert flush_usage() == 1
+    assert usage_ledger._load_today(7, usage_ledger._utc_day())['turns'] == 1
+
+
+def test_quota_totals_from_earlier_days_are_evicted(ledger, monkeypatch):
+    monkeypatch.setattr(usage_ledger, '_utc_day', lambda: '2026-01-01')
+    get_today_usage(1)
+    get_today_usage(2)
+    monkeypatch.setattr(usage_ledger, '_utc_day', lambda: '2026-01-02')
+    get_today_usage(2)
+    assert set(usage_ledger._quota_usage) == {2}
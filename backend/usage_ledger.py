@@ -0,0 +1,267 @@
+"""
+Per-user LLM usage ledger and daily quotas.
+
+Every chat turn produces one `llm_usage` row: model, estimated prompt and
+response tokens, latency, whether it was served from the response cache, and
+how it ended (complete, partial, cancelled or error). Rows are buffered in
+memory and a writer thread appends them every USAGE_FLUSH_SECONDS, or sooner
+once USAGE_FLUSH_BATCH_SIZE rows are waiting. Each flush is one transaction,
+which also adds the rows into the `llm_usage_daily` per-user rollups. A chat
+turn never waits for a commit.
+
+Quotas (LLM_DAILY_TOKEN_QUOTA, LLM_DAILY_TURN_QUOTA; 0 = unlimited) are
+checked from memory. A user's rollup for the current UTC day is loaded once and
+re-read every USAGE_QUOTA_REFRESH_SECONDS so usage from other workers is picked
+up. In between, this process's own turns are added as they are recorded.
+Totals from earlier days are dropped when the UTC day changes. A reload waits
+for any running flush, so rows taken from the buffer are seen either in the
+rollup (committed) or back in the buffer (failed), never missed or doubled.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import get_db_connection
+from metrics import increment
+from security_utils import safe_log
+
+USAGE_FLUSH_SECONDS = float(os.getenv('USAGE_FLUSH_SECONDS', '2'))
+USAGE_FLUSH_BATCH_SIZE = 200
+# Rows kept in memory if the database is unavailable; older rows are dropped past this
+USAGE_BUFFER_MAX = 10000
+LLM_DAILY_TOKEN_QUOTA = int(os.getenv('LLM_DAILY_TOKEN_QUOTA', '0'))
+LLM_DAILY_TURN_QUOTA = int(os.getenv('LLM_DAILY_TURN_QUOTA', '0'))
+USAGE_QUOTA_REFRESH_SECONDS = 60
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after))
+
+
+class UsageRecord:
+    """Usage of one chat turn, filled in as the turn progresses"""
+
+    def __init__(self, user_id, conversation_id):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.model = None
+        self.prompt_tokens = 0
+        self.cache_hit = False
+        self.started = time.monotonic()
+        self.recorded = False
+
+
+def _utc_day():
+    return datetime.utcnow().date().isoformat()
+
+
+def _seconds_until_utc_midnight():
+    now = datetime.utcnow()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (tomorrow - now).total_seconds()
+
+
+_buffer = []
+_buffer_lock = threading.Lock()
+# Held for a whole flush, from taking the rows until they commit or are put back
+_flush_lock = threading.Lock()
+# user_id -> {'day', 'loaded_at', 'turns', 'tokens'}; today's totals as seen by this process
+_quota_usage = {}
+_quota_day = None
+
+
+def _load_today(user_id, day):
+    # A flush cannot commit between reading the rollup and counting unflushed rows
+    with _flush_lock:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT turns, prompt_tokens + response_tokens AS tokens FROM llm_usage_daily
+            WHERE user_id = ? AND day = ?
+        ''', (user_id, day))
+        row = cursor.fetchone()
+        conn.close()
+        turns, tokens = (row['turns'], row['tokens']) if row else (0, 0)
+        with _buffer_lock:
+            # Recorded here but not committed yet, so not in the rollup
+            for entry in _buffer:
+                if entry['user_id'] == user_id and entry['day'] == day:
+                    turns += 1
+                    tokens += entry['prompt_tokens'] + entry['response_tokens']
+    return {'day': day, 'loaded_at': time.monotonic(), 'turns': turns, 'tokens': tokens}
+
+
+def get_today_usage(user_id):
+    """Return (turns, tokens) used today by user_id, from memory when fresh"""
+    global _quota_day
+    day = _utc_day()
+    if day != _quota_day:
+        # Earlier days' totals are never read again
+        _quota_usage.clear()
+        _quota_day = day
+    usage = _quota_usage.get(user_id)
+    if usage is None or usage['day'] != day or time.monotonic() - usage['loaded_at'] > USAGE_QUOTA_REFRESH_SECONDS:
+        usage = _quota_usage[user_id] = _load_today(user_id, day)
+    return usage['turns'], usage['tokens']
+
+
+def check_quota(user_id):
+    """Raise QuotaExceeded if user_id has used up today's allowance"""
+    if not user_id or not (LLM_DAILY_TOKEN_QUOTA or LLM_DAILY_TURN_QUOTA):
+        return
+    turns, tokens = get_today_usage(user_id)
+    if LLM_DAILY_TURN_QUOTA and turns >= LLM_DAILY_TURN_QUOTA:
+        increment('llm_rejected_quota')
+        raise QuotaExceeded('daily_turn_quota', _seconds_until_utc_midnight())
+    if LLM_DAILY_TOKEN_QUOTA and tokens >= LLM_DAILY_TOKEN_QUOTA:
+        increment('llm_rejected_quota')
+        raise QuotaExceeded('daily_token_quota', _seconds_until_utc_midnight())
+
+
+def record_usage(usage, response_tokens=0, status='complete'):
+    """Queue the ledger row for a finished turn (only the first call per turn counts)"""
+    if usage is None or usage.recorded:
+        return
+    usage.recorded = True
+    entry = {
+        'user_id': usage.user_id,
+        'conversation_id': usage.conversation_id,
+        'model': 'response_cache' if usage.cache_hit else usage.model,
+        'prompt_tokens': usage.prompt_tokens,
+        'response_tokens': response_tokens,
+        'latency_ms': int((time.monotonic() - usage.started) * 1000),
+        'cache_hit': 1 if usage.cache_hit else 0,
+        'status': status,
+        'day': _utc_day(),
+    }
+    with _buffer_lock:
+        if len(_buffer) >= USAGE_BUFFER_MAX:
+            del _buffer[0]
+            increment('usage_rows_dropped')
+        _buffer.append(entry)
+        buffered = len(_buffer)
+
+    tracked = _quota_usage.get(usage.user_id)
+    if tracked is not None and tracked['day'] == entry['day']:
+        tracked['turns'] += 1
+        tracked['tokens'] += entry['prompt_tokens'] + response_tokens
+    increment('llm_prompt_tokens', entry['prompt_tokens'])
+    increment('llm_response_tokens', response_tokens)
+    if buffered >= USAGE_FLUSH_BATCH_SIZE and _writer is not None:
+        _writer.wake()
+
+
+def flush_usage():
+    """Write buffered rows and their daily rollups in one transaction; returns rows written"""
+    with _flush_lock:
+        with _buffer_lock:
+            entries = _buffer[:]
+            _buffer.clear()
+        try:
+            return _write_entries(entries)
+        except Exception:
+            # Keep the rows for the next flush
+            with _buffer_lock:
+                _buffer[:0] = entries
+                del _buffer[:max(0, len(_buffer) - USAGE_BUFFER_MAX)]
+            raise
+
+
+def _write_entries(entries):
+    if not entries:
+        return 0
+
+    rollups = {}
+    for entry in entries:
+        if entry['user_id'] is None:
+            continue
+        key = (entry['user_id'], entry['day'])
+        totals = rollups.setdefault(key, [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += entry['prompt_tokens']
+        totals[2] += entry['response_tokens']
+        totals[3] += entry['cache_hit']
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO llm_usage
+                (user_id, conversation_id, model, prompt_tokens, response_tokens, latency_ms, cache_hit, status)
+            VALUES (:user_id, :conversation_id, :model, :prompt_tokens, :response_tokens, :latency_ms, :cache_hit, :status)
+        ''', entries)
+        cursor.executemany('''
+            INSERT INTO llm_usage_daily (user_id, day, turns, prompt_tokens, response_tokens, cache_hits)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                turns = turns + excluded.turns,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                response_tokens = response_tokens + excluded.response_tokens,
+                cache_hits = cache_hits + excluded.cache_hits
+        ''', [(user_id, day, *totals) for (user_id, day), totals in rollups.items()])
+        conn.commit()
+    finally:
+        conn.close()
+    increment('usage_rows_flushed', len(entries))
+    return len(entries)
+
+
+class UsageWriter(threading.Thread):
+    """Background thread that appends buffered usage rows"""
+
+    def __init__(self):
+        super().__init__(name='usage-ledger', daemon=True)
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(USAGE_FLUSH_SECONDS)
+            self._wake.clear()
+            try:
+                flush_usage()
+            except Exception:
+                safe_log('error', 'Usage ledger flush failed')
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _flush_at_exit():
+    try:
+        flush_usage()
+    except Exception:
+        pass
+
+
+def start_usage_writer():
+    """Start this process's usage writer (idempotent)"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = UsageWriter()
+            _writer.start()
+            atexit.register(_flush_at_exit)
+    return _writer
+
+
+def get_daily_usage(user_id, days=30):
+    """Return the user's daily rollups for the last `days` days, newest first"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT day, turns, prompt_tokens, response_tokens, cache_hits FROM llm_usage_daily
+        WHERE user_id = ? AND day >= DATE('now', ?)
+        ORDER BY day DESC
+    ''', (user_id, f'-{days} day'))
+    rows = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return rows
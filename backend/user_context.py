@@ -0,0 +1,104 @@
+"""
+Per-user prompt context (baby profiles and sleep goals).
+
+The "PARENT AND BABY INFORMATION" block is rendered once and cached per
+process keyed by (user_id, profile_version, date). profile_version is bumped by
+every baby-profile and sleep-goal write (see profile_cache), and including the
+date means ages derived from birth_date are recomputed when the day changes.
+On a cache hit building the prompt needs no database query at all, since the
+profile version comes with the session's user row.
+"""
+from datetime import datetime
+
+from database import get_read_connection
+from profile_cache import LRUCache
+
+USER_CONTEXT_CACHE_MAX_ENTRIES = 4096
+
+USER_CONTEXT_HEADER = "\n\n=== PARENT AND BABY INFORMATION ===\n"
+USER_CONTEXT_FOOTER = "Use this information to provide personalized, tailored advice that addresses their specific baby and goals.\n\n"
+
+_cache = LRUCache(USER_CONTEXT_CACHE_MAX_ENTRIES)
+
+
+def calculate_age_months(birth_date, today=None):
+    today = today or datetime.utcnow().date()
+    months = (today.year - birth_date.year) * 12 + (today.month - birth_date.month)
+    if today.day < birth_date.day:
+        months -= 1
+    return months
+
+
+def _baby_age_line(bp, today):
+    if bp.get('birth_date'):
+        try:
+            birth_date = datetime.strptime(bp['birth_date'], '%Y-%m-%d').date()
+            return f"- Age: {calculate_age_months(birth_date, today)} months\n"
+        except (TypeError, ValueError):
+            pass
+    if bp.get('age_months'):
+        return f"- Age: {bp['age_months']} months\n"
+    if bp.get('birth_date'):
+        return f"- Birth date: {bp['birth_date']}\n"
+    return None
+
+
+def render_user_context(baby_profiles, sleep_goals, today=None):
+    """Render the prompt block for a user's baby profiles and sleep goals ('' when empty)"""
+    today = today or datetime.utcnow().date()
+    parts = []
+
+    if baby_profiles:
+        if len(baby_profiles) == 1:
+            parts.append("Baby Information:\n")
+        else:
+            parts.append(f"Baby Information ({len(baby_profiles)} babies):\n")
+
+        for idx, bp in enumerate(baby_profiles, 1):
+            if len(baby_profiles) > 1:
+                parts.append(f"\nBaby {idx}:\n")
+            if bp.get('name'):
+                parts.append(f"- Baby's name: {bp['name']}\n")
+            age_line = _baby_age_line(bp, today)
+            if age_line:
+                parts.append(age_line)
+            if bp.get('sleep_issues'):
+                parts.append(f"- Sleep issues: {bp['sleep_issues']}\n")
+            if bp.get('current_schedule'):
+                parts.append(f"- Current sleep schedule: {bp['current_schedule']}\n")
+            if bp.get('notes'):
+                parts.append(f"- Additional notes: {bp['notes']}\n")
+        parts.append("\n")
+
+    if sleep_goals:
+        parts.append("Parent's Sleep Goals:\n")
+        goals = [
+            f"{number}. {sleep_goals[f'goal_{number}']}"
+            for number in range(1, 6)
+            if sleep_goals.get(f'goal_{number}')
+        ]
+        if goals:
+            parts.append("\n".join(goals) + "\n")
+        parts.append("\n")
+
+    if not parts:
+        return ''
+    return USER_CONTEXT_HEADER + ''.join(parts) + USER_CONTEXT_FOOTER
+
+
+def get_user_context_block(user_id, profile_version):
+    """Return the cached prompt block for a user, rendering it on a miss"""
+    today = datetime.utcnow().date()
+    key = (user_id, profile_version or 0, today)
+    block = _cache.get(key)
+    if block is None:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM baby_profiles WHERE user_id = ? ORDER BY created_at ASC', (user_id,))
+        baby_profiles = [dict(bp) for bp in cursor.fetchall()]
+        cursor.execute('SELECT * FROM sleep_goals WHERE user_id = ?', (user_id,))
+        sleep_goals = cursor.fetchone()
+        conn.close()
+        block = render_user_context(baby_profiles, dict(sleep_goals) if sleep_goals else None, today)
+        _cache.put(key, block)
+    return block
@@ -0,0 +1,165 @@
+"""
+Username and email availability checks.
+
+Lookups use `SELECT 1` probes against the auth_users indexes so no row data is
+fetched. Names freed by a rename that is still cascading are held in
+username_reservations and count as taken.
+
+Taken usernames are also mirrored into a per-process Bloom filter, refreshed
+incrementally (by auth_users.id) and rebuilt every BLOOM_REBUILD_SECONDS.
+Renames and purges done by other workers only reach it on a rebuild, so it is
+used as a fast "maybe taken" answer: random-name generation skips candidates it
+flags, and every name that is actually claimed or reported free is confirmed
+with the username index.
+"""
+import hashlib
+import math
+import threading
+import time
+
+# Full rebuild interval in seconds. Incremental refreshes only see new rows,
+# so renames done by other workers are picked up on the next rebuild.
+BLOOM_REBUILD_SECONDS = 300
+BLOOM_MIN_CAPACITY = 1024
+BLOOM_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings"""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+class _TakenUsernames:
+    """Bloom filter of taken usernames, kept in sync with auth_users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_id = 0
+        self._built_at = 0.0
+
+    def _rebuild(self, cursor):
+        cursor.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM auth_users')
+        total, max_id = cursor.fetchone()
+        bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, total * 2))
+        cursor.execute('SELECT username FROM auth_users WHERE id <= ?', (max_id,))
+        for (username,) in cursor.fetchall():
+            bloom.add(username)
+        self._bloom = bloom
+        self._last_id = max_id
+        self._built_at = time.monotonic()
+
+    def refresh(self, cursor):
+        with self._lock:
+            stale = time.monotonic() - self._built_at > BLOOM_REBUILD_SECONDS
+            if self._bloom is None or stale or self._bloom.count >= self._bloom.capacity:
+                self._rebuild(cursor)
+                return
+            cursor.execute(
+                'SELECT id, username FROM auth_users WHERE id > ? ORDER BY id',
+                (self._last_id,)
+            )
+            for row in cursor.fetchall():
+                self._bloom.add(row[1])
+                self._last_id = row[0]
+
+    def might_contain(self, username):
+        with self._lock:
+            return self._bloom is None or username in self._bloom
+
+    def add(self, username):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(username)
+
+
+_taken = _TakenUsernames()
+
+
+def username_exists(cursor, username, exclude_user_id=None):
+    """Authoritative indexed check for an existing (or rename-reserved) username"""
+    if exclude_user_id is None:
+        cursor.execute('''
+            SELECT 1 FROM auth_users WHERE username = ?
+            UNION ALL
+            SELECT 1 FROM username_reservations WHERE username = ?
+            LIMIT 1
+        ''', (username, username))
+    else:
+        cursor.execute('''
+            SELECT 1 FROM auth_users WHERE username = ? AND id != ?
+            UNION ALL
+            SELECT 1 FROM username_reservations WHERE username = ? AND user_id != ?
+            LIMIT 1
+        ''', (username, exclude_user_id, username, exclude_user_id))
+    return cursor.fetchone() is not None
+
+
+def email_exists(cursor, email, exclude_user_id=None):
+    """Authoritative indexed check for an existing email"""
+    if exclude_user_id is None:
+        cursor.execute('SELECT 1 FROM auth_users WHERE email = ? LIMIT 1', (email,))
+    else:
+        cursor.execute(
+            'SELECT 1 FROM auth_users WHERE email = ? AND id != ? LIMIT 1',
+            (email, exclude_user_id)
+        )
+    return cursor.fetchone() is not None
+
+
+def is_username_available(cursor, username):
+    """
+    Availability check for live form validation.
+    Always confirmed against the username index: another worker's Bloom filter
+    may have seen a rename or purge this one has not.
+    """
+    return not username_exists(cursor, username)
+
+
+def pick_available_username(cursor, candidates):
+    """
+    Return the first candidate that is not taken, or None.
+    Likely-taken candidates are dropped via the Bloom filter and the rest are
+    tested with a single IN query.
+    """
+    _taken.refresh(cursor)
+    candidates = [c for c in dict.fromkeys(candidates) if c and not _taken.might_contain(c)]
+    if not candidates:
+        return None
+    placeholders = ', '.join('?' for _ in candidates)
+    cursor.execute(f'''
+        SELECT username FROM auth_users WHERE username IN ({placeholders})
+        UNION
+        SELECT username FROM username_reservations WHERE username IN ({placeholders})
+    ''', candidates + candidates)
+    taken = {row[0] for row in cursor.fetchall()}
+    for candidate in candidates:
+        if candidate not in taken:
+            return candidate
+    return None
+
+
+def mark_username_taken(username):
+    """Record a newly claimed username in the local Bloom filter"""
+    if username:
+        _taken.add(username)